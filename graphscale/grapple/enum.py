@@ -5,10 +5,14 @@ from graphql import GraphQLEnumType
 from graphql.type import GraphQLEnumValue
 from graphql.language.ast import EnumValue, Value
 
+from graphscale.kvetch.data_storage import register_body_enum
+
 
 class GraphQLPythonEnumType(GraphQLEnumType):
     def __init__(self, python_enum_type: Any, description: str=None) -> None:
         self.python_enum_type = python_enum_type
+        # generated pents store their enums in kvetch bodies
+        register_body_enum(python_enum_type)
         name = python_enum_type.__name__
         values = OrderedDict()  # type: OrderedDict[Any, GraphQLEnumValue]
         for enum_value in python_enum_type.__members__.keys():
@@ -1,4 +1,7 @@
-from typing import Any, Callable, Dict
+import inspect
+from typing import Any, Callable, Dict, FrozenSet
+
+from graphql.language.ast import Field
 
 from graphscale import check
 from graphscale.errors import async_field_error_boundary, field_error_boundary
@@ -36,9 +39,40 @@ def define_pent_mutation_resolver(python_name: str, pent_data_cls_name: str) ->
     return mutation_resolver
 
 
+def collect_projection(info: Any) -> FrozenSet[str]:
+    """Data attribute names selected directly under the field being resolved. Returns None
+    (meaning everything) whenever the selection can't be read exactly, e.g. fragments."""
+    projection = set()
+    for field_ast in info.field_asts:
+        selection_set = field_ast.selection_set
+        if selection_set is None:
+            return None
+        for selection in selection_set.selections:
+            if not isinstance(selection, Field):
+                return None
+            name = selection.name.value
+            if name == '__typename':
+                continue
+            projection.add('obj_id' if name == 'id' else to_snake_case(name))
+    return frozenset(projection)
+
+
+_ACCEPTS_PROJECTION = {}  # type: Dict[Callable, bool]
+
+
+def accepts_projection(prop: Callable) -> bool:
+    func = getattr(prop, '__func__', prop)
+    if func not in _ACCEPTS_PROJECTION:
+        try:
+            _ACCEPTS_PROJECTION[func] = 'projection' in inspect.signature(func).parameters
+        except (TypeError, ValueError):
+            _ACCEPTS_PROJECTION[func] = False
+    return _ACCEPTS_PROJECTION[func]
+
+
 def define_default_gen_resolver(python_name: str) -> Callable:
     @async_field_error_boundary
-    async def the_resolver(obj: Any, args: Dict[str, Any], *_: Any):
+    async def the_resolver(obj: Any, args: Dict[str, Any], *rest: Any):
         if args:
             if 'id' in args:
                 args['obj_id'] = args['id']
@@ -46,6 +80,9 @@ def define_default_gen_resolver(python_name: str) -> Callable:
             args = pythonify_dict(args)
         prop = getattr(obj, python_name)
         check.invariant(callable(prop), 'must be async function')
+        if len(rest) > 1 and accepts_projection(prop):
+            # rest is (context, info). lets list fields skip loading unselected data
+            args['projection'] = collect_projection(rest[1])
         return await prop(**args)
 
     return the_resolver
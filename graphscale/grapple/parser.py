@@ -78,6 +78,7 @@ class FieldVarietal(Enum):
     BROWSE_PENTS = auto()
     GEN_FROM_STORED_ID = auto()
     EDGE_TO_STORED_ID = auto()
+    EDGE_COUNT = auto()
 
     @property
     def is_gen_varietal(self) -> bool:
@@ -91,6 +92,7 @@ class FieldVarietal(Enum):
             FieldVarietal.BROWSE_PENTS,
             FieldVarietal.GEN_FROM_STORED_ID,
             FieldVarietal.EDGE_TO_STORED_ID,
+            FieldVarietal.EDGE_COUNT,
         ]
 
     @property
@@ -112,11 +114,15 @@ class EdgeToStoredIdData(NamedTuple):
     field: str
 
 
+class EdgeCountData(NamedTuple):
+    edge_name: str
+
+
 class DeletePentData(NamedTuple):
     type: str
 
 
-FieldVarietalsUnion = Union[EdgeToStoredIdData, DeletePentData]
+FieldVarietalsUnion = Union[EdgeToStoredIdData, EdgeCountData, DeletePentData]
 
 
 class GrappleFieldData(NamedTuple):
@@ -402,6 +408,7 @@ FIELD_VARIETAL_MAPPING = {
     'browsePents': FieldVarietal.BROWSE_PENTS,
     'genFromStoredId': FieldVarietal.GEN_FROM_STORED_ID,
     'edgeToStoredId': FieldVarietal.EDGE_TO_STORED_ID,
+    'edgeCount': FieldVarietal.EDGE_COUNT,
 }
 
 
@@ -426,6 +433,9 @@ def get_field_varietal_data(
             edge_id=req_int_argument(dir_ast, 'edgeId'),
             field=req_string_argument(dir_ast, 'field'),
         )
+    elif field_varietal == FieldVarietal.EDGE_COUNT:
+        dir_ast = get_directive(graphql_field, 'edgeCount')
+        return EdgeCountData(edge_name=req_string_argument(dir_ast, 'edgeName'))
     elif field_varietal == FieldVarietal.DELETE_PENT:
         dir_ast = get_directive(graphql_field, 'deletePent')
         return DeletePentData(type=req_string_argument(dir_ast, 'type'))
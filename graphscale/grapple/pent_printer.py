@@ -5,7 +5,7 @@ from graphscale.utils import to_snake_case
 
 from .code_writer import CodeWriter
 from .parser import (
-    DeletePentData, EdgeToStoredIdData, FieldVarietal, GrappleDocument, GrappleField,
+    DeletePentData, EdgeCountData, EdgeToStoredIdData, FieldVarietal, GrappleDocument, GrappleField,
     GrappleFieldArgument, GrappleTypeDef, TypeRefVarietal, GrappleTypeRef, TypeVarietal
 )
 
@@ -16,7 +16,7 @@ GENERATED_PENT_HEADER = """#W0611: unused imports lint
 
 from collections import namedtuple
 from enum import Enum, auto
-from typing import List, Any
+from typing import List, Any, FrozenSet
 from uuid import UUID
 
 from graphscale import check
@@ -203,6 +203,8 @@ def print_generated_fields(
             print_gen_from_stored_id_field(writer, field)
         elif field.field_varietal == FieldVarietal.EDGE_TO_STORED_ID:
             print_edge_to_stored_id_field(writer, field)
+        elif field.field_varietal == FieldVarietal.EDGE_COUNT:
+            print_edge_count_field(writer, field)
         else:
             raise Exception('unsupported varietal')
 
@@ -419,13 +421,13 @@ def print_edge_to_stored_id_field(writer: CodeWriter, field: GrappleField) -> No
 
     _first_arg, _after_arg, target_type = get_first_after_args(field)
     writer.line(
-        "async def %s(self, first: int=100, after: UUID=None) -> List[Pent]: # mypy circ '%s'" %
-        (field.python_name, python_typing_string(field.type_ref))
+        "async def %s(self, first: int=100, after: UUID=None, projection: FrozenSet[str]=None)"
+        " -> List[Pent]: # mypy circ '%s'" % (field.python_name, python_typing_string(field.type_ref))
     )
     writer.increase_indent()  # begin implemenation
     writer.line(
         "return await self.gen_associated_pents_dynamic"
-        "('{target_type}', '{edge_name}', after, first) # type: ignore".format(
+        "('{target_type}', '{edge_name}', after, first, projection) # type: ignore".format(
             target_type=target_type, edge_name=field.field_varietal_data.edge_name
         )
     )
@@ -433,6 +435,25 @@ def print_edge_to_stored_id_field(writer: CodeWriter, field: GrappleField) -> No
     writer.blank_line()
 
 
+def print_edge_count_field(writer: CodeWriter, field: GrappleField) -> None:
+    if not isinstance(field.field_varietal_data, EdgeCountData):
+        check.failed('not an EdgeCountData')
+
+    check.invariant(len(field.args) == 0, 'edgeCount should have no args')
+    named_type = field.type_ref
+    if named_type.varietal == TypeRefVarietal.NONNULL:
+        named_type = named_type.inner_type
+    check.invariant(named_type.graphql_typename == 'Int', 'edgeCount must be an Int')
+
+    writer.line('async def %s(self) -> int:' % field.python_name)
+    writer.increase_indent()  # begin implemenation
+    writer.line(
+        "return await self.gen_edge_count('%s')" % field.field_varietal_data.edge_name
+    )
+    writer.decrease_indent()  # end implementation
+    writer.blank_line()
+
+
 def print_gen_from_stored_id_field(writer: CodeWriter, field: GrappleField) -> None:
     check.invariant(len(field.args) == 0, 'genFromStoredId should have no args')
     check.invariant(
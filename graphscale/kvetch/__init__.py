@@ -1,7 +1,9 @@
 from .kvetch import (
     Kvetch,
     Schema,
+    EdgeCursor,
     EdgeData,
+    EdgeQuery,
     ObjectDefinition,
     StoredIdEdgeDefinition,
     IndexDefinition,
@@ -9,8 +11,21 @@ from .kvetch import (
     define_int_index,
 )
 
+from .routing import (
+    ShardRouter,
+    ModuloShardRouter,
+    ConsistentHashShardRouter,
+    plan_shard_moves,
+)
+
+from .cache import (
+    KvetchObjectCache,
+    KvetchCacheStats,
+)
+
 from .init import (
     init_from_conn,
     nuke_conn,
     init_in_memory,
+    init_durable_in_memory,
 )
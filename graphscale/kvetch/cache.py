@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import sys
+import time
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, NamedTuple, Tuple
+from uuid import UUID
+
+from graphscale.check import invariant
+
+from .data_storage import LazyKvetchRecord
+
+if TYPE_CHECKING:
+    # .kvetch imports this module
+    from .kvetch import KvetchData  # pylint: disable=W0611
+
+
+class KvetchCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int  # entries dropped to stay under max_bytes
+    expirations: int  # entries dropped because they outlived the ttl
+    entries: int
+    size_bytes: int
+
+
+def estimate_size(data: 'KvetchData') -> int:
+    """Approximate in-memory footprint of an object. Only looks one level deep."""
+    size = sys.getsizeof(data)
+    if isinstance(data, LazyKvetchRecord) and not data.is_decoded:
+        # sized by its stored body, without decoding it
+        return size + data.body_size
+    for key, value in data.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+class KvetchObjectCache:
+    """Process-wide LRU + TTL cache of object data, shared by every request.
+
+    Readers fill the cache with begin_fill/end_fill. Any invalidation that happens while
+    a fill is in flight wins over the fill, so a read that raced with a write can never
+    put the pre-write data back into the cache.
+
+    Undecoded LazyKvetchRecords are cached as their stored body and every hit gets a new
+    undecoded record over it, so enabling the cache keeps reads lazy. Records that were
+    already decoded, and plain dicts, are copied and handed out as read-only views.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_bytes: int=64 * 1024 * 1024,
+        ttl: float=60.0,
+        clock: Callable[[], float]=time.monotonic,
+        sizeof: Callable[['KvetchData'], int]=estimate_size
+    ) -> None:
+        invariant(max_bytes > 0, 'max_bytes must be positive')
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._sizeof = sizeof
+
+        # obj_id => (data, expires_at, size). least recently used first
+        self._entries = OrderedDict()  # type: OrderedDict[UUID, Tuple[KvetchData, float, int]]
+        self._size_bytes = 0
+
+        self._epoch = 0
+        self._fills_in_flight = 0
+        # obj_id => epoch of last invalidation. only tracked while fills are in flight
+        self._invalidated_at = {}  # type: Dict[UUID, int]
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get_many(self, obj_ids: Iterable[UUID]) -> Dict[UUID, 'KvetchData']:
+        """Cached objects among obj_ids, as read-only views of the cached copies or as new
+        undecoded records"""
+        now = self._clock()
+        found = {}  # type: Dict[UUID, KvetchData]
+        for obj_id in obj_ids:
+            entry = self._entries.get(obj_id)
+            if entry is None:
+                self._misses += 1
+                continue
+            data, expires_at, _size = entry
+            if expires_at <= now:
+                self._remove(obj_id)
+                self._expirations += 1
+                self._misses += 1
+                continue
+            self._entries.move_to_end(obj_id)
+            self._hits += 1
+            if isinstance(data, LazyKvetchRecord):
+                found[obj_id] = data.undecoded_copy()
+            else:
+                found[obj_id] = MappingProxyType(data)
+        return found
+
+    def begin_fill(self) -> int:
+        self._fills_in_flight += 1
+        return self._epoch
+
+    def end_fill(self, token: int, objs: Dict[UUID, 'KvetchData']) -> None:
+        try:
+            for obj_id, data in objs.items():
+                if data is None or self._invalidated_at.get(obj_id, -1) >= token:
+                    continue
+                self._put(obj_id, data)
+        finally:
+            self._fills_in_flight -= 1
+            if not self._fills_in_flight:
+                self._invalidated_at.clear()
+
+    def invalidate(self, obj_id: UUID) -> None:
+        self._epoch += 1
+        if self._fills_in_flight:
+            self._invalidated_at[obj_id] = self._epoch
+        self._remove(obj_id)
+
+    def clear(self) -> None:
+        for obj_id in list(self._entries.keys()):
+            self.invalidate(obj_id)
+
+    def stats(self) -> KvetchCacheStats:
+        return KvetchCacheStats(
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            expirations=self._expirations,
+            entries=len(self._entries),
+            size_bytes=self._size_bytes,
+        )
+
+    def _put(self, obj_id: UUID, data: 'KvetchData') -> None:
+        self._remove(obj_id)
+        size = self._sizeof(data)
+        if size > self.max_bytes:
+            return
+        # a private copy, never mutated, so reads can share it
+        private = data.undecoded_copy() if isinstance(data, LazyKvetchRecord) else None
+        self._entries[obj_id] = (private or dict(data), self._clock() + self.ttl, size)
+        self._size_bytes += size
+        while self._size_bytes > self.max_bytes:
+            lru_id = next(iter(self._entries))
+            self._remove(lru_id)
+            self._evictions += 1
+
+    def _remove(self, obj_id: UUID) -> None:
+        entry = self._entries.pop(obj_id, None)
+        if entry is not None:
+            self._size_bytes -= entry[2]
@@ -1,25 +1,529 @@
+from abc import ABCMeta, abstractmethod
+from collections.abc import MutableMapping
+from datetime import date, datetime
+from enum import Enum
 import pickle
+import struct
 import zlib
-# import json
-from typing import Dict, Any, cast
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, cast
 
 from uuid import UUID
 
+import iso8601
 
-def data_to_body(data: Dict[str, Any]) -> bytes:
-    return zlib.compress(pickle.dumps(data))
-    # this should switch to json, but I need to do some special support
-    # for correct serializing and deserializing UUIDS and other types
-    # return zlib.compress(json.dumps(data).encode())
+from graphscale.errors import GraphscaleError
+
+# Body layout: one header byte followed by the payload. The low 7 bits of the header
+# are the codec id and the high bit marks a zlib-compressed payload. Rows written before
+# the header existed are bare zlib streams, which always start with 0x78, so that codec
+# id is reserved for them.
+COMPRESSED_FLAG = 0x80
+LEGACY_ZLIB_HEADER = 0x78
+
+# payloads smaller than this are stored uncompressed. zlib rarely wins on them and
+# costs a decompress on every read
+DEFAULT_COMPRESS_THRESHOLD = 512
+
+
+class KvetchBodyDecodeError(GraphscaleError):
+    pass
+
+
+class UnsupportedBodyValue(GraphscaleError):
+    pass
+
+
+class BodyCodec(metaclass=ABCMeta):
+    codec_id = 0
+
+    @abstractmethod
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        ...
+
+    @abstractmethod
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        ...
+
+    # codecs that can pull a single top level field out of a payload without decoding
+    # the rest override decode_field and set this
+    supports_field_decode = False
+
+    def decode_field(self, payload: bytes, key: str) -> Tuple[bool, Any]:
+        """(found, value) for one top level field"""
+        data = self.decode(payload)
+        return (key in data, data.get(key))
+
+
+class PickleBodyCodec(BodyCodec):
+    """Python-only, but pickle's C implementation decodes small objects faster than any
+    pure python format, so it is the default."""
+    codec_id = 1
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        return cast(Dict[str, Any], pickle.loads(payload))
+
+
+class TaggedBodyCodec(BodyCodec):
+    """Compact msgpack-style format: every value is a one byte type tag followed by a
+    fixed size or length-prefixed little-endian payload. Supports None, bool, int, float,
+    str, bytes, list, tuple, dict, UUID, datetime, date and members of enums registered
+    with register_body_enum. Enum members are stored as their class path and value, and
+    decoding only resolves paths of registered enums.
+
+    Readable from other languages, but several times slower than pickle to decode in
+    CPython."""
+    codec_id = 2
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        out = []  # type: List[bytes]
+        _encode_value(data, out)
+        return b''.join(out)
+
+    supports_field_decode = True
+
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        try:
+            value, offset = _decode_value(payload, 0)
+        except _MALFORMED_ERRORS as error:
+            raise KvetchBodyDecodeError('malformed tagged body: ' + str(error))
+        if offset != len(payload) or not isinstance(value, dict):
+            raise KvetchBodyDecodeError('malformed tagged body')
+        return value
+
+    def decode_field(self, payload: bytes, key: str) -> Tuple[bool, Any]:
+        if not payload or payload[0] != _DICT:
+            raise KvetchBodyDecodeError('malformed tagged body')
+        try:
+            size = _LENGTH_STRUCT.unpack_from(payload, 1)[0]
+            offset = 5
+            for _ in range(size):
+                entry_key, offset = _decode_value(payload, offset)
+                if entry_key == key:
+                    return True, _decode_value(payload, offset)[0]
+                offset = _skip_value(payload, offset)
+        except _MALFORMED_ERRORS as error:
+            raise KvetchBodyDecodeError('malformed tagged body: ' + str(error))
+        return False, None
+
+
+PICKLE_CODEC = PickleBodyCodec()
+TAGGED_CODEC = TaggedBodyCodec()
+
+_CODECS = {}  # type: Dict[int, BodyCodec]
+
+
+def register_body_codec(codec: BodyCodec) -> None:
+    codec_id = codec.codec_id
+    if not 0 < codec_id < COMPRESSED_FLAG or codec_id == LEGACY_ZLIB_HEADER:
+        raise GraphscaleError('invalid codec id: ' + str(codec_id))
+    if codec_id in _CODECS and _CODECS[codec_id] is not codec:
+        raise GraphscaleError('codec id already registered: ' + str(codec_id))
+    _CODECS[codec_id] = codec
+
+
+register_body_codec(PICKLE_CODEC)
+register_body_codec(TAGGED_CODEC)
+
+_default_codec = PICKLE_CODEC  # type: BodyCodec
+
+
+def set_default_body_codec(codec: BodyCodec) -> None:
+    """Codec for every body written from now on in this process, unless data_to_body is
+    passed one. Stored bodies are always decoded with the codec that wrote them, so this
+    can be changed on a live database."""
+    global _default_codec  # pylint: disable=W0603
+    if _CODECS.get(codec.codec_id) is not codec:
+        raise GraphscaleError('codec not registered: ' + str(codec.codec_id))
+    _default_codec = codec
+
+
+def get_default_body_codec() -> BodyCodec:
+    return _default_codec
+
+
+def data_to_body(
+    data: Dict[str, Any],
+    codec: BodyCodec=None,
+    compress_threshold: int=DEFAULT_COMPRESS_THRESHOLD
+) -> bytes:
+    """Raises UnsupportedBodyValue if data holds a value the codec cannot encode"""
+    codec = codec or _default_codec
+    if type(data) is not dict:
+        # e.g. a LazyKvetchRecord read back and modified. never store the wrapper itself
+        data = dict(data)
+    payload = codec.encode(data)
+
+    header = codec.codec_id
+    if len(payload) >= compress_threshold:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            header |= COMPRESSED_FLAG
+            payload = compressed
+    return bytes((header, )) + payload
 
 
 def body_to_data(body: bytes) -> Dict[str, Any]:
     if body is None:
         return {}
-    return cast(Dict[str, Any], pickle.loads(zlib.decompress(body)))
+    codec, payload = _split_body(body)
+    return codec.decode(payload)
+
+
+def _split_body(body: bytes) -> Tuple[BodyCodec, bytes]:
+    header = body[0]
+    if header == LEGACY_ZLIB_HEADER:
+        return PICKLE_CODEC, zlib.decompress(body)
+
+    codec = _CODECS.get(header & ~COMPRESSED_FLAG)
+    if codec is None:
+        raise KvetchBodyDecodeError('unknown body codec: ' + str(header))
+    payload = body[1:]
+    if header & COMPRESSED_FLAG:
+        payload = zlib.decompress(payload)
+    return codec, payload
+
+
+class LazyKvetchRecord(MutableMapping):
+    """Object data backed by the raw stored body. obj_id and type_id are available
+    immediately; the body is only decoded when some other field is read. If the body's
+    codec supports field decoding, reading a field decodes just that field until
+    something needs the whole object (iteration, len, writes)."""
+
+    __slots__ = ('_ids', '_body', '_payload', '_codec', '_fields', '_data')
+
+    def __init__(self, obj_id: UUID, type_id: int, body: bytes) -> None:
+        self._ids = {'obj_id': obj_id, 'type_id': type_id}
+        self._body = body
+        self._payload = None  # type: bytes
+        self._codec = None  # type: BodyCodec
+        self._fields = {}  # type: Dict[str, Tuple[bool, Any]]
+        self._data = None  # type: Dict[str, Any]
+
+    @property
+    def is_decoded(self) -> bool:
+        return self._data is not None
+
+    @property
+    def body_size(self) -> int:
+        """Bytes of stored body still held, 0 once decoded"""
+        if self._data is not None:
+            return 0
+        raw = self._body if self._body is not None else self._payload
+        return len(raw) if raw is not None else 0
+
+    def undecoded_copy(self) -> Optional['LazyKvetchRecord']:
+        """A new record over the same stored body, or None once this one is decoded, since
+        its data may have been changed since"""
+        if self._data is not None:
+            return None
+        copy = LazyKvetchRecord(self._ids['obj_id'], self._ids['type_id'], self._body)
+        # the payload is immutable, so both records can share it. decoded fields are not
+        copy._codec, copy._payload = self._codec, self._payload
+        return copy
+
+    def _split(self) -> BodyCodec:
+        if self._codec is None:
+            self._codec, self._payload = _split_body(self._body)
+            self._body = None
+        return self._codec
+
+    def _materialize(self) -> Dict[str, Any]:
+        if self._data is None:
+            body_data = {}  # type: Dict[str, Any]
+            if self._body is not None or self._payload is not None:
+                body_data = self._split().decode(self._payload)
+            self._data = {**self._ids, **body_data}
+            self._payload = None
+            self._fields = {}
+        return self._data
+
+    def __getitem__(self, key: str) -> Any:
+        if self._data is not None:
+            return self._data[key]
+        if key in self._ids:
+            return self._ids[key]
+        if self._body is None and self._payload is None:
+            raise KeyError(key)
+        if key not in self._fields:
+            codec = self._split()
+            if not codec.supports_field_decode:
+                return self._materialize()[key]
+            self._fields[key] = codec.decode_field(self._payload, key)
+        found, value = self._fields[key]
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._materialize()[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self._materialize()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._materialize())
+
+    def __len__(self) -> int:
+        return len(self._materialize())
+
+    def __bool__(self) -> bool:
+        # never empty, since obj_id and type_id are always there. without this, truth
+        # tests would fall back to __len__ and decode the body
+        return True
+
+    def __repr__(self) -> str:
+        if self._data is None:
+            return 'LazyKvetchRecord({0!r}, undecoded)'.format(self._ids)
+        return 'LazyKvetchRecord({0!r})'.format(self._data)
+
+
+def row_to_obj(row: Dict[str, Any]) -> LazyKvetchRecord:
+    return LazyKvetchRecord(UUID(bytes=row['obj_id']), row['type_id'], row['body'])
+
+
+_NONE = 0x00
+_TRUE = 0x01
+_FALSE = 0x02
+_INT64 = 0x03
+_BIGINT = 0x04
+_FLOAT = 0x05
+_STR = 0x06
+_BYTES = 0x07
+_LIST = 0x08
+_TUPLE = 0x09
+_DICT = 0x0A
+_UUID = 0x0B
+_DATETIME = 0x0C
+_DATE = 0x0D
+_ENUM = 0x0E
+
+_NONE_BYTES = bytes((_NONE, ))
+_TRUE_BYTES = bytes((_TRUE, ))
+_FALSE_BYTES = bytes((_FALSE, ))
+_UUID_BYTES = bytes((_UUID, ))
+
+_INT64_STRUCT = struct.Struct('<Bq')
+_FLOAT_STRUCT = struct.Struct('<Bd')
+_HEAD_STRUCT = struct.Struct('<BI')  # tag + length or item count
+_LENGTH_STRUCT = struct.Struct('<I')
+# what the tag decoders raise on a truncated or corrupt payload: short struct reads,
+# reads past the end, short uuids and bad utf-8, dates or enum values
+_MALFORMED_ERRORS = (struct.error, IndexError, ValueError)
+_INT64_MIN = -2**63
+_INT64_MAX = 2**63 - 1
+
+
+def _encode_sized(tag: int, raw: bytes, out: List[bytes]) -> None:
+    out.append(_HEAD_STRUCT.pack(tag, len(raw)))
+    out.append(raw)
+
+
+def _encode_value(value: Any, out: List[bytes]) -> None:
+    # exact type lookup first since that covers nearly every stored value
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        encoder(value, out)
+    elif isinstance(value, Enum):
+        # before the int/str checks so IntEnum members keep their type
+        path = _enum_path(type(value))
+        if _ENUM_CLASSES.get(path) is not type(value):
+            raise UnsupportedBodyValue('enum not registered: ' + path)
+        _encode_sized(_ENUM, path.encode(), out)
+        _encode_value(value.value, out)
+    elif isinstance(value, datetime):
+        _encode_datetime(value, out)
+    elif isinstance(value, date):
+        _encode_date(value, out)
+    elif isinstance(value, UUID):
+        _encode_uuid(value, out)
+    else:
+        raise UnsupportedBodyValue('cannot encode type: ' + str(type(value)))
+
+
+def _encode_none(_value: None, out: List[bytes]) -> None:
+    out.append(_NONE_BYTES)
+
+
+def _encode_bool(value: bool, out: List[bytes]) -> None:
+    out.append(_TRUE_BYTES if value else _FALSE_BYTES)
+
+
+def _encode_int(value: int, out: List[bytes]) -> None:
+    if _INT64_MIN <= value <= _INT64_MAX:
+        out.append(_INT64_STRUCT.pack(_INT64, value))
+    else:
+        raw = value.to_bytes((value.bit_length() + 8) // 8, 'little', signed=True)
+        _encode_sized(_BIGINT, raw, out)
+
+
+def _encode_float(value: float, out: List[bytes]) -> None:
+    out.append(_FLOAT_STRUCT.pack(_FLOAT, value))
+
+
+def _encode_str(value: str, out: List[bytes]) -> None:
+    _encode_sized(_STR, value.encode(), out)
+
+
+def _encode_bytes(value: bytes, out: List[bytes]) -> None:
+    _encode_sized(_BYTES, value, out)
+
+
+def _encode_list(value: List[Any], out: List[bytes]) -> None:
+    out.append(_HEAD_STRUCT.pack(_LIST, len(value)))
+    for item in value:
+        _encode_value(item, out)
+
+
+def _encode_tuple(value: Tuple[Any, ...], out: List[bytes]) -> None:
+    out.append(_HEAD_STRUCT.pack(_TUPLE, len(value)))
+    for item in value:
+        _encode_value(item, out)
+
+
+def _encode_dict(value: Dict[Any, Any], out: List[bytes]) -> None:
+    out.append(_HEAD_STRUCT.pack(_DICT, len(value)))
+    for key, item in value.items():
+        _encode_value(key, out)
+        _encode_value(item, out)
+
+
+def _encode_uuid(value: UUID, out: List[bytes]) -> None:
+    out.append(_UUID_BYTES)
+    out.append(value.bytes)
+
+
+def _encode_datetime(value: datetime, out: List[bytes]) -> None:
+    _encode_sized(_DATETIME, value.isoformat().encode(), out)
+
+
+def _encode_date(value: date, out: List[bytes]) -> None:
+    _encode_sized(_DATE, value.isoformat().encode(), out)
+
+
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    list: _encode_list,
+    tuple: _encode_tuple,
+    dict: _encode_dict,
+    UUID: _encode_uuid,
+    datetime: _encode_datetime,
+    date: _encode_date,
+}  # type: Dict[type, Callable[[Any, List[bytes]], None]]
+
+
+def _decode_value(payload: bytes, offset: int) -> Tuple[Any, int]:
+    try:
+        tag = payload[offset]
+    except IndexError:
+        raise KvetchBodyDecodeError('truncated tagged body')
+    offset += 1
+
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _INT64:
+        return _INT64_STRUCT.unpack_from(payload, offset - 1)[1], offset + 8
+    if tag == _FLOAT:
+        return _FLOAT_STRUCT.unpack_from(payload, offset - 1)[1], offset + 8
+    if tag == _UUID:
+        end = offset + 16
+        return UUID(bytes=payload[offset:end]), end
+
+    size = _LENGTH_STRUCT.unpack_from(payload, offset)[0]
+    offset += 4
+    if tag == _LIST or tag == _TUPLE:
+        items = []
+        for _ in range(size):
+            item, offset = _decode_value(payload, offset)
+            items.append(item)
+        return (items if tag == _LIST else tuple(items)), offset
+    if tag == _DICT:
+        out_dict = {}
+        for _ in range(size):
+            key, offset = _decode_value(payload, offset)
+            out_dict[key], offset = _decode_value(payload, offset)
+        return out_dict, offset
+
+    end = offset + size
+    if end > len(payload):
+        raise KvetchBodyDecodeError('truncated tagged body')
+    raw = payload[offset:end]
+    if tag == _STR:
+        return raw.decode(), end
+    if tag == _BYTES:
+        return bytes(raw), end
+    if tag == _BIGINT:
+        return int.from_bytes(raw, 'little', signed=True), end
+    # not fromisoformat, which needs python 3.7
+    if tag == _DATETIME:
+        # default_timezone=None keeps naive datetimes naive
+        return iso8601.parse_date(raw.decode(), default_timezone=None), end
+    if tag == _DATE:
+        return datetime.strptime(raw.decode(), '%Y-%m-%d').date(), end
+    if tag == _ENUM:
+        enum_value, end = _decode_value(payload, end)
+        return _enum_class(raw.decode())(enum_value), end
+    raise KvetchBodyDecodeError('unknown tag: ' + str(tag))
+
+
+def _skip_value(payload: bytes, offset: int) -> int:
+    tag = payload[offset]
+    offset += 1
+    if tag == _NONE or tag == _TRUE or tag == _FALSE:
+        return offset
+    if tag == _INT64 or tag == _FLOAT:
+        return offset + 8
+    if tag == _UUID:
+        return offset + 16
+
+    size = _LENGTH_STRUCT.unpack_from(payload, offset)[0]
+    offset += 4
+    if tag == _LIST or tag == _TUPLE:
+        for _ in range(size):
+            offset = _skip_value(payload, offset)
+        return offset
+    if tag == _DICT:
+        for _ in range(size * 2):
+            offset = _skip_value(payload, offset)
+        return offset
+    if tag == _ENUM:
+        return _skip_value(payload, offset + size)
+    if tag in (_STR, _BYTES, _BIGINT, _DATETIME, _DATE):
+        return offset + size
+    raise KvetchBodyDecodeError('unknown tag: ' + str(tag))
+
+
+# path => enum class. the only classes the tagged codec stores or resolves, so a body
+# written elsewhere can never make this process import or construct anything else
+_ENUM_CLASSES = {}  # type: Dict[str, type]
+
+
+def _enum_path(enum_cls: type) -> str:
+    return enum_cls.__module__ + ':' + enum_cls.__qualname__
+
+
+def register_body_enum(enum_cls: type) -> type:
+    """Let the tagged codec store members of enum_cls. Returns enum_cls, so it can be
+    used as a class decorator. GraphQLPythonEnumType registers the enums it wraps."""
+    if not (isinstance(enum_cls, type) and issubclass(enum_cls, Enum)):
+        raise GraphscaleError('not an enum: ' + repr(enum_cls))
+    _ENUM_CLASSES[_enum_path(enum_cls)] = enum_cls
+    return enum_cls
 
 
-def row_to_obj(row: Dict[str, Any]) -> Dict[str, Any]:
-    id_dict = {'obj_id': UUID(bytes=row['obj_id']), 'type_id': row['type_id']}
-    body_dict = body_to_data(row['body'])
-    return {**id_dict, **body_dict}
+def _enum_class(path: str) -> type:
+    enum_cls = _ENUM_CLASSES.get(path)
+    if enum_cls is None:
+        raise KvetchBodyDecodeError('enum not registered: ' + path)
+    return enum_cls
@@ -76,12 +76,25 @@ def create_kvetch_edge_table_sql() -> str:
 """
 
 
+def create_kvetch_edge_counts_table_sql() -> str:
+    # denormalized count of edges per (edge_id, from_id), maintained in the same
+    # transaction as every edge insert and delete
+    return """CREATE TABLE IF NOT EXISTS kvetch_edge_counts (
+    edge_id INT NOT NULL,
+    from_id BINARY(16) NOT NULL,
+    edge_count INT NOT NULL,
+    PRIMARY KEY(edge_id, from_id)
+) ENGINE=InnoDB;
+"""
+
+
 def create_kvetch_objects_table(shard: KvetchDbShard) -> None:
     execute_ddl(shard, create_kvetch_objects_table_sql())
 
 
 def create_kvetch_edges_table(shard: KvetchDbShard) -> None:
     execute_ddl(shard, create_kvetch_edge_table_sql())
+    execute_ddl(shard, create_kvetch_edge_counts_table_sql())
 
 
 def create_kvetch_index_table(shard: KvetchDbShard, shard_index: IndexDefinition) -> None:
@@ -107,5 +120,6 @@ def init_shard_db_tables(shard: KvetchDbShard, indexes: List[IndexDefinition]) -
 def drop_shard_db_tables(shard: KvetchDbShard, indexes: List[IndexDefinition]) -> None:
     execute_ddl(shard, 'DROP TABLE IF EXISTS kvetch_objects')
     execute_ddl(shard, 'DROP TABLE IF EXISTS kvetch_edges')
+    execute_ddl(shard, 'DROP TABLE IF EXISTS kvetch_edge_counts')
     for shard_index in indexes:
         execute_ddl(shard, 'DROP TABLE IF EXISTS %s' % shard_index.index_name)
@@ -1,18 +1,39 @@
-from collections import OrderedDict
+from abc import ABCMeta, abstractmethod
+import asyncio
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
+import functools
+import threading
+import time
 from uuid import UUID
-from typing import Iterator, Any, List, Dict
+from typing import Any, Callable, Deque, Dict, Iterator, List, NamedTuple, Tuple, TypeVar
 
 import pymysql
+from pymysql.constants import SERVER_STATUS
 
+from graphscale.check import invariant
+from graphscale.errors import GraphscaleError
 from graphscale.sql import ConnectionInfo, pymysql_conn_from_info
 
 from .data_storage import body_to_data, data_to_body, row_to_obj
-from .kvetch import KvetchShard, KvetchData, IndexDefinition, StoredIdEdgeDefinition, EdgeData, IndexEntry
+from .kvetch import (
+    KvetchShard, KvetchData, KvetchProjection, KvetchWriteBatch, IndexDefinition,
+    StoredIdEdgeDefinition, EdgeAfter, EdgeCursor, EdgeData, EdgeQuery, IndexEntry,
+    is_column_projection
+)
 
+T = TypeVar('T')
 
-class KvetchDbSingleConnectionPool:
+
+class KvetchDbPool(metaclass=ABCMeta):
+    @abstractmethod
+    def create_safe_conn(self) -> Iterator[pymysql.Connection]:
+        ...
+
+
+class KvetchDbSingleConnectionPool(KvetchDbPool):
     def __init__(self, conn_info: ConnectionInfo) -> None:
         self.conn_info = conn_info
 
@@ -23,8 +44,208 @@ class KvetchDbSingleConnectionPool:
         conn.close()  # type: ignore
 
 
+class KvetchDbPoolTimeout(GraphscaleError):
+    pass
+
+
+class KvetchDbPoolStats(NamedTuple):
+    checkouts: int  # total successful and failed checkout attempts
+    waits: int  # checkouts that had to wait for a connection to be returned
+    timeouts: int  # checkouts that gave up waiting
+    creations: int  # new connections opened
+    discards: int  # connections closed because they were idle, unhealthy or errored
+    size: int  # connections currently open (idle + checked out)
+    idle: int  # connections currently sitting in the pool
+
+
+class KvetchDbConnectionPool(KvetchDbPool):
+    """Bounded pool of reusable connections. Thread-safe so that it can back shards that
+    execute queries on worker threads.
+
+    min_size: connections are never pruned for idleness below this count
+    max_size: hard cap on open connections. Checkouts beyond it wait for a checkin
+    idle_timeout: seconds an idle connection is kept before being closed
+    checkout_timeout: seconds a checkout waits before raising KvetchDbPoolTimeout
+    health_check_interval: connections idle for longer than this are pinged on checkout
+    """
+
+    def __init__(
+        self,
+        conn_info: ConnectionInfo,
+        *,
+        min_size: int=0,
+        max_size: int=10,
+        idle_timeout: float=300.0,
+        checkout_timeout: float=10.0,
+        health_check_interval: float=30.0,
+        conn_factory: Callable[[ConnectionInfo], pymysql.Connection]=pymysql_conn_from_info,
+        clock: Callable[[], float]=time.monotonic
+    ) -> None:
+        invariant(max_size > 0, 'max_size must be positive')
+        invariant(0 <= min_size <= max_size, 'min_size must be between 0 and max_size')
+
+        self.conn_info = conn_info
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._conn_factory = conn_factory
+        self._clock = clock
+
+        self._cond = threading.Condition()
+        # (conn, time of checkin). oldest on the left, most recently used on the right
+        self._idle = deque()  # type: Deque[Tuple[pymysql.Connection, float]]
+        self._size = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._creations = 0
+        self._discards = 0
+
+        for _ in range(0, min_size):
+            self._size += 1
+            self._idle.append((self._create_conn(), self._clock()))
+
+    @contextmanager
+    def create_safe_conn(self) -> Iterator[pymysql.Connection]:
+        conn = self._checkout()
+        try:
+            yield conn
+        except BaseException:
+            # connection state is unknown (e.g. a half-read result set) so never reuse it
+            self._discard(conn)
+            raise
+        self._checkin(conn)
+
+    def stats(self) -> KvetchDbPoolStats:
+        with self._cond:
+            return KvetchDbPoolStats(
+                checkouts=self._checkouts,
+                waits=self._waits,
+                timeouts=self._timeouts,
+                creations=self._creations,
+                discards=self._discards,
+                size=self._size,
+                idle=len(self._idle),
+            )
+
+    def close(self) -> None:
+        """Close all idle connections. Connections that are checked out are unaffected"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._discards += len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+    def _create_conn(self) -> pymysql.Connection:
+        conn = self._conn_factory(self.conn_info)
+        with self._cond:
+            self._creations += 1
+        return conn
+
+    def _checkout(self) -> pymysql.Connection:
+        deadline = self._clock() + self.checkout_timeout
+        conn = None
+        idle_since = 0.0
+        to_close = []  # type: List[pymysql.Connection]
+        timed_out = False
+        with self._cond:
+            self._checkouts += 1
+            waited = False
+            while True:
+                to_close.extend(self._pop_expired_idle())
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve the slot now, connect outside the lock
+                    self._size += 1
+                    break
+                if not waited:
+                    waited = True
+                    self._waits += 1
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    timed_out = True
+                    break
+                self._cond.wait(remaining)
+
+        for expired in to_close:
+            _close_quietly(expired)
+
+        if timed_out:
+            raise KvetchDbPoolTimeout(
+                'Timed out after {0}s waiting for one of {1} connections'.format(
+                    self.checkout_timeout, self.max_size
+                )
+            )
+
+        if conn is not None and self._is_healthy(conn, idle_since):
+            return conn
+
+        if conn is not None:
+            _close_quietly(conn)
+            with self._cond:
+                self._discards += 1
+
+        try:
+            return self._create_conn()
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def _checkin(self, conn: pymysql.Connection) -> None:
+        with self._cond:
+            self._idle.append((conn, self._clock()))
+            self._cond.notify()
+
+    def _discard(self, conn: pymysql.Connection) -> None:
+        _close_quietly(conn)
+        with self._cond:
+            self._discards += 1
+        self._release_slot()
+
+    def _release_slot(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _pop_expired_idle(self) -> List[pymysql.Connection]:
+        # must hold self._cond
+        expired = []
+        cutoff = self._clock() - self.idle_timeout
+        while self._idle and self._size > self.min_size and self._idle[0][1] < cutoff:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self._discards += 1
+            expired.append(conn)
+        return expired
+
+    def _is_healthy(self, conn: pymysql.Connection, idle_since: float) -> bool:
+        if self._clock() - idle_since < self.health_check_interval:
+            return True
+        try:
+            conn.ping(reconnect=False)
+        except Exception:  # pylint: disable=W0703
+            return False
+        return True
+
+
+def _close_quietly(conn: pymysql.Connection) -> None:
+    try:
+        conn.close()  # type: ignore
+    except Exception:  # pylint: disable=W0703
+        pass
+
+
 class KvetchDbShard(KvetchShard):
-    def __init__(self, *, pool: KvetchDbSingleConnectionPool) -> None:
+    def __init__(self, *, pool: KvetchDbPool) -> None:
         self._pool = pool
 
     def create_safe_conn(
@@ -32,44 +253,51 @@ class KvetchDbShard(KvetchShard):
     ) -> Any:  # ContextManager:  # should be context manager typing module imports it conditionally
         return self._pool.create_safe_conn()
 
-    async def gen_object(self, obj_id: UUID) -> KvetchData:
+    def _run_with_conn(self, func: Callable[..., T], *args: Any) -> T:
         with self.create_safe_conn() as conn:
-            return _kv_shard_get_object(conn, obj_id)
+            return func(conn, *args)
+
+    async def _gen_with_conn(self, func: Callable[..., T], *args: Any) -> T:
+        """Check out a connection and call func(conn, *args). Runs inline on the event loop"""
+        return self._run_with_conn(func, *args)
+
+    async def gen_object(self, obj_id: UUID) -> KvetchData:
+        return await self._gen_with_conn(_kv_shard_get_object, obj_id)
 
     async def gen_objects(self, ids: List[UUID]) -> Dict[UUID, KvetchData]:
-        with self.create_safe_conn() as conn:
-            return _kv_shard_get_objects(conn, ids)
+        return await self._gen_with_conn(_kv_shard_get_objects, ids)
+
+    async def gen_objects_projected(self, ids: List[UUID],
+                                    projection: KvetchProjection) -> Dict[UUID, KvetchData]:
+        if is_column_projection(projection):
+            return await self._gen_with_conn(_kv_shard_get_objects, ids, False)
+        return await self.gen_objects(ids)
 
     async def gen_objects_of_type(self, type_id: int, after: UUID=None,
                                   first: int=None) -> Dict[UUID, KvetchData]:
-        with self.create_safe_conn() as conn:
-            return _kv_shard_get_objects_by_type(conn, type_id, after, first)
+        return await self._gen_with_conn(_kv_shard_get_objects_by_type, type_id, after, first)
 
     async def gen_insert_index_entry(
         self, index: IndexDefinition, index_value: Any, target_id: UUID
     ) -> None:
-        attr = index.indexed_attr
-        with self.create_safe_conn() as conn:
-            _kv_shard_insert_index_entry(
-                shard_conn=conn,
-                index_name=index.index_name,
-                index_column=attr,
-                index_value=index_value,
-                target_id=target_id,
-            )
+        await self._gen_with_conn(
+            _kv_shard_insert_index_entry,
+            index.index_name,
+            index.indexed_attr,
+            index_value,
+            target_id,
+        )
 
     async def gen_delete_index_entry(
         self, index: IndexDefinition, index_value: Any, target_id: UUID
     ) -> None:
-        attr = index.indexed_attr
-        with self.create_safe_conn() as conn:
-            _kv_shard_delete_index_entry(
-                shard_conn=conn,
-                index_name=index.index_name,
-                index_column=attr,
-                index_value=index_value,
-                target_id=target_id,
-            )
+        await self._gen_with_conn(
+            _kv_shard_delete_index_entry,
+            index.index_name,
+            index.indexed_attr,
+            index_value,
+            target_id,
+        )
 
     async def gen_insert_edge(
         self,
@@ -79,58 +307,133 @@ class KvetchDbShard(KvetchShard):
         data: KvetchData=None
     ):
         data = data or {}
-        with self.create_safe_conn() as conn:
-            _kv_shard_insert_edge(conn, edge_definition.edge_id, from_id, to_id, data)
+        await self._gen_with_conn(
+            _kv_shard_insert_edge, edge_definition.edge_id, from_id, to_id, data
+        )
+
+    async def gen_insert_edges(
+        self, edge_definition: StoredIdEdgeDefinition, edges: List[Tuple[UUID, UUID, KvetchData]]
+    ) -> None:
+        await self._gen_with_conn(_kv_shard_insert_edges, edge_definition.edge_id, edges)
+
+    async def gen_apply_writes(self, batch: KvetchWriteBatch) -> None:
+        await self._gen_with_conn(_kv_shard_apply_writes, batch)
+
+    async def gen_delete_edge(
+        self, edge_definition: StoredIdEdgeDefinition, from_id: UUID, to_id: UUID
+    ) -> None:
+        await self._gen_with_conn(_kv_shard_delete_edge, edge_definition.edge_id, from_id, to_id)
+
+    async def gen_edge_counts(self, edge_definition: StoredIdEdgeDefinition,
+                              from_ids: List[UUID]) -> List[int]:
+        if not from_ids:
+            return []
+        return await self._gen_with_conn(
+            _kv_shard_get_edge_counts, edge_definition.edge_id, from_ids
+        )
+
+    async def gen_rebuild_edge_counts(self) -> None:
+        """Recompute every counter from kvetch_edges, e.g. for edges written before the
+        counter table existed"""
+        await self._gen_with_conn(_kv_shard_rebuild_edge_counts)
+
+    async def gen_insert_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._gen_with_conn(
+            _kv_shard_insert_index_entries, index.index_name, index.indexed_attr, entries
+        )
+
+    async def gen_delete_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._gen_with_conn(
+            _kv_shard_delete_index_entries, index.index_name, index.indexed_attr, entries
+        )
 
     async def gen_insert_object(self, new_id: UUID, type_id: int, data: KvetchData) -> UUID:
-        with self.create_safe_conn() as conn:
-            return _kv_shard_insert_object(conn, new_id, type_id, data)
+        return await self._gen_with_conn(_kv_shard_insert_object, new_id, type_id, data)
 
     async def gen_insert_objects(self, new_ids: List[UUID], type_id: int,
                                  datas: List[KvetchData]) -> List[UUID]:
-        with self.create_safe_conn() as conn:
-            _kv_shard_insert_objects(conn, new_ids, type_id, datas)
+        await self._gen_with_conn(_kv_shard_insert_objects, new_ids, type_id, datas)
         return new_ids
 
     async def gen_update_object(self, obj_id: UUID, data: KvetchData) -> None:
-        old_object = await self.gen_object(obj_id)
-        for key, val in data.items():
-            old_object[key] = val
-        with self.create_safe_conn() as conn:
-            _kv_shard_replace_object(conn, obj_id, old_object)
+        await self._gen_with_conn(_kv_shard_update_object, obj_id, data)
 
     async def gen_delete_object(self, obj_id: UUID) -> None:
-        with self.create_safe_conn() as conn:
-            _kv_shard_delete_object(conn, obj_id)
+        await self._gen_with_conn(_kv_shard_delete_object, obj_id)
 
     async def gen_edges(
         self,
         edge_definition: StoredIdEdgeDefinition,
         from_id: UUID,
-        after: UUID=None,
+        after: EdgeAfter=None,
         first: int=None
     ) -> List[EdgeData]:
-        with self.create_safe_conn() as conn:
-            return _kv_shard_get_edges(conn, edge_definition.edge_id, from_id, after, first)
+        return await self._gen_with_conn(
+            _kv_shard_get_edges, edge_definition.edge_id, from_id, after, first
+        )
+
+    async def gen_edges_batch(
+        self, edge_definition: StoredIdEdgeDefinition, queries: List[EdgeQuery]
+    ) -> List[List[EdgeData]]:
+        if not queries:
+            return []
+        return await self._gen_with_conn(
+            _kv_shard_get_edges_batch, edge_definition.edge_id, queries
+        )
 
     async def gen_edge_ids(
         self,
         edge_definition: StoredIdEdgeDefinition,
         from_id: UUID,
-        after: UUID=None,
+        after: EdgeAfter=None,
         first: int=None
     ) -> List[UUID]:
         edges = await self.gen_edges(edge_definition, from_id, after, first)
         return [edge.to_id for edge in edges]
 
     async def gen_index_entries(self, index: IndexDefinition, value: Any) -> List[IndexEntry]:
-        with self.create_safe_conn() as conn:
-            return _kv_shard_get_index_entries(
-                shard_conn=conn,
-                index_name=index.index_name,
-                index_column=index.indexed_attr,
-                index_value=value
-            )
+        return await self._gen_with_conn(
+            _kv_shard_get_index_entries, index.index_name, index.indexed_attr, value
+        )
+
+    async def gen_index_entries_batch(self, index: IndexDefinition,
+                                      values: List[Any]) -> List[List[IndexEntry]]:
+        if not values:
+            return []
+        return await self._gen_with_conn(
+            _kv_shard_get_index_entries_batch, index.index_name, index.indexed_attr, values
+        )
+
+    async def gen_index_entries_with_objects(
+        self, index: IndexDefinition, value: Any
+    ) -> Tuple[List[IndexEntry], Dict[UUID, KvetchData]]:
+        return await self._gen_with_conn(
+            _kv_shard_get_index_entries_with_objects, index.index_name, index.indexed_attr, value
+        )
+
+
+class KvetchDbThreadedShard(KvetchDbShard):
+    """Runs every query on a worker thread so that pymysql never blocks the event loop.
+    Concurrent resolvers and the per-shard fan-out in Kvetch overlap their I/O.
+
+    The pool must be thread-safe (KvetchDbConnectionPool) and should allow at least as
+    many connections as the executor has workers.
+    """
+
+    def __init__(self, *, pool: KvetchDbPool, executor: Executor=None) -> None:
+        super().__init__(pool=pool)
+        max_workers = getattr(pool, 'max_size', None)
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _gen_with_conn(self, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self._run_with_conn, func, *args)
+        )
 
 
 def _kv_shard_get_objects_by_type(
@@ -164,10 +467,12 @@ def _kv_shard_get_object(shard_conn: pymysql.Connection, obj_id: UUID) -> Kvetch
     return obj_dict.get(obj_id)
 
 
-def _kv_shard_get_objects(shard_conn: pymysql.Connection,
-                          obj_ids: List[UUID]) -> Dict[UUID, KvetchData]:
+def _kv_shard_get_objects(
+    shard_conn: pymysql.Connection, obj_ids: List[UUID], with_body: bool=True
+) -> Dict[UUID, KvetchData]:
     values_sql = ', '.join(['%s' for x in range(0, len(obj_ids))])
-    sql = 'SELECT obj_id, type_id, body FROM kvetch_objects WHERE obj_id in (' + values_sql + ')'
+    columns = 'obj_id, type_id, body' if with_body else 'obj_id, type_id, NULL AS body'
+    sql = 'SELECT ' + columns + ' FROM kvetch_objects WHERE obj_id in (' + values_sql + ')'
 
     with shard_conn.cursor() as cursor:
         cursor.execute(sql, [obj_id.bytes for obj_id in obj_ids])
@@ -212,6 +517,46 @@ def _kv_shard_insert_objects(
     return new_ids
 
 
+def _kv_shard_apply_writes(shard_conn: pymysql.Connection, batch: KvetchWriteBatch) -> None:
+    # one connection and one commit for everything bound for this shard
+    with _transaction(shard_conn):
+        for type_id, objects in batch.objects.items():
+            _kv_shard_insert_objects(
+                shard_conn, [new_id for new_id, _ in objects], type_id,
+                [data for _, data in objects]
+            )
+        for edge_definition, edges in batch.edges.items():
+            _kv_shard_insert_edges(shard_conn, edge_definition.edge_id, edges)
+        # deletes first: under the index columns' case-insensitive collation, deleting
+        # 'Alice' would also remove a just-inserted 'alice'
+        for index, entries in batch.index_deletes.items():
+            _kv_shard_delete_index_entries(
+                shard_conn, index.index_name, index.indexed_attr, entries
+            )
+        for index, entries in batch.index_entries.items():
+            _kv_shard_insert_index_entries(
+                shard_conn, index.index_name, index.indexed_attr, entries
+            )
+
+
+def _kv_shard_update_object(
+    shard_conn: pymysql.Connection, obj_id: UUID, data: KvetchData
+) -> None:
+    # the row lock is held until commit, so concurrent updates to the same object merge
+    # one after the other instead of overwriting each other
+    with _transaction(shard_conn):
+        with shard_conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT body FROM kvetch_objects WHERE obj_id = %s FOR UPDATE', (obj_id.bytes, )
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return
+        merged = body_to_data(row['body'])
+        merged.update(data)
+        _kv_shard_replace_object(shard_conn, obj_id, merged)
+
+
 def _kv_shard_replace_object(
     shard_conn: pymysql.Connection, obj_id: UUID, data: KvetchData
 ) -> None:
@@ -249,6 +594,21 @@ def _kv_shard_insert_index_entry(
         cursor.execute(sql, tuple(_to_sql_value(v) for v in values))
 
 
+def _kv_shard_insert_index_entries(
+    shard_conn: pymysql.Connection, index_name: str, index_column: str,
+    entries: List[Tuple[Any, UUID]]
+) -> None:
+    sql = 'INSERT INTO %s (%s, target_id, created)' % (index_name, index_column)
+    sql += ' VALUES(%s, %s, %s)'
+    now = datetime.now()
+    values = [
+        (_to_sql_value(index_value), _to_sql_value(target_id), now)
+        for index_value, target_id in entries
+    ]
+    with shard_conn.cursor() as cursor:
+        cursor.executemany(sql, values)
+
+
 def _kv_shard_delete_index_entry(
     shard_conn: pymysql.Connection,
     index_name: str,
@@ -267,6 +627,47 @@ def _kv_shard_delete_index_entry(
         cursor.execute(sql, args)
 
 
+def _kv_shard_delete_index_entries(
+    shard_conn: pymysql.Connection, index_name: str, index_column: str,
+    entries: List[Tuple[Any, UUID]]
+) -> None:
+    sql = 'DELETE FROM {index_table} WHERE {index_column} = %s AND target_id = %s'.format(
+        index_table=index_name,
+        index_column=index_column,
+    )
+    values = [
+        (_to_sql_value(index_value), _to_sql_value(target_id))
+        for index_value, target_id in entries
+    ]
+    with shard_conn.cursor() as cursor:
+        cursor.executemany(sql, values)
+
+
+@contextmanager
+def _transaction(shard_conn: pymysql.Connection) -> Iterator[None]:
+    """Connections are in autocommit mode. Groups the statements run inside into one
+    transaction, rolled back if anything raises. Joins the enclosing transaction if there
+    is one, since BEGIN would implicitly commit it."""
+    if shard_conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+        yield
+        return
+    shard_conn.begin()
+    try:
+        yield
+    except BaseException:
+        shard_conn.rollback()
+        raise
+    shard_conn.commit()
+
+
+def _bump_edge_counts(cursor: Any, edge_id: int, deltas: Dict[UUID, int]) -> None:
+    sql = 'INSERT INTO kvetch_edge_counts (edge_id, from_id, edge_count) VALUES (%s, %s, %s) '
+    sql += 'ON DUPLICATE KEY UPDATE edge_count = edge_count + VALUES(edge_count)'
+    cursor.executemany(
+        sql, [(edge_id, from_id.bytes, delta) for from_id, delta in deltas.items() if delta]
+    )
+
+
 def _kv_shard_insert_edge(
     shard_conn: pymysql.Connection, edge_id: int, from_id: UUID, to_id: UUID, data: KvetchData
 ) -> None:
@@ -274,39 +675,123 @@ def _kv_shard_insert_edge(
     sql = 'INSERT into kvetch_edges (edge_id, from_id, to_id, body, created, updated) '
     sql += 'VALUES(%s, %s, %s, %s, %s, %s)'
     values = (edge_id, from_id.bytes, to_id.bytes, data_to_body(data), now, now)
-    with shard_conn.cursor() as cursor:
+    with _transaction(shard_conn), shard_conn.cursor() as cursor:
         cursor.execute(sql, values)
+        _bump_edge_counts(cursor, edge_id, {from_id: 1})
 
 
-def _kv_shard_get_edges(
-    shard_conn: pymysql.Connection, edge_id: int, from_id: UUID, after: UUID, first: int
-) -> List[EdgeData]:
-    sql = 'SELECT from_id, to_id, created, body '
+def _kv_shard_insert_edges(
+    shard_conn: pymysql.Connection, edge_id: int, edges: List[Tuple[UUID, UUID, KvetchData]]
+) -> None:
+    now = datetime.now()
+    sql = 'INSERT into kvetch_edges (edge_id, from_id, to_id, body, created, updated) '
+    sql += 'VALUES(%s, %s, %s, %s, %s, %s)'
+    values = [
+        (edge_id, from_id.bytes, to_id.bytes, data_to_body(data or {}), now, now)
+        for from_id, to_id, data in edges
+    ]
+    with _transaction(shard_conn), shard_conn.cursor() as cursor:
+        cursor.executemany(sql, values)
+        _bump_edge_counts(cursor, edge_id, Counter(from_id for from_id, _, _ in edges))
+
+
+def _kv_shard_delete_edge(
+    shard_conn: pymysql.Connection, edge_id: int, from_id: UUID, to_id: UUID
+) -> None:
+    sql = 'DELETE FROM kvetch_edges WHERE edge_id = %s AND from_id = %s AND to_id = %s'
+    with _transaction(shard_conn), shard_conn.cursor() as cursor:
+        deleted = cursor.execute(sql, (edge_id, from_id.bytes, to_id.bytes))
+        _bump_edge_counts(cursor, edge_id, {from_id: -deleted})
+
+
+def _kv_shard_get_edge_counts(
+    shard_conn: pymysql.Connection, edge_id: int, from_ids: List[UUID]
+) -> List[int]:
+    values_sql = ', '.join(['%s' for _ in from_ids])
+    sql = 'SELECT from_id, edge_count FROM kvetch_edge_counts '
+    sql += 'WHERE edge_id = %s AND from_id IN (' + values_sql + ')'
+    with shard_conn.cursor() as cursor:
+        cursor.execute(sql, [edge_id] + [from_id.bytes for from_id in from_ids])
+        rows = cursor.fetchall()
+
+    counts = {UUID(bytes=row['from_id']): row['edge_count'] for row in rows}
+    return [counts.get(from_id, 0) for from_id in from_ids]
+
+
+def _kv_shard_rebuild_edge_counts(shard_conn: pymysql.Connection) -> None:
+    with _transaction(shard_conn), shard_conn.cursor() as cursor:
+        cursor.execute('DELETE FROM kvetch_edge_counts')
+        cursor.execute(
+            'INSERT INTO kvetch_edge_counts (edge_id, from_id, edge_count) '
+            'SELECT edge_id, from_id, COUNT(*) FROM kvetch_edges GROUP BY edge_id, from_id'
+        )
+
+
+def _edges_select_sql(edge_id: int, from_id: UUID, after: EdgeAfter,
+                      first: int) -> Tuple[str, List[Any]]:
+    sql = 'SELECT row_id, from_id, to_id, created, body '
     sql += 'FROM kvetch_edges WHERE edge_id = %s AND from_id = %s'
-    args = [edge_id, from_id.bytes]
-    if after:
-        sql += """AND row_id >
+    args = [edge_id, from_id.bytes]  # type: List[Any]
+    if isinstance(after, EdgeCursor):
+        # pure range scan on the (edge_id, from_id, row_id) key
+        sql += ' AND row_id > %s'
+        args.append(after.seq)
+    elif after:
+        sql += """ AND row_id >
         (SELECT row_id from kvetch_edges WHERE edge_id = %s
         AND from_id = %s
         AND to_id = %s) """
         args.extend([edge_id, from_id.bytes, after.bytes])
     sql += ' ORDER BY row_id'
     if first:
-        sql += ' LIMIT %s' % first
+        sql += ' LIMIT %s' % int(first)
+    return sql, args
+
+
+def _edge_from_row(row: dict) -> EdgeData:
+    return EdgeData(
+        from_id=UUID(bytes=row['from_id']),
+        to_id=UUID(bytes=row['to_id']),
+        created=row['created'],
+        data=body_to_data(row['body']),
+        cursor=EdgeCursor(row['row_id'])
+    )
+
+
+def _kv_shard_get_edges(
+    shard_conn: pymysql.Connection, edge_id: int, from_id: UUID, after: EdgeAfter, first: int
+) -> List[EdgeData]:
+    sql, args = _edges_select_sql(edge_id, from_id, after, first)
 
     with shard_conn.cursor() as cursor:
         cursor.execute(sql, tuple(args))
         rows = cursor.fetchall()
 
-    def edge_from_row(row: dict) -> EdgeData:
-        return EdgeData(
-            from_id=UUID(bytes=row['from_id']),
-            to_id=UUID(bytes=row['to_id']),
-            created=row['created'],
-            data=body_to_data(row['body'])
-        )
+    return [_edge_from_row(row) for row in rows]
 
-    return [edge_from_row(row) for row in rows]
+
+def _kv_shard_get_edges_batch(
+    shard_conn: pymysql.Connection, edge_id: int, queries: List[EdgeQuery]
+) -> List[List[EdgeData]]:
+    # one parenthesized SELECT per query so that each keeps its own after/LIMIT,
+    # tagged with its position so rows can be routed back
+    selects = []
+    args = []  # type: List[Any]
+    for position, query in enumerate(queries):
+        sql, query_args = _edges_select_sql(edge_id, query.from_id, query.after, query.first)
+        selects.append('(SELECT %s AS query_index, edges.* FROM (' + sql + ') AS edges)')
+        args.append(position)
+        args.extend(query_args)
+    sql = ' UNION ALL '.join(selects) + ' ORDER BY query_index, row_id'
+
+    with shard_conn.cursor() as cursor:
+        cursor.execute(sql, tuple(args))
+        rows = cursor.fetchall()
+
+    results = [[] for _ in queries]  # type: List[List[EdgeData]]
+    for row in rows:
+        results[row['query_index']].append(_edge_from_row(row))
+    return results
 
 
 def _kv_shard_get_index_entries(
@@ -321,3 +806,52 @@ def _kv_shard_get_index_entries(
         rows = cursor.fetchall()
 
     return [IndexEntry(target_id=UUID(bytes=row['target_id'])) for row in rows]
+
+
+def _kv_shard_get_index_entries_with_objects(
+    shard_conn: pymysql.Connection, index_name: str, index_column: str, index_value: Any
+) -> Tuple[List[IndexEntry], Dict[UUID, KvetchData]]:
+    sql = (
+        'SELECT idx.target_id, obj.obj_id, obj.type_id, obj.body ' +
+        'FROM {index_table} idx LEFT JOIN kvetch_objects obj ON obj.obj_id = idx.target_id ' +
+        'WHERE idx.{index_column} = %s ORDER BY idx.target_id'
+    ).format(
+        index_table=index_name, index_column=index_column
+    )
+    with shard_conn.cursor() as cursor:
+        cursor.execute(sql, (_to_sql_value(index_value), ))
+        rows = cursor.fetchall()
+
+    entries = [IndexEntry(target_id=UUID(bytes=row['target_id'])) for row in rows]
+    objs = OrderedDict()  # type: Dict[UUID, KvetchData]
+    for row in rows:
+        if row['obj_id'] is not None:
+            objs[UUID(bytes=row['obj_id'])] = row_to_obj(row)
+    return entries, objs
+
+
+def _kv_shard_get_index_entries_batch(
+    shard_conn: pymysql.Connection, index_name: str, index_column: str, index_values: List[Any]
+) -> List[List[IndexEntry]]:
+    # join against a derived table of (position, value) so the index column's collation
+    # decides what matches, accents, case and trailing spaces included, and each row comes
+    # back with the position of the value it matched
+    values_sql = ' UNION ALL '.join(
+        ['SELECT %s AS position, %s AS value'] + ['SELECT %s, %s'] * (len(index_values) - 1)
+    )
+    sql = (
+        'SELECT requested.position, {index_table}.target_id FROM ({values_sql}) AS requested '
+        'JOIN {index_table} ON {index_table}.{index_column} = requested.value '
+        'ORDER BY {index_table}.target_id'
+    ).format(index_table=index_name, index_column=index_column, values_sql=values_sql)
+    args = []  # type: List[Any]
+    for position, value in enumerate(index_values):
+        args.extend((position, _to_sql_value(value)))
+    with shard_conn.cursor() as cursor:
+        cursor.execute(sql, args)
+        rows = cursor.fetchall()
+
+    results = [[] for _ in index_values]  # type: List[List[IndexEntry]]
+    for row in rows:
+        results[row['position']].append(IndexEntry(target_id=UUID(bytes=row['target_id'])))
+    return results
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import pickle
+import re
+from typing import Any, Awaitable, List, Optional, Tuple, TypeVar
+from uuid import UUID
+
+from .kvetch import IndexDefinition, KvetchData, KvetchWriteBatch, StoredIdEdgeDefinition
+from .memshard import KvetchMemShard
+from .wal import KvetchWalError, KvetchWriteAheadLog, WalDurability, read_wal_records
+
+T = TypeVar('T')
+
+# A directory holds snapshot.<n> files and wal.<n> logs. snapshot.<n> is the state
+# before wal.<n>, so recovery loads the newest snapshot and replays that log and every
+# later one in order. Each open starts a new log, so a torn record left by a crash is
+# always at the end of a log nobody appends to again.
+_FILE_NAME = re.compile(r'^(snapshot|wal)\.(\d+)$')
+
+
+def _sync_directory(directory: str) -> None:
+    # makes creates, renames and removes in directory durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _run_to_completion(gen: Awaitable[T]) -> T:
+    # memory shard calls never suspend, so replay can drive them without an event loop
+    try:
+        gen.send(None)  # type: ignore
+    except StopIteration as stop:
+        return stop.value
+    raise KvetchWalError('memory shard call suspended during replay')
+
+
+class KvetchDurableMemShard(KvetchMemShard):
+    """KvetchMemShard whose writes are logged to a write-ahead log in directory and
+    replayed when the shard is constructed again.
+
+    Each write is applied in memory, appended to the log as one record (a batch or a
+    gen_insert_objects call is one record) and then waits for the durability level. Once
+    the log reaches compact_after_bytes the shard is compacted: the log is closed, a new
+    one is started and the shard is snapshotted. Compaction snapshots synchronously, so
+    it blocks the event loop for as long as save_snapshot takes.
+
+    Replayed writes get new 'updated' and 'created' timestamps.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        durability: WalDurability=WalDurability.EVERY_WRITE,
+        sync_interval: float=0.005,
+        compact_after_bytes: int=64 * 1024 * 1024
+    ) -> None:
+        super().__init__()
+        self.directory = directory
+        self._durability = durability
+        self._sync_interval = sync_interval
+        self._compact_after_bytes = compact_after_bytes
+        self._depth = 0
+        self._compacting = None  # type: Optional[asyncio.Future]
+        self._wal = None  # type: Optional[KvetchWriteAheadLog]
+
+        os.makedirs(directory, exist_ok=True)
+        files = self._list_files()
+        snapshots = [generation for kind, generation in files if kind == 'snapshot']
+        first_log = max(snapshots, default=0)
+        if snapshots:
+            self._load_snapshot(self._path('snapshot', first_log))
+        for generation in sorted(gen for kind, gen in files if kind == 'wal'):
+            if generation >= first_log:
+                self._replay(self._path('wal', generation))
+
+        self._generation = max((generation for _kind, generation in files), default=0) + 1
+        self._wal = self._open_wal()
+
+    def _path(self, kind: str, generation: int) -> str:
+        return os.path.join(self.directory, '{}.{}'.format(kind, generation))
+
+    def _list_files(self) -> List[Tuple[str, int]]:
+        files = []
+        for name in os.listdir(self.directory):
+            match = _FILE_NAME.match(name)
+            if match:
+                files.append((match.group(1), int(match.group(2))))
+        return files
+
+    def _open_wal(self) -> KvetchWriteAheadLog:
+        wal = KvetchWriteAheadLog(
+            self._path('wal', self._generation), self._durability, self._sync_interval
+        )
+        # otherwise a power loss could lose the new log's directory entry along with
+        # every synced write in it
+        _sync_directory(self.directory)
+        return wal
+
+    def _replay(self, path: str) -> None:
+        for payload in read_wal_records(path):
+            method, args = pickle.loads(payload)
+            _run_to_completion(getattr(KvetchMemShard, method)(self, *args))
+
+    async def gen_compact(self) -> None:
+        """Snapshot the shard and drop the logs the snapshot covers"""
+        if self._compacting is None:
+            self._compacting = asyncio.ensure_future(self._gen_compact())
+        await asyncio.shield(self._compacting)
+
+    async def _gen_compact(self) -> None:
+        try:
+            await self._wal.gen_close()
+            # nothing below yields, so the snapshot holds exactly the closed logs
+            self._generation += 1
+            self._wal = self._open_wal()
+            self.save_snapshot(self._path('snapshot', self._generation))
+            # the snapshot has to be reachable after a power loss before the logs it
+            # replaces go
+            _sync_directory(self.directory)
+            for kind, generation in self._list_files():
+                if generation < self._generation:
+                    os.remove(self._path(kind, generation))
+        finally:
+            self._compacting = None
+
+    async def gen_close(self) -> None:
+        if self._compacting is not None:
+            await asyncio.shield(self._compacting)
+        await self._wal.gen_close()
+
+    async def _gen_logged(self, method: str, *args: Any) -> Any:
+        apply = getattr(super(), method)
+        if self._depth or self._wal is None:
+            # part of a logged call, or replay
+            return await apply(*args)
+
+        # encode first so a write that cannot be logged is not applied either
+        payload = pickle.dumps((method, args), pickle.HIGHEST_PROTOCOL)
+        self._depth += 1
+        try:
+            result = await apply(*args)
+        finally:
+            self._depth -= 1
+        wal = self._wal
+        position = wal.append(payload)
+        if wal.size >= self._compact_after_bytes and self._compacting is None:
+            self._compacting = asyncio.ensure_future(self._gen_compact())
+        await wal.gen_wait(position)
+        return result
+
+    async def gen_update_object(self, obj_id: UUID, data: KvetchData) -> None:
+        await self._gen_logged('gen_update_object', obj_id, data)
+
+    async def gen_delete_object(self, obj_id: UUID) -> UUID:
+        return await self._gen_logged('gen_delete_object', obj_id)
+
+    async def gen_insert_object(self, new_id: UUID, type_id: int, data: KvetchData) -> UUID:
+        return await self._gen_logged('gen_insert_object', new_id, type_id, data)
+
+    async def gen_insert_objects(self, new_ids: List[UUID], type_id: int,
+                                 datas: List[KvetchData]) -> List[UUID]:
+        return await self._gen_logged('gen_insert_objects', new_ids, type_id, datas)
+
+    async def gen_apply_writes(self, batch: KvetchWriteBatch) -> None:
+        await self._gen_logged('gen_apply_writes', batch)
+
+    async def gen_insert_edge(
+        self,
+        edge_definition: StoredIdEdgeDefinition,
+        from_id: UUID,
+        to_id: UUID,
+        data: KvetchData=None
+    ) -> None:
+        await self._gen_logged('gen_insert_edge', edge_definition, from_id, to_id, data)
+
+    async def gen_insert_edges(
+        self, edge_definition: StoredIdEdgeDefinition, edges: List[Tuple[UUID, UUID, KvetchData]]
+    ) -> None:
+        await self._gen_logged('gen_insert_edges', edge_definition, edges)
+
+    async def gen_delete_edge(
+        self, edge_definition: StoredIdEdgeDefinition, from_id: UUID, to_id: UUID
+    ) -> None:
+        await self._gen_logged('gen_delete_edge', edge_definition, from_id, to_id)
+
+    async def gen_insert_index_entry(
+        self, index: IndexDefinition, index_value: Any, target_id: UUID
+    ) -> None:
+        await self._gen_logged('gen_insert_index_entry', index, index_value, target_id)
+
+    async def gen_insert_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._gen_logged('gen_insert_index_entries', index, entries)
+
+    async def gen_delete_index_entry(
+        self, index: IndexDefinition, index_value: Any, target_id: UUID
+    ) -> None:
+        await self._gen_logged('gen_delete_index_entry', index, index_value, target_id)
+
+    async def gen_delete_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._gen_logged('gen_delete_index_entries', index, entries)
@@ -1,13 +1,31 @@
 from graphscale.sql import ConnectionInfo
 
+from .data_storage import BodyCodec, set_default_body_codec
 from .kvetch import Kvetch, Schema
-from .dbshard import KvetchDbShard, KvetchDbSingleConnectionPool, ConnectionInfo
+from .dbshard import (
+    KvetchDbShard, KvetchDbThreadedShard, KvetchDbPool, KvetchDbConnectionPool,
+    KvetchDbSingleConnectionPool, ConnectionInfo
+)
 from .dbschema import init_shard_db_tables, drop_shard_db_tables
+from .durableshard import KvetchDurableMemShard
 from .memshard import KvetchMemShard
+from .wal import WalDurability
 
 
-def init_from_conn(conn_info: ConnectionInfo, schema: Schema) -> Kvetch:
-    shards = [KvetchDbShard(pool=KvetchDbSingleConnectionPool(conn_info))]
+def init_from_conn(
+    conn_info: ConnectionInfo,
+    schema: Schema,
+    pool: KvetchDbPool=None,
+    threaded: bool=False,
+    body_codec: BodyCodec=None
+) -> Kvetch:
+    """body_codec, e.g. TAGGED_CODEC for bodies other languages can read, becomes the
+    process-wide codec for new bodies. See set_default_body_codec."""
+    if body_codec is not None:
+        set_default_body_codec(body_codec)
+    pool = pool or KvetchDbConnectionPool(conn_info)
+    shard_cls = KvetchDbThreadedShard if threaded else KvetchDbShard
+    shards = [shard_cls(pool=pool)]
     init_shard_db_tables(shards[0], schema.indexes)
     return Kvetch(shards=shards, schema=schema)
 
@@ -18,5 +36,16 @@ def nuke_conn(conn_info: ConnectionInfo, schema: Schema) -> None:
     init_shard_db_tables(shards[0], schema.indexes)
 
 
-def init_in_memory(schema: Schema) -> Kvetch:
-    return Kvetch(shards=[KvetchMemShard()], schema=schema)
+def init_in_memory(schema: Schema, snapshot_path: str=None) -> Kvetch:
+    """In-memory kvetch, starting from the snapshot at snapshot_path if one is passed.
+    See KvetchMemShard.save_snapshot."""
+    shard = KvetchMemShard.from_snapshot(snapshot_path) if snapshot_path else KvetchMemShard()
+    return Kvetch(shards=[shard], schema=schema)
+
+
+def init_durable_in_memory(
+    schema: Schema, directory: str, durability: WalDurability=WalDurability.EVERY_WRITE
+) -> Kvetch:
+    """In-memory kvetch that logs its writes to directory and recovers them from there.
+    See KvetchDurableMemShard."""
+    return Kvetch(shards=[KvetchDurableMemShard(directory, durability)], schema=schema)
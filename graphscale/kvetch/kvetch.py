@@ -1,14 +1,36 @@
 from abc import ABCMeta, abstractmethod
-from collections import OrderedDict
+import asyncio
+import base64
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 from enum import Enum, auto
-from typing import Any, Dict, Iterable, List, NamedTuple, Sequence, Optional
+import heapq
+from itertools import islice
+from typing import (
+    Any, AsyncIterator, Awaitable, Deque, Dict, FrozenSet, Iterable, List, NamedTuple, Sequence,
+    Optional, Tuple, Union
+)
 from uuid import UUID, uuid4
 
+from graphscale.check import invariant
 from graphscale.utils import async_list
 
+from .cache import KvetchObjectCache
+from .routing import ModuloShardRouter, ShardRouter
+
 KvetchData = Dict[str, Any]
 
+# Attribute names a caller is going to read from fetched objects. None means everything
+KvetchProjection = FrozenSet[str]
+
+# attributes stored in their own columns rather than in the object body
+COLUMN_ATTRS = frozenset(('obj_id', 'type_id'))  # type: KvetchProjection
+
+
+def is_column_projection(projection: Optional[KvetchProjection]) -> bool:
+    """True if every attribute in the projection can be read without fetching the body"""
+    return projection is not None and projection <= COLUMN_ATTRS
+
 
 class ObjectDefinition(NamedTuple):
     type_name: str
@@ -40,17 +62,86 @@ class Schema(NamedTuple):
     edges: List[StoredIdEdgeDefinition]
 
 
+class EdgeCursor(NamedTuple):
+    """Position of an edge within its adjacency list. Pass it as `after` to fetch the next
+    page with a range scan instead of first locating the edge by to_id. seq orders edges
+    within a (edge_id, from_id) list; for the db shard it is the row_id."""
+    seq: int
+
+    def encode(self) -> str:
+        """Opaque string form for handing to clients"""
+        return base64.urlsafe_b64encode(b'e' + str(self.seq).encode()).decode()
+
+    @staticmethod
+    def decode(cursor: str) -> 'EdgeCursor':
+        raw = base64.urlsafe_b64decode(cursor.encode())
+        if raw[:1] != b'e' or not raw[1:].isdigit():
+            raise ValueError('invalid edge cursor: ' + repr(cursor))
+        return EdgeCursor(int(raw[1:]))
+
+
+# edges can be paged after the to_id of the last edge seen or, faster, after its cursor
+EdgeAfter = Union[UUID, EdgeCursor]
+
+
 class EdgeData(NamedTuple):
     from_id: UUID
     to_id: UUID
     created: datetime
     data: KvetchData
+    cursor: EdgeCursor = None
 
 
 class IndexEntry(NamedTuple):
     target_id: UUID
 
 
+class EdgeQuery(NamedTuple):
+    from_id: UUID
+    after: EdgeAfter = None
+    first: int = None
+
+
+class TypeWritePlan(NamedTuple):
+    """Edges and indexes that writes to objects of one type must maintain"""
+    edges: Tuple[StoredIdEdgeDefinition, ...]
+    indexes: Tuple[IndexDefinition, ...]
+
+
+EMPTY_WRITE_PLAN = TypeWritePlan(edges=(), indexes=())
+
+
+class KvetchWriteBatch:
+    """Writes bound for a single shard, applied together by KvetchShard.gen_apply_writes
+    so that a shard can make them in one transaction"""
+
+    def __init__(self) -> None:
+        self.objects = defaultdict(list)  # type: Dict[int, List[Tuple[UUID, KvetchData]]]
+        self.edges = defaultdict(
+            list
+        )  # type: Dict[StoredIdEdgeDefinition, List[Tuple[UUID, UUID, KvetchData]]]
+        self.index_entries = defaultdict(
+            list
+        )  # type: Dict[IndexDefinition, List[Tuple[Any, UUID]]]
+        self.index_deletes = defaultdict(
+            list
+        )  # type: Dict[IndexDefinition, List[Tuple[Any, UUID]]]
+
+    def add_object(self, type_id: int, new_id: UUID, data: KvetchData) -> None:
+        self.objects[type_id].append((new_id, data))
+
+    def add_edge(
+        self, edge_definition: StoredIdEdgeDefinition, from_id: UUID, to_id: UUID, data: KvetchData
+    ) -> None:
+        self.edges[edge_definition].append((from_id, to_id, data))
+
+    def add_index_entry(self, index: IndexDefinition, index_value: Any, target_id: UUID) -> None:
+        self.index_entries[index].append((index_value, target_id))
+
+    def add_index_delete(self, index: IndexDefinition, index_value: Any, target_id: UUID) -> None:
+        self.index_deletes[index].append((index_value, target_id))
+
+
 class KvetchShard(metaclass=ABCMeta):
     @abstractmethod
     async def gen_object(self, _obj_id: UUID) -> KvetchData:
@@ -84,6 +175,50 @@ class KvetchShard(metaclass=ABCMeta):
     ) -> None:
         ...
 
+    async def gen_objects_projected(
+        self, obj_ids: List[UUID], projection: KvetchProjection
+    ) -> Dict[UUID, KvetchData]:
+        """Fetch objects when only the attributes in projection will be read. Objects may
+        be missing any other attribute. Override to skip fetching unneeded data"""
+        return await self.gen_objects(obj_ids)
+
+    async def gen_apply_writes(self, batch: KvetchWriteBatch) -> None:
+        """Apply every write in batch: objects, edges, index deletes, then index inserts.
+        Deletes go before inserts because the db shard's index columns compare
+        case-insensitively, so deleting 'Alice' after inserting 'alice' for the same target
+        would remove both. Override to make them atomic and/or to use fewer round trips"""
+        for type_id, objects in batch.objects.items():
+            await self.gen_insert_objects(
+                [new_id for new_id, _ in objects], type_id, [data for _, data in objects]
+            )
+        for edge_definition, edges in batch.edges.items():
+            await self.gen_insert_edges(edge_definition, edges)
+        for index, entries in batch.index_deletes.items():
+            await self.gen_delete_index_entries(index, entries)
+        for index, entries in batch.index_entries.items():
+            await self.gen_insert_index_entries(index, entries)
+
+    async def gen_insert_edges(
+        self, edge_definition: StoredIdEdgeDefinition, edges: List[Tuple[UUID, UUID, KvetchData]]
+    ) -> None:
+        """Insert many (from_id, to_id, data) edges. Override to batch"""
+        for from_id, to_id, data in edges:
+            await self.gen_insert_edge(edge_definition, from_id, to_id, data)
+
+    async def gen_insert_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        """Insert many (index_value, target_id) entries. Override to batch"""
+        for index_value, target_id in entries:
+            await self.gen_insert_index_entry(index, index_value, target_id)
+
+    async def gen_delete_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        """Delete many (index_value, target_id) entries. Override to batch"""
+        for index_value, target_id in entries:
+            await self.gen_delete_index_entry(index, index_value, target_id)
+
     @abstractmethod
     async def gen_delete_object(self, _obj_id: UUID) -> UUID:
         ...
@@ -109,15 +244,54 @@ class KvetchShard(metaclass=ABCMeta):
         self,
         _edge_definition: StoredIdEdgeDefinition,
         _from_id: UUID,
-        _after: UUID=None,
+        _after: EdgeAfter=None,
         _first: int=None
     ) -> List[EdgeData]:
         raise Exception('not implemented')
 
+    async def gen_delete_edge(
+        self, _edge_definition: StoredIdEdgeDefinition, _from_id: UUID, _to_id: UUID
+    ) -> None:
+        raise Exception('not implemented')
+
+    async def gen_edge_counts(self, edge_definition: StoredIdEdgeDefinition,
+                              from_ids: List[UUID]) -> List[int]:
+        """Number of edges from each of from_ids, in order. The default counts by fetching
+        every edge; shards should override this with a maintained counter."""
+        edge_lists = await self.gen_edges_batch(
+            edge_definition, [EdgeQuery(from_id=from_id) for from_id in from_ids]
+        )
+        return [len(edges) for edges in edge_lists]
+
+    async def gen_edges_batch(
+        self, edge_definition: StoredIdEdgeDefinition, queries: List[EdgeQuery]
+    ) -> List[List[EdgeData]]:
+        """One list of edges per query, in query order. Override to answer in one round trip"""
+        return await async_list(
+            [
+                self.gen_edges(edge_definition, query.from_id, query.after, query.first)
+                for query in queries
+            ]
+        )
+
     @abstractmethod
     async def gen_index_entries(self, _index: IndexDefinition, _value: Any) -> List[IndexEntry]:
         ...
 
+    async def gen_index_entries_batch(self, index: IndexDefinition,
+                                      values: List[Any]) -> List[List[IndexEntry]]:
+        """One list of entries per value, in value order. Override to answer in one round trip"""
+        return await async_list([self.gen_index_entries(index, value) for value in values])
+
+    async def gen_index_entries_with_objects(
+        self, index: IndexDefinition, value: Any
+    ) -> Tuple[List[IndexEntry], Dict[UUID, KvetchData]]:
+        """Index entries for value plus whichever of their target objects live in this shard.
+        Shards that can answer both in one round trip should override this."""
+        entries = await self.gen_index_entries(index, value)
+        objs = await self.gen_objects([entry.target_id for entry in entries]) if entries else {}
+        return entries, {obj_id: obj for obj_id, obj in objs.items() if obj}
+
 
 def define_string_index(
     *, index_name: str, indexed_type: str, indexed_attr: str
@@ -140,9 +314,21 @@ def define_int_index(*, index_name: str, indexed_type: str, indexed_attr: str) -
 
 
 class Kvetch:
-    def __init__(self, *, shards: Sequence[KvetchShard], schema: Schema) -> None:
+    def __init__(
+        self,
+        *,
+        shards: Sequence[KvetchShard],
+        schema: Schema,
+        router: ShardRouter=None,
+        cache: KvetchObjectCache=None
+    ) -> None:
 
         self._shards = shards
+        self._cache = cache
+        self._router = router or ModuloShardRouter(len(shards))
+        invariant(
+            self._router.shard_count == len(shards), 'router must route to exactly these shards'
+        )
         # shard => shard_id
         self._shard_lookup = dict(zip(self._shards, range(0, len(shards))))
         # index_name => index
@@ -151,6 +337,29 @@ class Kvetch:
         self._edge_dict = dict(zip([edge.edge_name for edge in schema.edges], schema.edges))
 
         self._object_dict = dict(zip([obj.type_name for obj in schema.objects], schema.objects))
+        # type_id => write plan. computed once so writes only visit their own definitions
+        self._write_plans = self._build_write_plans(schema)
+        # updates that touch none of these cannot change any index entry
+        self._indexed_attrs = frozenset(index.indexed_attr for index in schema.indexes)
+
+    def _build_write_plans(self, schema: Schema) -> Dict[int, TypeWritePlan]:
+        edges_per_type = defaultdict(list)  # type: Dict[int, List[StoredIdEdgeDefinition]]
+        for edge_definition in schema.edges:
+            edges_per_type[self.get_edge_stored_on_type_id(edge_definition)].append(edge_definition)
+        indexes_per_type = defaultdict(list)  # type: Dict[int, List[IndexDefinition]]
+        for index in schema.indexes:
+            indexes_per_type[self.get_indexed_type_id(index)].append(index)
+
+        return {
+            type_id: TypeWritePlan(
+                edges=tuple(edges_per_type[type_id]), indexes=tuple(indexes_per_type[type_id])
+            )
+            for type_id in set(edges_per_type) | set(indexes_per_type)
+        }
+
+    @property
+    def shards(self) -> Sequence[KvetchShard]:
+        return self._shards
 
     def get_index(self, index_name: str) -> IndexDefinition:
         return self._index_dict[index_name]
@@ -163,18 +372,58 @@ class Kvetch:
         return self._shards[shard_id]
 
     def get_shard_id_from_obj_id(self, obj_id: UUID) -> int:
-        # do something less stupid like consistent hashing
-        # excellent description here http://michaelnielsen.org/blog/consistent-hashing/
-        return obj_id.int % len(self._shards)
+        return self._router.get_shard_id_from_obj_id(obj_id)
 
     def get_shard_from_value(self, value: Any) -> KvetchShard:
-        shard_id = hash(value) % len(self._shards)
+        shard_id = self.get_shard_id_from_value(value)
         return self._shards[shard_id]
 
-    async def gen_update_object(self, obj_id: UUID, data: KvetchData) -> None:
+    def get_shard_id_from_value(self, value: Any) -> int:
+        return self._router.get_shard_id_from_value(value)
 
+    async def gen_update_object(self, obj_id: UUID, data: KvetchData) -> None:
+        """Update the attributes in data. If any indexed attribute changes value, its old
+        index entry is deleted and the new one inserted, with one gen_apply_writes call per
+        index shard, all shards concurrently. Attributes that keep their value cost nothing.
+
+        The old values are read before, and outside, the shard's update, so two concurrent
+        updates of the same indexed attribute on one object can both delete the same old
+        entry and leave the entry of the losing value behind. Serialize such updates if
+        index lookups must stay exact."""
         shard = self.get_shard_from_obj_id(obj_id)
+        if self._indexed_attrs.isdisjoint(data.keys()):
+            await shard.gen_update_object(obj_id, data)
+            if self._cache:
+                self._cache.invalidate(obj_id)
+            return
+
+        old_obj = await shard.gen_object(obj_id)
+        # diff against the object as it was before the update
+        batches = defaultdict(KvetchWriteBatch)  # type: Dict[int, KvetchWriteBatch]
+        plan = self.get_write_plan(old_obj['type_id']) if old_obj else EMPTY_WRITE_PLAN
+        for index in plan.indexes:
+            attr = index.indexed_attr
+            if attr not in data:
+                continue
+            old_value, new_value = old_obj.get(attr), data[attr]
+            if old_value == new_value:
+                continue
+            # falsy values are never indexed, matching iterate_applicable_indexes
+            if old_value:
+                batches[self.get_shard_id_from_value(old_value)].add_index_delete(
+                    index, old_value, obj_id
+                )
+            if new_value:
+                batches[self.get_shard_id_from_value(new_value)].add_index_entry(
+                    index, new_value, obj_id
+                )
+
         await shard.gen_update_object(obj_id, data)
+        if self._cache:
+            self._cache.invalidate(obj_id)
+        await async_list(
+            [self._shards[shard_id].gen_apply_writes(batch) for shard_id, batch in batches.items()]
+        )
 
     def get_indexed_type_id(self, index: IndexDefinition) -> int:
         return self._object_dict[index.indexed_type].type_id
@@ -182,12 +431,20 @@ class Kvetch:
     def get_edge_stored_on_type_id(self, edge_definition: StoredIdEdgeDefinition) -> int:
         return self._object_dict[edge_definition.stored_on_type].type_id
 
-    def iterate_applicable_indexes(self, type_id: int,
-                                   data: KvetchData) -> Iterable[IndexDefinition]:
-        for index in self._index_dict.values():
-            if self.get_indexed_type_id(index) != type_id:
+    def get_write_plan(self, type_id: int) -> TypeWritePlan:
+        return self._write_plans.get(type_id, EMPTY_WRITE_PLAN)
+
+    def iterate_applicable_edges(self, type_id: int,
+                                 data: KvetchData) -> Iterable[StoredIdEdgeDefinition]:
+        for edge_definition in self.get_write_plan(type_id).edges:
+            attr = edge_definition.stored_id_attr
+            if not (attr in data) or not data[attr]:
                 continue
+            yield edge_definition
 
+    def iterate_applicable_indexes(self, type_id: int,
+                                   data: KvetchData) -> Iterable[IndexDefinition]:
+        for index in self.get_write_plan(type_id).indexes:
             attr = index.indexed_attr
             if not (attr in data) or not data[attr]:
                 continue
@@ -201,57 +458,88 @@ class Kvetch:
         type_id = obj['type_id']
 
         await shard.gen_delete_object(obj_id)
+        if self._cache:
+            self._cache.invalidate(obj_id)
 
-        # do edges
+        for edge_definition in self.iterate_applicable_edges(type_id, obj):
+            from_id = obj[edge_definition.stored_id_attr]
+            from_id_shard = self.get_shard_from_obj_id(from_id)
+            await from_id_shard.gen_delete_edge(edge_definition, from_id, obj_id)
 
         for index in self.iterate_applicable_indexes(type_id, obj):
             indexed_value = obj[index.indexed_attr]
-            indexed_shard = self.get_shard_from_obj_id(obj_id)
+            indexed_shard = self.get_shard_from_value(indexed_value)
             await indexed_shard.gen_delete_index_entry(index, indexed_value, obj_id)
 
         return obj_id
 
     async def gen_insert_object(self, type_id: int, data: KvetchData) -> UUID:
-        new_id = uuid4()
-        shard = self.get_shard_from_obj_id(new_id)
-        await shard.gen_insert_object(new_id, type_id, data)
-
-        for edge_definition in self._edge_dict.values():
-            attr = edge_definition.stored_id_attr
-            if self.get_edge_stored_on_type_id(edge_definition) != type_id:
-                continue
-            if not (attr in data) or not data[attr]:
-                continue
-
-            from_id = data[attr]
-            from_id_shard = self.get_shard_from_obj_id(from_id)
-            await from_id_shard.gen_insert_edge(edge_definition, from_id, new_id, {})
-
-        for index in self.iterate_applicable_indexes(type_id, data):
-            indexed_value = data[index.indexed_attr]
-            index_shard = self.get_shard_from_value(indexed_value)
-            await index_shard.gen_insert_index_entry(index, indexed_value, new_id)
-
-        return new_id
+        return (await self.gen_insert_objects(type_id, [data]))[0]
 
     async def gen_insert_objects(self, type_id: int, datas: List[KvetchData]) -> List[UUID]:
-        if len(self._shards) > 1:
-            raise Exception('shards > 1 currently not supported')
-
-        shard = self._shards[0]
-
-        new_ids = []
-        for _ in range(0, len(datas)):
-            new_ids.append(uuid4())
-
-        await shard.gen_insert_objects(new_ids, type_id, datas)
+        """Insert objects together with their edges and index entries. All writes bound
+        for one shard are applied as one gen_apply_writes call (a single transaction for
+        the db shard) and the shards are written concurrently. Writes to different shards
+        are not atomic with respect to each other."""
+        new_ids = [uuid4() for _ in range(0, len(datas))]
+
+        batches = defaultdict(KvetchWriteBatch)  # type: Dict[int, KvetchWriteBatch]
+        for new_id, data in zip(new_ids, datas):
+            batches[self.get_shard_id_from_obj_id(new_id)].add_object(type_id, new_id, data)
+
+            for edge_definition in self.iterate_applicable_edges(type_id, data):
+                from_id = data[edge_definition.stored_id_attr]
+                batches[self.get_shard_id_from_obj_id(from_id)].add_edge(
+                    edge_definition, from_id, new_id, {}
+                )
+
+            for index in self.iterate_applicable_indexes(type_id, data):
+                indexed_value = data[index.indexed_attr]
+                batches[self.get_shard_id_from_value(indexed_value)].add_index_entry(
+                    index, indexed_value, new_id
+                )
+
+        await async_list(
+            [self._shards[shard_id].gen_apply_writes(batch) for shard_id, batch in batches.items()]
+        )
         return new_ids
 
     async def gen_object(self, obj_id: UUID) -> KvetchData:
+        if self._cache:
+            return (await self.gen_objects([obj_id]))[obj_id]
         shard = self.get_shard_from_obj_id(obj_id)
         return await shard.gen_object(obj_id)
 
-    async def gen_objects(self, obj_ids: List[UUID]) -> Dict[UUID, KvetchData]:
+    async def gen_objects(self, obj_ids: List[UUID],
+                          projection: KvetchProjection=None) -> Dict[UUID, KvetchData]:
+        """Objects in request order. If projection is passed, the caller promises to only
+        read those attributes and objects may be missing the others."""
+        if not is_column_projection(projection):
+            # only column attributes can be fetched on their own today, so any other
+            # projection is the same as fetching the whole object
+            projection = None
+
+        if not self._cache:
+            return await self._gen_objects_from_shards(obj_ids, projection)
+
+        cached = self._cache.get_many(obj_ids)
+        missing = [obj_id for obj_id in obj_ids if obj_id not in cached]
+        if missing and projection is not None:
+            # partial objects must never be cached
+            cached.update(await self._gen_objects_from_shards(missing, projection))
+        elif missing:
+            token = self._cache.begin_fill()
+            fetched = {}  # type: Dict[UUID, KvetchData]
+            try:
+                fetched = await self._gen_objects_from_shards(missing)
+            finally:
+                self._cache.end_fill(token, fetched)
+            cached.update(fetched)
+        return OrderedDict((obj_id, cached.get(obj_id)) for obj_id in obj_ids)
+
+    async def _gen_objects_from_shards(
+        self, obj_ids: List[UUID], projection: KvetchProjection=None
+    ) -> Dict[UUID, KvetchData]:
         # construct dictionary of shard_id to all ids in that shard
         shard_to_ids = {}  # type: Dict[int, List[UUID]]
         for obj_id in obj_ids:
@@ -264,43 +552,167 @@ class Kvetch:
         unawaited_gens = []
         for shard_id, ids_in_shard in shard_to_ids.items():
             shard = self._shards[shard_id]
-            unawaited_gens.append(shard.gen_objects(ids_in_shard))
+            if projection is None:
+                unawaited_gens.append(shard.gen_objects(ids_in_shard))
+            else:
+                unawaited_gens.append(shard.gen_objects_projected(ids_in_shard, projection))
 
         obj_dict_per_shard = await async_list(unawaited_gens)
 
-        # flatten results into single dict
-        results = OrderedDict()  # type: OrderedDict[UUID, KvetchData]
+        # flatten results into single dict, in the order requested
+        fetched = {}  # type: Dict[UUID, KvetchData]
         for obj_dict in obj_dict_per_shard:
-            for obj_id, obj in obj_dict.items():
-                results[obj_id] = obj
-        return results
+            fetched.update(obj_dict)
+        return OrderedDict((obj_id, fetched.get(obj_id)) for obj_id in obj_ids)
 
     async def gen_objects_of_type(self, type_id: int, after: UUID=None,
                                   first: int=None) -> Dict[UUID, KvetchData]:
-        if len(self._shards) > 1:
-            raise Exception('shards > 1 currently not supported')
-
-        shard = self._shards[0]
-        return await shard.gen_objects_of_type(type_id, after, first)
+        """Page through all objects of a type in obj_id order. after and first are pushed
+        down to every shard so a page reads at most first rows per shard."""
+        pages = await async_list(
+            [shard.gen_objects_of_type(type_id, after, first) for shard in self._shards]
+        )
+        if len(pages) == 1:
+            return pages[0]
+
+        merged = heapq.merge(*[page.items() for page in pages], key=lambda item: item[0])
+        return OrderedDict(islice(merged, first) if first else merged)
+
+    async def gen_iterate_objects_of_type(self, type_id: int, page_size: int=1000
+                                          ) -> AsyncIterator[Tuple[UUID, KvetchData]]:
+        """Stream (obj_id, data) for every object of a type in obj_id order without
+        materializing the whole type. Each shard is paged independently so every row is
+        read exactly once. Intended for administrative full-table scans."""
+        scans = [_ShardTypeScan(shard, type_id, page_size) for shard in self._shards]
+        await async_list([scan.gen_next_page() for scan in scans])
+
+        heap = [(scan.peek_id(), i) for i, scan in enumerate(scans) if scan.has_buffered()]
+        heapq.heapify(heap)
+        while heap:
+            _, scan_index = heapq.heappop(heap)
+            scan = scans[scan_index]
+            yield scan.pop()
+            if not scan.has_buffered() and not scan.exhausted:
+                await scan.gen_next_page()
+            if scan.has_buffered():
+                heapq.heappush(heap, (scan.peek_id(), scan_index))
 
     async def gen_edges(
         self,
         edge_definition: StoredIdEdgeDefinition,
         from_id: UUID,
-        after: UUID=None,
+        after: EdgeAfter=None,
         first: int=None
     ) -> List[EdgeData]:
         shard = self.get_shard_from_obj_id(from_id)
         return await shard.gen_edges(edge_definition, from_id, after, first)
 
-    async def gen_from_index(self, index: IndexDefinition,
-                             index_value: Any) -> Dict[UUID, KvetchData]:
-        obj_ids = []
-        for shard in self._shards:
-            index_entries = await shard.gen_index_entries(index, index_value)
-            obj_ids.extend([entry.target_id for entry in index_entries])
+    async def gen_delete_edge(
+        self, edge_definition: StoredIdEdgeDefinition, from_id: UUID, to_id: UUID
+    ) -> None:
+        shard = self.get_shard_from_obj_id(from_id)
+        await shard.gen_delete_edge(edge_definition, from_id, to_id)
+
+    async def gen_edge_count(self, edge_definition: StoredIdEdgeDefinition, from_id: UUID) -> int:
+        return (await self.gen_edge_counts(edge_definition, [from_id]))[0]
+
+    async def gen_edge_counts(self, edge_definition: StoredIdEdgeDefinition,
+                              from_ids: List[UUID]) -> List[int]:
+        """Edge counts for many from_ids with one call per shard, all shards concurrently.
+        Results are in from_ids order."""
+        positions_per_shard = defaultdict(list)  # type: Dict[int, List[int]]
+        for position, from_id in enumerate(from_ids):
+            positions_per_shard[self.get_shard_id_from_obj_id(from_id)].append(position)
+
+        shard_ids = list(positions_per_shard.keys())
+        counts_per_shard = await async_list(
+            [
+                self._shards[shard_id].gen_edge_counts(
+                    edge_definition,
+                    [from_ids[position] for position in positions_per_shard[shard_id]],
+                ) for shard_id in shard_ids
+            ]
+        )
+
+        results = [0] * len(from_ids)
+        for shard_id, counts in zip(shard_ids, counts_per_shard):
+            for position, count in zip(positions_per_shard[shard_id], counts):
+                results[position] = count
+        return results
 
-        return await self.gen_objects(obj_ids)
+    async def gen_edges_batch(
+        self, edge_definition: StoredIdEdgeDefinition, queries: List[EdgeQuery]
+    ) -> List[List[EdgeData]]:
+        """gen_edges for many queries at once with one call per shard, all shards
+        concurrently. Results are in query order."""
+        positions_per_shard = defaultdict(list)  # type: Dict[int, List[int]]
+        for position, query in enumerate(queries):
+            positions_per_shard[self.get_shard_id_from_obj_id(query.from_id)].append(position)
+
+        shard_ids = list(positions_per_shard.keys())
+        edge_lists_per_shard = await async_list(
+            [
+                self._shards[shard_id].gen_edges_batch(
+                    edge_definition,
+                    [queries[position] for position in positions_per_shard[shard_id]],
+                ) for shard_id in shard_ids
+            ]
+        )
+
+        results = [[] for _ in queries]  # type: List[List[EdgeData]]
+        for shard_id, edge_lists in zip(shard_ids, edge_lists_per_shard):
+            for position, edges in zip(positions_per_shard[shard_id], edge_lists):
+                results[position] = edges
+        return results
+
+    async def gen_from_index(
+        self,
+        index: IndexDefinition,
+        index_value: Any,
+        *,
+        shard_timeout: float=None,
+        allow_partial: bool=False
+    ) -> Dict[UUID, KvetchData]:
+        """Look up index_value on every shard concurrently and load the matching objects.
+        Objects stored on the same shard as their index entry come back with the lookup,
+        so only the remainder costs a second round trip.
+
+        shard_timeout: seconds to wait for each shard. A shard that times out raises
+        asyncio.TimeoutError unless allow_partial is set, in which case its entries are
+        left out of the result.
+        """
+        shard_results = await async_list(
+            [
+                self._gen_shard_index_lookup(
+                    shard, index, index_value, shard_timeout, allow_partial
+                ) for shard in self._shards
+            ]
+        )
+
+        obj_ids = []  # type: List[UUID]
+        found = {}  # type: Dict[UUID, KvetchData]
+        for entries, objs in shard_results:
+            obj_ids.extend([entry.target_id for entry in entries])
+            found.update(objs)
+
+        missing = [obj_id for obj_id in obj_ids if obj_id not in found]
+        if missing:
+            found.update(await self.gen_objects(missing))
+        return OrderedDict((obj_id, found.get(obj_id)) for obj_id in obj_ids)
+
+    @staticmethod
+    async def _gen_shard_index_lookup(
+        shard: KvetchShard, index: IndexDefinition, index_value: Any, timeout: Optional[float],
+        allow_partial: bool
+    ) -> Tuple[List[IndexEntry], Dict[UUID, KvetchData]]:
+        try:
+            return await asyncio.wait_for(
+                shard.gen_index_entries_with_objects(index, index_value), timeout
+            )
+        except asyncio.TimeoutError:
+            if not allow_partial:
+                raise
+            return [], {}
 
     async def gen_id_from_index(self, index_name: str, index_value: Any) -> Optional[UUID]:
         index = self.get_index(index_name)
@@ -310,7 +722,57 @@ class Kvetch:
 
         return obj_ids[0]
 
+    async def gen_ids_from_index_batch(self, index: IndexDefinition,
+                                       index_values: List[Any]) -> List[List[UUID]]:
+        """gen_ids_from_index for many values with one call per shard, all shards
+        concurrently. Results are in value order."""
+        positions_per_shard = defaultdict(list)  # type: Dict[int, List[int]]
+        for position, value in enumerate(index_values):
+            positions_per_shard[self.get_shard_id_from_value(value)].append(position)
+
+        shard_ids = list(positions_per_shard.keys())
+        entry_lists_per_shard = await async_list(
+            [
+                self._shards[shard_id].gen_index_entries_batch(
+                    index, [index_values[position] for position in positions_per_shard[shard_id]]
+                ) for shard_id in shard_ids
+            ]
+        )
+
+        results = [[] for _ in index_values]  # type: List[List[UUID]]
+        for shard_id, entry_lists in zip(shard_ids, entry_lists_per_shard):
+            for position, entries in zip(positions_per_shard[shard_id], entry_lists):
+                results[position] = [entry.target_id for entry in entries]
+        return results
+
     async def gen_ids_from_index(self, index: IndexDefinition, index_value: Any) -> List[UUID]:
         shard = self.get_shard_from_value(index_value)
         entries = await shard.gen_index_entries(index, index_value)
         return [entry.target_id for entry in entries]
+
+
+class _ShardTypeScan:
+    def __init__(self, shard: KvetchShard, type_id: int, page_size: int) -> None:
+        self.shard = shard
+        self.type_id = type_id
+        self.page_size = page_size
+        self.after = None  # type: UUID
+        self.exhausted = False
+        self.buffer = deque()  # type: Deque[Tuple[UUID, KvetchData]]
+
+    async def gen_next_page(self) -> None:
+        page = await self.shard.gen_objects_of_type(self.type_id, self.after, self.page_size)
+        self.buffer.extend(page.items())
+        if self.buffer:
+            self.after = self.buffer[-1][0]
+        if len(page) < self.page_size:
+            self.exhausted = True
+
+    def has_buffered(self) -> bool:
+        return bool(self.buffer)
+
+    def peek_id(self) -> UUID:
+        return self.buffer[0][0]
+
+    def pop(self) -> Tuple[UUID, KvetchData]:
+        return self.buffer.popleft()
@@ -1,89 +1,318 @@
+from bisect import bisect_left, bisect_right, insort
 from collections import OrderedDict, defaultdict
 from datetime import datetime
-from typing import Any, Dict, List
+from itertools import count, islice
+from types import MappingProxyType
+from typing import Any, Dict, Iterator, List, Optional, Set
 from uuid import UUID
 
 from graphscale.kvetch.kvetch import KvetchShard
 
-from .kvetch import EdgeData, IndexDefinition, KvetchData, StoredIdEdgeDefinition, IndexEntry
+from .data_storage import body_to_data, data_to_body
+from .kvetch import (
+    EdgeAfter, EdgeCursor, EdgeData, IndexDefinition, KvetchData, StoredIdEdgeDefinition,
+    IndexEntry
+)
+from .snapshot import BlobLocation, KvetchSnapshot, KvetchSnapshotWriter
+
+
+class _MemEdgeList:
+    """One adjacency list. Edges are appended with increasing seq, so seqs stays sorted
+    and a cursor can be found by bisection."""
+
+    __slots__ = ('entries', 'seqs', 'seq_by_to_id')
+
+    def __init__(self) -> None:
+        self.entries = []  # type: List[Dict]
+        self.seqs = []  # type: List[int]
+        self.seq_by_to_id = {}  # type: Dict[UUID, int]
+
+    def append(self, entry: Dict) -> None:
+        self.entries.append(entry)
+        self.seqs.append(entry['seq'])
+        self.seq_by_to_id[entry['to_id']] = entry['seq']
+
+    def remove(self, to_id: UUID) -> None:
+        seq = self.seq_by_to_id.pop(to_id, None)
+        if seq is None:
+            return
+        index = bisect_left(self.seqs, seq)
+        del self.seqs[index]
+        del self.entries[index]
+
+    def index_after(self, after: EdgeAfter) -> int:
+        if isinstance(after, EdgeCursor):
+            seq = after.seq
+        else:
+            seq = self.seq_by_to_id.get(after)
+            if seq is None:
+                return len(self.entries)
+        return bisect_right(self.seqs, seq)
+
+
+class _SortedIds:
+    """Ids of one type in sorted order, kept as a list of sorted chunks of at most
+    2 * load ids. Inserts and deletes only shift one chunk and a page is found by
+    bisecting the chunk maximums and then the chunk, so both stay cheap at millions
+    of ids."""
+
+    __slots__ = ('load', 'chunks', 'maxes')
+
+    def __init__(self, load: int=1000) -> None:
+        self.load = load
+        self.chunks = []  # type: List[List[UUID]]
+        self.maxes = []  # type: List[UUID]
+
+    def extend_sorted(self, obj_ids: List[UUID]) -> None:
+        """Append ids that are sorted and greater than every id already present"""
+        for start in range(0, len(obj_ids), self.load):
+            chunk = obj_ids[start:start + self.load]
+            self.chunks.append(chunk)
+            self.maxes.append(chunk[-1])
+
+    def add(self, obj_id: UUID) -> None:
+        if not self.chunks:
+            self.chunks.append([obj_id])
+            self.maxes.append(obj_id)
+            return
+
+        pos = bisect_left(self.maxes, obj_id)
+        if pos == len(self.maxes):
+            pos -= 1
+            self.chunks[pos].append(obj_id)
+            self.maxes[pos] = obj_id
+        else:
+            insort(self.chunks[pos], obj_id)
+
+        chunk = self.chunks[pos]
+        if len(chunk) > 2 * self.load:
+            self.chunks[pos:pos + 1] = [chunk[:self.load], chunk[self.load:]]
+            self.maxes[pos:pos + 1] = [chunk[self.load - 1], chunk[-1]]
+
+    def remove(self, obj_id: UUID) -> None:
+        pos = bisect_left(self.maxes, obj_id)
+        if pos == len(self.maxes):
+            return
+        chunk = self.chunks[pos]
+        index = bisect_left(chunk, obj_id)
+        if index == len(chunk) or chunk[index] != obj_id:
+            return
+        del chunk[index]
+        if not chunk:
+            del self.chunks[pos]
+            del self.maxes[pos]
+        elif index == len(chunk):
+            self.maxes[pos] = chunk[-1]
+
+    def iterate_after(self, after: UUID=None) -> Iterator[UUID]:
+        """Ids greater than after (all ids if after is None) in ascending order"""
+        if after is None:
+            pos, index = 0, 0
+        else:
+            pos = bisect_right(self.maxes, after)
+            if pos == len(self.maxes):
+                return
+            index = bisect_right(self.chunks[pos], after)
+        for chunk in islice(self.chunks, pos, None):
+            yield from islice(chunk, index, None)
+            index = 0
+
+
+def _frozen(obj: Optional[KvetchData]) -> Optional[KvetchData]:
+    return None if obj is None else MappingProxyType(obj)
 
 
 class KvetchMemShard(KvetchShard):
+    """Objects are returned as read-only views of the stored dicts, which are never
+    mutated once stored: updates store a new dict. A read costs no copy and holders of
+    an object never see later writes to it."""
+
     def __init__(self) -> None:
+        # never mutated once stored, see gen_update_object
         self._objects = {}  # type: Dict[UUID, KvetchData]
-        self._all_indexes = defaultdict(lambda: defaultdict(list)
-                                        )  # type: Dict[str, Dict[str, List[Dict]]]
-        self._all_edges = defaultdict(lambda: defaultdict(list)
-                                      )  # type: Dict[str, Dict[UUID, List[Dict]]]
+        # type_id => its object ids, sorted for paging
+        self._ids_by_type = defaultdict(_SortedIds)  # type: Dict[int, _SortedIds]
+        # index_name => index_value => target_id => entry. keyed by target so one entry
+        # is deleted without rebuilding the list; dicts keep insertion order
+        self._all_indexes = defaultdict(lambda: defaultdict(dict)
+                                        )  # type: Dict[str, Dict[Any, Dict[UUID, Dict]]]
+        self._all_edges = defaultdict(lambda: defaultdict(_MemEdgeList)
+                                      )  # type: Dict[str, Dict[UUID, _MemEdgeList]]
+        self._edge_seq = count(1)
 
-    async def gen_object(self, obj_id: UUID) -> KvetchData:
-        return self._objects.get(obj_id)
+        # contents of a restored snapshot that have not been decoded yet. an entry moves
+        # into the structures above the first time it is used
+        self._snapshot = None  # type: KvetchSnapshot
+        # keyed by obj_id.bytes, see KvetchSnapshot.object_locations
+        self._lazy_objects = {}  # type: Dict[bytes, BlobLocation]
+        # types whose ids are still only in the snapshot's object table
+        self._lazy_types = set()  # type: Set[int]
+        self._lazy_edges = defaultdict(dict)  # type: Dict[str, Dict[UUID, BlobLocation]]
+        self._lazy_indexes = defaultdict(dict)  # type: Dict[str, Dict[Any, BlobLocation]]
 
-    async def gen_objects(self, ids: List[UUID]) -> Dict[UUID, KvetchData]:
-        return {obj_id: self._objects.get(obj_id) for obj_id in ids}
+    @staticmethod
+    def from_snapshot(path: str) -> 'KvetchMemShard':
+        """Shard over a snapshot written by save_snapshot. Only the object locations and
+        the directory are read up front. Objects, adjacency lists and index values are
+        decoded from the memory-mapped file when first used, and the sorted ids of a type
+        are built the first time it is paged or written."""
+        shard = KvetchMemShard()
+        shard._load_snapshot(path)
+        return shard
 
-    async def gen_objects_of_type(self, type_id: int, after: UUID=None,
-                                  first: int=None) -> Dict[UUID, KvetchData]:
-        objs = {}
+    def _load_snapshot(self, path: str) -> None:
+        # only valid on an empty shard
+        snapshot = KvetchSnapshot(path)
+        self._snapshot = snapshot
+        self._lazy_objects = snapshot.object_locations()
+        self._lazy_types = set(snapshot.object_types.keys())
+
+        directory = snapshot.directory
+        for edge_name, lists in directory['edges'].items():
+            self._lazy_edges[edge_name] = {
+                UUID(bytes=from_id): location
+                for from_id, location in lists
+            }
+        for index_name, values in directory['indexes'].items():
+            self._lazy_indexes[index_name] = dict(values)
+        self._edge_seq = count(directory['next_edge_seq'])
+
+    def save_snapshot(self, path: str) -> None:
+        """Write every object, edge and index entry to path, replacing it atomically.
+        Entries still undecoded from a restored snapshot are copied without decoding."""
+        writer = KvetchSnapshotWriter(path)
         for obj_id, obj in self._objects.items():
-            if obj['type_id'] == type_id:
-                objs[obj_id] = obj
+            writer.add_object(obj_id, obj['type_id'], data_to_body(obj))
+        if self._lazy_objects:
+            for lazy_obj in self._snapshot.iterate_objects():
+                if lazy_obj.obj_id.bytes in self._lazy_objects:
+                    writer.add_object(
+                        lazy_obj.obj_id, lazy_obj.type_id, self._snapshot.read(*lazy_obj.location)
+                    )
 
-        tuple_list = sorted(objs.items(), key=lambda t: t[0])
+        edges = defaultdict(list)  # type: Dict[str, List]
+        for edge_name, edge_lists in self._all_edges.items():
+            for from_id, edge_list in edge_lists.items():
+                if edge_list.entries:
+                    blob = data_to_body({'entries': edge_list.entries})
+                    edges[edge_name].append((from_id.bytes, writer.write_blob(blob)))
+        for edge_name, locations in self._lazy_edges.items():
+            for from_id, location in locations.items():
+                blob = self._snapshot.read(*location)
+                edges[edge_name].append((from_id.bytes, writer.write_blob(blob)))
 
-        if after:
-            index = 0
-            for obj_id, _obj in tuple_list:
-                if after >= obj_id:
-                    index += 1
-            tuple_list = tuple_list[index:]
+        indexes = defaultdict(list)  # type: Dict[str, List]
+        for index_name, index_dict in self._all_indexes.items():
+            for index_value, entries in index_dict.items():
+                if entries:
+                    blob = data_to_body({'entries': list(entries.values())})
+                    indexes[index_name].append((index_value, writer.write_blob(blob)))
+        for index_name, locations in self._lazy_indexes.items():
+            for index_value, location in locations.items():
+                blob = self._snapshot.read(*location)
+                indexes[index_name].append((index_value, writer.write_blob(blob)))
+
+        # put the seq back, so a shard restored from this snapshot and this shard hand the
+        # same seqs to the edges inserted next. edges replayed from a log depend on that
+        next_edge_seq = next(self._edge_seq)
+        self._edge_seq = count(next_edge_seq)
+        writer.set_directory(
+            {
+                'edges': dict(edges),
+                'indexes': dict(indexes),
+                'next_edge_seq': next_edge_seq,
+            }
+        )
+        writer.close()
+
+    def _get_sorted_ids(self, type_id: int) -> _SortedIds:
+        if type_id in self._lazy_types:
+            self._lazy_types.remove(type_id)
+            self._ids_by_type[type_id].extend_sorted(self._snapshot.object_ids_of_type(type_id))
+        return self._ids_by_type[type_id]
+
+    def _get_object(self, obj_id: UUID) -> Optional[KvetchData]:
+        obj = self._objects.get(obj_id)
+        if obj is None and self._lazy_objects:
+            location = self._lazy_objects.pop(obj_id.bytes, None)
+            if location is not None:
+                obj = self._objects[obj_id] = body_to_data(self._snapshot.read(*location))
+        return obj
 
-        if first:
-            tuple_list = tuple_list[:first]
+    def _get_edge_list(self, edge_name: str, from_id: UUID) -> Optional[_MemEdgeList]:
+        edge_list = self._all_edges[edge_name].get(from_id)
+        if edge_list is None and self._lazy_edges:
+            location = self._lazy_edges[edge_name].pop(from_id, None)
+            if location is not None:
+                edge_list = self._all_edges[edge_name][from_id]
+                for entry in body_to_data(self._snapshot.read(*location))['entries']:
+                    edge_list.append(entry)
+        return edge_list
 
-        return OrderedDict(tuple_list)
+    def _get_index_entries(self, index_name: str, index_value: Any) -> Optional[Dict[UUID, Dict]]:
+        entries = self._all_indexes[index_name].get(index_value)
+        if entries is None and self._lazy_indexes:
+            location = self._lazy_indexes[index_name].pop(index_value, None)
+            if location is not None:
+                entries = self._all_indexes[index_name][index_value]
+                for entry in body_to_data(self._snapshot.read(*location))['entries']:
+                    entries[entry['target_id']] = entry
+        return entries
+
+    async def gen_object(self, obj_id: UUID) -> KvetchData:
+        return _frozen(self._get_object(obj_id))
+
+    async def gen_objects(self, ids: List[UUID]) -> Dict[UUID, KvetchData]:
+        return {obj_id: _frozen(self._get_object(obj_id)) for obj_id in ids}
+
+    async def gen_objects_of_type(self, type_id: int, after: UUID=None,
+                                  first: int=None) -> Dict[UUID, KvetchData]:
+        if type_id not in self._ids_by_type and type_id not in self._lazy_types:
+            return OrderedDict()
+        sorted_ids = self._get_sorted_ids(type_id)
+        page = islice(sorted_ids.iterate_after(after), first)
+        return OrderedDict((obj_id, _frozen(self._get_object(obj_id))) for obj_id in page)
 
     async def gen_insert_index_entry(
         self, index: IndexDefinition, index_value: Any, target_id: UUID
     ) -> None:
         index_name = index.index_name
-        index_dict = self._all_indexes[index_name]
+        self._get_index_entries(index_name, index_value)
         index_entry = {'target_id': target_id, 'updated': datetime.now()}
-        index_dict[index_value].append(index_entry)
+        self._all_indexes[index_name][index_value][target_id] = index_entry
 
     async def gen_delete_index_entry(
         self, index: IndexDefinition, index_value: Any, target_id: UUID
     ):
-        index_dict = self._all_indexes[index.index_name]
-        index_dict[index_value
-                   ] = list(filter(lambda e: e['target_id'] != target_id, index_dict[index_value]))
+        entries = self._get_index_entries(index.index_name, index_value)
+        if entries is not None:
+            entries.pop(target_id, None)
 
     async def gen_index_entries(self, index: IndexDefinition, value: Any) -> List[IndexEntry]:
-        index_name = index.index_name
-        index_dict = self._all_indexes[index_name]
-        entries_data = index_dict.get(value, [])
-        return [IndexEntry(target_id=data['target_id']) for data in entries_data]
+        entries_data = self._get_index_entries(index.index_name, value) or {}
+        return [IndexEntry(target_id=target_id) for target_id in entries_data]
 
     async def gen_update_object(self, obj_id: UUID, data: KvetchData) -> None:
 
-        if not obj_id in self._objects:
+        obj = self._get_object(obj_id)
+        if obj is None:
             return None
 
-        obj = self._objects[obj_id]
-
-        for key, val in data.items():
-            obj[key] = val
-
-        obj['updated'] = datetime.now()
-
-        self._objects[obj_id] = obj
+        # copy on write. the new dict shares every value with the old one, which stays
+        # intact for anyone still holding it
+        self._objects[obj_id] = {**obj, **data, 'updated': datetime.now()}
 
     async def gen_delete_object(self, obj_id: UUID) -> UUID:
-        if obj_id in self._objects:
+        obj = self._get_object(obj_id)
+        if obj is not None:
             del self._objects[obj_id]
+            self._get_sorted_ids(obj['type_id']).remove(obj_id)
         return obj_id
 
     async def gen_insert_object(self, new_id: UUID, type_id: int, data: KvetchData) -> UUID:
+        if new_id in self._objects or (self._lazy_objects and new_id.bytes in self._lazy_objects):
+            await self.gen_delete_object(new_id)
+        self._get_sorted_ids(type_id).add(new_id)
         self._objects[new_id] = {
             **{'obj_id': new_id, 'type_id': type_id, 'updated': datetime.now()},
             **data
@@ -114,47 +343,55 @@ class KvetchMemShard(KvetchShard):
             'data': data,
             'created': now,
             'updated': now,
+            'seq': next(self._edge_seq),
         }
+        self._get_edge_list(edge_name, from_id)
         self._all_edges[edge_name][from_id].append(edge_entry)
 
-    @staticmethod
-    def __get_after_index(edges: List[Dict], after: UUID) -> int:
-        for index, edge in enumerate(edges):
-            if after == edge['to_id']:
-                return index + 1
-        return len(edges)
-
     async def gen_edges(
         self,
         edge_definition: StoredIdEdgeDefinition,
         from_id: UUID,
-        after: UUID=None,
+        after: EdgeAfter=None,
         first: int=None
     ) -> List[EdgeData]:
 
-        edge_name = edge_definition.edge_name
-        edges = self._all_edges[edge_name].get(from_id)
-
-        if after:
-            index = KvetchMemShard.__get_after_index(edges, after)
-            edges = edges[index:]
-        if first:
-            edges = edges[0:first]
+        edge_list = self._get_edge_list(edge_definition.edge_name, from_id)
+        if edge_list is None:
+            return []
 
+        start = edge_list.index_after(after) if after else 0
+        end = start + first if first else len(edge_list.entries)
         return [
             EdgeData(
                 from_id=obj['from_id'],
                 to_id=obj['to_id'],
                 created=obj['created'],
-                data=obj['data']
-            ) for obj in edges
+                data=obj['data'],
+                cursor=EdgeCursor(obj['seq'])
+            ) for obj in edge_list.entries[start:end]
         ]
 
+    async def gen_delete_edge(
+        self, edge_definition: StoredIdEdgeDefinition, from_id: UUID, to_id: UUID
+    ) -> None:
+        edge_list = self._get_edge_list(edge_definition.edge_name, from_id)
+        if edge_list is not None:
+            edge_list.remove(to_id)
+
+    async def gen_edge_counts(self, edge_definition: StoredIdEdgeDefinition,
+                              from_ids: List[UUID]) -> List[int]:
+        counts = []
+        for from_id in from_ids:
+            edge_list = self._get_edge_list(edge_definition.edge_name, from_id)
+            counts.append(len(edge_list.entries) if edge_list is not None else 0)
+        return counts
+
     async def gen_edge_ids(
         self,
         edge_definition: StoredIdEdgeDefinition,
         from_id: UUID,
-        after: UUID=None,
+        after: EdgeAfter=None,
         first: int=None
     ) -> List[UUID]:
         edges = await self.gen_edges(edge_definition, from_id, after, first)
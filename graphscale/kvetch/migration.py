@@ -0,0 +1,72 @@
+from typing import Any, NamedTuple, Tuple
+from uuid import UUID
+
+from graphscale.utils import async_list
+
+from .kvetch import IndexDefinition, Kvetch, KvetchShard
+
+
+class IndexRebuildStats(NamedTuple):
+    scanned: int  # objects of the indexed type visited
+    inserted: int  # entries written to the shard that now owns the value
+    deleted: int  # misplaced entries removed from other shards
+
+
+async def gen_rebuild_index(
+    kvetch: Kvetch, index: IndexDefinition, page_size: int=1000
+) -> IndexRebuildStats:
+    """Move every entry of an index onto the shard its value routes to under the current
+    router. Use after changing how index values are routed (e.g. entries written while
+    routing used the per-process randomized builtin hash()). Since the old placement is
+    not reproducible every shard is checked for each value. Safe to re-run."""
+    type_id = kvetch.get_indexed_type_id(index)
+    scanned = inserted = deleted = 0
+
+    for shard in kvetch.shards:
+        after = None  # type: UUID
+        while True:
+            objs = await shard.gen_objects_of_type(type_id, after, page_size)
+            if not objs:
+                break
+            for obj_id, obj in objs.items():
+                after = obj_id
+                scanned += 1
+                value = obj.get(index.indexed_attr)
+                if not value:
+                    continue
+                obj_inserted, obj_deleted = await _gen_place_index_entry(
+                    kvetch, index, value, obj_id
+                )
+                inserted += obj_inserted
+                deleted += obj_deleted
+            if len(objs) < page_size:
+                break
+
+    return IndexRebuildStats(scanned=scanned, inserted=inserted, deleted=deleted)
+
+
+async def _gen_place_index_entry(
+    kvetch: Kvetch, index: IndexDefinition, value: Any, target_id: UUID
+) -> Tuple[int, int]:
+    owner = kvetch.get_shard_from_value(value)
+    results = await async_list(
+        [
+            _gen_fix_shard_entry(shard, shard is owner, index, value, target_id)
+            for shard in kvetch.shards
+        ]
+    )
+    return sum(inserted for inserted, _ in results), sum(deleted for _, deleted in results)
+
+
+async def _gen_fix_shard_entry(
+    shard: KvetchShard, is_owner: bool, index: IndexDefinition, value: Any, target_id: UUID
+) -> Tuple[int, int]:
+    entries = await shard.gen_index_entries(index, value)
+    present = any(entry.target_id == target_id for entry in entries)
+    if is_owner and not present:
+        await shard.gen_insert_index_entry(index, value, target_id)
+        return 1, 0
+    if not is_owner and present:
+        await shard.gen_delete_index_entry(index, value, target_id)
+        return 0, 1
+    return 0, 0
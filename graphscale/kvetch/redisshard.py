@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from uuid import UUID
+
+from .data_storage import body_to_data, data_to_body
+from .kvetch import (
+    EdgeAfter, EdgeData, EdgeQuery, IndexDefinition, IndexEntry, KvetchData, KvetchShard,
+    KvetchWriteBatch, StoredIdEdgeDefinition
+)
+
+
+# Fills the cache with bodies read from the backing shard, skipping every object whose
+# version changed since it was read, i.e. that was invalidated while the backing shard
+# was being read. Writing those would put back the pre-write body.
+# KEYS: (body key, version key) pairs. ARGV: ttl, then (expected version, body) pairs
+_FILL_SCRIPT = """
+for i = 1, #KEYS, 2 do
+    local version = redis.call('GET', KEYS[i + 1]) or ''
+    if version == ARGV[i + 1] then
+        redis.call('SET', KEYS[i], ARGV[i + 2], 'EX', ARGV[1])
+    end
+end
+return 0
+"""
+
+
+class KvetchRedisCachedShard(KvetchShard):
+    """Read-through, write-invalidate Redis tier in front of another shard (typically a
+    KvetchDbShard). Object reads are answered with one MGET and only the misses go to the
+    backing shard; updates and deletes go to the backing shard and then DEL the cached
+    copy. Edges and indexes are not cached.
+
+    Every object also has a version key that invalidation increments. A read that misses
+    reads the versions along with the bodies and only fills entries whose version is
+    unchanged once the backing shard has answered, so a write that lands during that read,
+    in this process or another, is never overwritten by the pre-write body.
+
+    redis_instance is a redis.StrictRedis created with decode_responses=False. Entries
+    and version keys expire after ttl seconds. A backing read that takes longer than ttl
+    could see a version key expire and be recreated with its old value, and fill a stale
+    body.
+    """
+
+    def __init__(
+        self,
+        *,
+        shard: KvetchShard,
+        redis_instance: Any,
+        ttl: int=3600,
+        key_prefix: str='kvetch:obj:'
+    ) -> None:
+        self._shard = shard
+        self._redis = redis_instance
+        self._ttl = ttl
+        self._key_prefix = key_prefix
+
+    @property
+    def backing_shard(self) -> KvetchShard:
+        return self._shard
+
+    def _key(self, obj_id: UUID) -> str:
+        return self._key_prefix + obj_id.hex
+
+    def _version_key(self, obj_id: UUID) -> str:
+        return self._key_prefix + obj_id.hex + ':version'
+
+    def _invalidate(self, obj_ids: List[UUID]) -> None:
+        pipeline = self._redis.pipeline(transaction=False)
+        for obj_id in obj_ids:
+            # bump the version first so a fill in flight can no longer match it
+            pipeline.incr(self._version_key(obj_id))
+            pipeline.expire(self._version_key(obj_id), self._ttl)
+            pipeline.delete(self._key(obj_id))
+        pipeline.execute()
+
+    async def gen_object(self, obj_id: UUID) -> KvetchData:
+        return (await self.gen_objects([obj_id]))[obj_id]
+
+    async def gen_objects(self, obj_ids: List[UUID]) -> Dict[UUID, KvetchData]:
+        if not obj_ids:
+            return OrderedDict()
+
+        # versions come back in the same MGET, so they are read before the backing shard
+        values = self._redis.mget(
+            [self._key(obj_id) for obj_id in obj_ids] +
+            [self._version_key(obj_id) for obj_id in obj_ids]
+        )
+        bodies, versions = values[:len(obj_ids)], values[len(obj_ids):]
+        found = {}  # type: Dict[UUID, KvetchData]
+        for obj_id, body in zip(obj_ids, bodies):
+            if body is not None:
+                found[obj_id] = body_to_data(body)
+
+        missing = [obj_id for obj_id in obj_ids if obj_id not in found]
+        if missing:
+            version_by_id = dict(zip(obj_ids, versions))
+            fetched = await self._shard.gen_objects(missing)
+            keys = []  # type: List[str]
+            args = [self._ttl]  # type: List[Any]
+            for obj_id, obj in fetched.items():
+                if obj is not None:
+                    keys.extend((self._key(obj_id), self._version_key(obj_id)))
+                    args.extend((version_by_id[obj_id] or b'', data_to_body(obj)))
+            if keys:
+                self._redis.eval(_FILL_SCRIPT, len(keys), *keys, *args)
+            found.update(fetched)
+
+        return OrderedDict((obj_id, found.get(obj_id)) for obj_id in obj_ids)
+
+    async def gen_update_object(self, obj_id: UUID, data: KvetchData) -> KvetchData:
+        result = await self._shard.gen_update_object(obj_id, data)
+        self._invalidate([obj_id])
+        return result
+
+    async def gen_delete_object(self, obj_id: UUID) -> UUID:
+        result = await self._shard.gen_delete_object(obj_id)
+        self._invalidate([obj_id])
+        return result
+
+    async def gen_insert_object(self, new_id: UUID, type_id: int, data: KvetchData) -> UUID:
+        return await self._shard.gen_insert_object(new_id, type_id, data)
+
+    async def gen_insert_objects(
+        self, new_ids: List[UUID], type_id: int, datas: List[KvetchData]
+    ) -> List[UUID]:
+        return await self._shard.gen_insert_objects(new_ids, type_id, datas)
+
+    async def gen_apply_writes(self, batch: KvetchWriteBatch) -> None:
+        await self._shard.gen_apply_writes(batch)
+
+    async def gen_objects_of_type(self, type_id: int, after: UUID=None,
+                                  first: int=None) -> Dict[UUID, KvetchData]:
+        return await self._shard.gen_objects_of_type(type_id, after, first)
+
+    async def gen_insert_edge(
+        self,
+        edge_definition: StoredIdEdgeDefinition,
+        from_id: UUID,
+        to_id: UUID,
+        data: KvetchData=None
+    ) -> None:
+        await self._shard.gen_insert_edge(edge_definition, from_id, to_id, data)
+
+    async def gen_insert_edges(
+        self, edge_definition: StoredIdEdgeDefinition, edges: List[Tuple[UUID, UUID, KvetchData]]
+    ) -> None:
+        await self._shard.gen_insert_edges(edge_definition, edges)
+
+    async def gen_edges(
+        self,
+        edge_definition: StoredIdEdgeDefinition,
+        from_id: UUID,
+        after: EdgeAfter=None,
+        first: int=None
+    ) -> List[EdgeData]:
+        return await self._shard.gen_edges(edge_definition, from_id, after, first)
+
+    async def gen_edges_batch(
+        self, edge_definition: StoredIdEdgeDefinition, queries: List[EdgeQuery]
+    ) -> List[List[EdgeData]]:
+        return await self._shard.gen_edges_batch(edge_definition, queries)
+
+    async def gen_delete_edge(
+        self, edge_definition: StoredIdEdgeDefinition, from_id: UUID, to_id: UUID
+    ) -> None:
+        await self._shard.gen_delete_edge(edge_definition, from_id, to_id)
+
+    async def gen_edge_counts(self, edge_definition: StoredIdEdgeDefinition,
+                              from_ids: List[UUID]) -> List[int]:
+        return await self._shard.gen_edge_counts(edge_definition, from_ids)
+
+    async def gen_insert_index_entry(
+        self, index: IndexDefinition, index_value: Any, target_id: UUID
+    ) -> None:
+        await self._shard.gen_insert_index_entry(index, index_value, target_id)
+
+    async def gen_insert_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._shard.gen_insert_index_entries(index, entries)
+
+    async def gen_delete_index_entry(
+        self, index: IndexDefinition, index_value: Any, target_id: UUID
+    ) -> None:
+        await self._shard.gen_delete_index_entry(index, index_value, target_id)
+
+    async def gen_delete_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._shard.gen_delete_index_entries(index, entries)
+
+    async def gen_index_entries(self, index: IndexDefinition, value: Any) -> List[IndexEntry]:
+        return await self._shard.gen_index_entries(index, value)
+
+    async def gen_index_entries_batch(self, index: IndexDefinition,
+                                      values: List[Any]) -> List[List[IndexEntry]]:
+        return await self._shard.gen_index_entries_batch(index, values)
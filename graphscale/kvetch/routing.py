@@ -0,0 +1,148 @@
+from abc import ABCMeta, abstractmethod
+from bisect import bisect
+import hashlib
+from typing import Any, Iterable, List, NamedTuple, Sequence
+from uuid import UUID
+
+from graphscale.check import invariant
+
+
+class ShardRouter(metaclass=ABCMeta):
+    """Decides which shard owns an object (and the edges stored from it) and which
+    shard owns an index value."""
+
+    @property
+    @abstractmethod
+    def shard_count(self) -> int:
+        ...
+
+    @abstractmethod
+    def get_shard_id_from_obj_id(self, obj_id: UUID) -> int:
+        ...
+
+    @abstractmethod
+    def get_shard_id_from_value(self, value: Any) -> int:
+        ...
+
+
+class ModuloShardRouter(ShardRouter):
+    """The original modulo placement scheme. Adding a shard remaps almost every key."""
+
+    def __init__(self, shard_count: int) -> None:
+        invariant(shard_count > 0, 'must have at least one shard')
+        self._shard_count = shard_count
+
+    @property
+    def shard_count(self) -> int:
+        return self._shard_count
+
+    def get_shard_id_from_obj_id(self, obj_id: UUID) -> int:
+        return obj_id.int % self._shard_count
+
+    def get_shard_id_from_value(self, value: Any) -> int:
+        return stable_hash(value) % self._shard_count
+
+
+class ConsistentHashShardRouter(ShardRouter):
+    """Consistent hash ring. Each shard owns vnodes_per_shard * weight points on the ring
+    and a key belongs to the shard owning the first point clockwise of the key's hash.
+    Adding shard N+1 only moves roughly 1/(N+1) of the keys, all of them onto the new shard.
+    See http://michaelnielsen.org/blog/consistent-hashing/
+    """
+
+    def __init__(
+        self, shard_count: int, *, weights: Sequence[float]=None, vnodes_per_shard: int=160
+    ) -> None:
+        invariant(shard_count > 0, 'must have at least one shard')
+        invariant(vnodes_per_shard > 0, 'must have at least one vnode per shard')
+        weights = weights or [1.0] * shard_count
+        invariant(len(weights) == shard_count, 'must have exactly one weight per shard')
+
+        self._shard_count = shard_count
+        ring = []
+        for shard_id, weight in enumerate(weights):
+            invariant(weight > 0, 'shard weights must be positive')
+            for vnode in range(0, max(1, round(vnodes_per_shard * weight))):
+                point = _hash_bytes('shard-{0}-vnode-{1}'.format(shard_id, vnode).encode())
+                ring.append((point, shard_id))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._owners = [shard_id for _, shard_id in ring]
+
+    @property
+    def shard_count(self) -> int:
+        return self._shard_count
+
+    def get_shard_id_from_obj_id(self, obj_id: UUID) -> int:
+        return self._owner_of(_hash_bytes(obj_id.bytes))
+
+    def get_shard_id_from_value(self, value: Any) -> int:
+        return self._owner_of(stable_hash(value))
+
+    def _owner_of(self, key_hash: int) -> int:
+        index = bisect(self._points, key_hash)
+        return self._owners[index % len(self._owners)]
+
+
+class ShardMove(NamedTuple):
+    key: Any
+    from_shard_id: int
+    to_shard_id: int
+
+
+class ShardMovePlan(NamedTuple):
+    # objects move together with the edges stored on them
+    objects: List[ShardMove]
+    index_values: List[ShardMove]
+
+
+def plan_shard_moves(
+    old_router: ShardRouter,
+    new_router: ShardRouter,
+    *,
+    obj_ids: Iterable[UUID]=(),
+    index_values: Iterable[Any]=()
+) -> ShardMovePlan:
+    """Report which keys land on a different shard when switching from old_router
+    to new_router (e.g. when growing from 8 to 9 shards)"""
+    object_moves = []
+    for obj_id in obj_ids:
+        old_shard_id = old_router.get_shard_id_from_obj_id(obj_id)
+        new_shard_id = new_router.get_shard_id_from_obj_id(obj_id)
+        if old_shard_id != new_shard_id:
+            object_moves.append(ShardMove(obj_id, old_shard_id, new_shard_id))
+
+    value_moves = []
+    for value in index_values:
+        old_shard_id = old_router.get_shard_id_from_value(value)
+        new_shard_id = new_router.get_shard_id_from_value(value)
+        if old_shard_id != new_shard_id:
+            value_moves.append(ShardMove(value, old_shard_id, new_shard_id))
+
+    return ShardMovePlan(objects=object_moves, index_values=value_moves)
+
+
+def stable_hash(value: Any) -> int:
+    """64-bit hash of an index value that is identical across processes and machines.
+    The builtin hash() is randomized per process for str (PYTHONHASHSEED) so it must never
+    be used for placement."""
+    return _hash_bytes(_value_to_bytes(value))
+
+
+def _hash_bytes(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def _value_to_bytes(value: Any) -> bytes:
+    # type-tagged so that e.g. 1 and '1' do not collide
+    if isinstance(value, str):
+        return b's' + value.encode()
+    if isinstance(value, bool):
+        return b'b' + str(int(value)).encode()
+    if isinstance(value, int):
+        return b'i' + str(value).encode()
+    if isinstance(value, UUID):
+        return b'u' + value.bytes
+    if isinstance(value, bytes):
+        return b'y' + value
+    raise Exception('type not supported yet: ' + str(type(value)))
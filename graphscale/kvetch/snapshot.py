@@ -0,0 +1,146 @@
+import mmap
+import os
+import struct
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Tuple
+from uuid import UUID
+
+from graphscale.errors import GraphscaleError
+
+from .data_storage import body_to_data, data_to_body
+
+# File layout:
+#   header: magic, then (object_table_offset, object_count, directory_offset,
+#           directory_length) as little-endian uint64s
+#   blobs: one kvetch body per object, adjacency list and index value, back to back
+#   object table: one fixed width record per object, sorted by (type_id, obj_id)
+#   directory: a kvetch body with the blob locations of edges and index values and the
+#              range of the object table holding each type
+#
+# Only the header and directory are decoded on open. Blobs are decoded from the mapping
+# when first used, and processes that open the same file share its pages.
+SNAPSHOT_MAGIC = b'KVSNAP01'
+_HEADER = struct.Struct('<8sQQQQ')
+# obj_id, type_id, blob offset, blob length
+_OBJECT_RECORD = struct.Struct('<16sqQI')
+
+# (offset, length) of a blob within the snapshot
+BlobLocation = Tuple[int, int]
+
+
+class KvetchSnapshotError(GraphscaleError):
+    pass
+
+
+class SnapshotObject(NamedTuple):
+    obj_id: UUID
+    type_id: int
+    location: BlobLocation
+
+
+class KvetchSnapshotWriter:
+    """Writes a snapshot to path. Nothing is visible at path until close() succeeds."""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'wb')  # type: BinaryIO
+        self._file.write(bytes(_HEADER.size))
+        self._offset = _HEADER.size
+        self._objects = []  # type: List[Tuple[bytes, int, int, int]]
+        self._directory = {}  # type: Dict[str, Any]
+
+    def write_blob(self, blob: bytes) -> BlobLocation:
+        self._file.write(blob)
+        location = (self._offset, len(blob))
+        self._offset += len(blob)
+        return location
+
+    def add_object(self, obj_id: UUID, type_id: int, blob: bytes) -> None:
+        offset, length = self.write_blob(blob)
+        self._objects.append((obj_id.bytes, type_id, offset, length))
+
+    def set_directory(self, directory: Dict[str, Any]) -> None:
+        self._directory = directory
+
+    def close(self) -> None:
+        try:
+            # uuid byte order is uuid order, so the table comes out sorted for paging
+            self._objects.sort(key=lambda record: (record[1], record[0]))
+            table_offset = self._offset
+            # type_id => (first record, record count)
+            type_ranges = {}  # type: Dict[int, Tuple[int, int]]
+            for position, record in enumerate(self._objects):
+                self._file.write(_OBJECT_RECORD.pack(*record))
+                first, count = type_ranges.get(record[1], (position, 0))
+                type_ranges[record[1]] = (first, count + 1)
+            directory_offset = table_offset + _OBJECT_RECORD.size * len(self._objects)
+            directory = data_to_body(dict(self._directory, object_types=type_ranges))
+            self._file.write(directory)
+
+            self._file.seek(0)
+            self._file.write(
+                _HEADER.pack(
+                    SNAPSHOT_MAGIC, table_offset, len(self._objects), directory_offset,
+                    len(directory)
+                )
+            )
+            self._file.flush()
+            # on disk before it is renamed into place, so the name never points at a file
+            # a power loss could truncate
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self._tmp_path, self._path)
+        except BaseException:
+            self._file.close()
+            os.remove(self._tmp_path)
+            raise
+
+
+class KvetchSnapshot:
+    """Read-only, memory-mapped view of a snapshot written by KvetchSnapshotWriter"""
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _HEADER.size:
+            raise KvetchSnapshotError('truncated snapshot: ' + path)
+        magic, table_offset, object_count, directory_offset, directory_length = \
+            _HEADER.unpack_from(self._mmap)
+        if magic != SNAPSHOT_MAGIC:
+            raise KvetchSnapshotError('not a kvetch snapshot: ' + path)
+        if directory_offset + directory_length > len(self._mmap):
+            raise KvetchSnapshotError('truncated snapshot: ' + path)
+
+        self._table_offset = table_offset
+        self.object_count = object_count
+        self.directory = body_to_data(self.read(directory_offset, directory_length))
+        # type_id => (first record, record count)
+        self.object_types = self.directory.pop('object_types')  # type: Dict[int, Tuple[int, int]]
+
+    def read(self, offset: int, length: int) -> bytes:
+        return self._mmap[offset:offset + length]
+
+    def object_locations(self) -> Dict[bytes, BlobLocation]:
+        """obj_id.bytes => blob location for every object. Keyed by bytes because
+        building a UUID per object would dominate the time to open a large snapshot."""
+        return {
+            id_bytes: (offset, length)
+            for id_bytes, _type_id, offset, length in self._iterate_records(0, self.object_count)
+        }
+
+    def object_ids_of_type(self, type_id: int) -> List[UUID]:
+        """Ids of every object of type_id, sorted"""
+        first, count = self.object_types.get(type_id, (0, 0))
+        return [UUID(bytes=record[0]) for record in self._iterate_records(first, count)]
+
+    def iterate_objects(self) -> Iterator[SnapshotObject]:
+        """Every object's location, sorted by (type_id, obj_id)"""
+        for id_bytes, type_id, offset, length in self._iterate_records(0, self.object_count):
+            yield SnapshotObject(UUID(bytes=id_bytes), type_id, (offset, length))
+
+    def _iterate_records(self, first: int, count: int) -> Iterator[Tuple[bytes, int, int, int]]:
+        start = self._table_offset + _OBJECT_RECORD.size * first
+        return _OBJECT_RECORD.iter_unpack(
+            memoryview(self._mmap)[start:start + _OBJECT_RECORD.size * count]
+        )
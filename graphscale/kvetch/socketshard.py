@@ -0,0 +1,337 @@
+import asyncio
+import copyreg
+import io
+import os
+import pickle
+import struct
+from types import MappingProxyType
+from typing import Any, Dict, List, Tuple
+from uuid import UUID
+
+from graphscale.errors import GraphscaleError
+
+from .kvetch import (
+    EdgeAfter, EdgeData, EdgeQuery, IndexDefinition, IndexEntry, KvetchData, KvetchProjection,
+    KvetchShard, KvetchWriteBatch, StoredIdEdgeDefinition
+)
+from .memshard import KvetchMemShard
+
+# Wire protocol: each frame is a 4 byte big-endian length followed by a pickle. A request
+# frame holds a list of (call_id, method, args) and its response frame a list of
+# (call_id, ok, result or error message) in the same order. Clients put every call made
+# in one event loop tick into one frame.
+#
+# Frames are pickles, so only processes that may run code as the server's user should be
+# able to connect. The socket is created with mode 0600.
+_FRAME_HEADER = struct.Struct('>I')
+
+# the KvetchShard interface. nothing else can be called remotely
+SHARD_METHODS = frozenset(
+    (
+        'gen_object',
+        'gen_objects',
+        'gen_objects_projected',
+        'gen_objects_of_type',
+        'gen_update_object',
+        'gen_delete_object',
+        'gen_insert_object',
+        'gen_insert_objects',
+        'gen_apply_writes',
+        'gen_insert_edge',
+        'gen_insert_edges',
+        'gen_edges',
+        'gen_edges_batch',
+        'gen_delete_edge',
+        'gen_edge_counts',
+        'gen_insert_index_entry',
+        'gen_insert_index_entries',
+        'gen_delete_index_entry',
+        'gen_delete_index_entries',
+        'gen_index_entries',
+        'gen_index_entries_batch',
+        'gen_index_entries_with_objects',
+    )
+)
+
+
+class KvetchShardServerError(GraphscaleError):
+    pass
+
+
+def _read_only(data: Dict) -> MappingProxyType:
+    return MappingProxyType(data)
+
+
+def _reduce_mapping_proxy(proxy: MappingProxyType) -> Tuple[Any, Tuple[Dict]]:
+    # the mem shard hands out read-only views. they arrive as read-only views too
+    return (_read_only, (dict(proxy), ))
+
+
+_DISPATCH_TABLE = copyreg.dispatch_table.copy()
+_DISPATCH_TABLE[MappingProxyType] = _reduce_mapping_proxy
+
+
+def _encode_frame(value: Any) -> bytes:
+    buf = io.BytesIO()
+    buf.write(bytes(_FRAME_HEADER.size))
+    pickler = pickle.Pickler(buf, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = _DISPATCH_TABLE
+    pickler.dump(value)
+    frame = buf.getbuffer()
+    _FRAME_HEADER.pack_into(frame, 0, len(frame) - _FRAME_HEADER.size)
+    return bytes(frame)
+
+
+async def _gen_read_frame(reader: asyncio.StreamReader) -> Any:
+    header = await reader.readexactly(_FRAME_HEADER.size)
+    (length, ) = _FRAME_HEADER.unpack(header)
+    return pickle.loads(await reader.readexactly(length))
+
+
+class KvetchShardServer:
+    """Serves one shard, typically a KvetchMemShard, over a Unix socket so that several
+    processes on a box can share it through KvetchSocketShard. Calls on a connection run
+    in the order they were made. Calls on different connections interleave only where the
+    served shard awaits, which a KvetchMemShard never does, so each call is atomic."""
+
+    def __init__(self, shard: KvetchShard, path: str) -> None:
+        self.shard = shard
+        self.path = path
+        self.frames = 0
+        self.calls = 0
+        self._server = None  # type: asyncio.AbstractServer
+
+    async def gen_start(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._gen_serve_conn, path=self.path)
+        finally:
+            os.umask(old_umask)
+
+    async def gen_close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _gen_serve_conn(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                calls = await _gen_read_frame(reader)
+                results = []  # type: List[Tuple[int, bool, Any]]
+                for call_id, method, args in calls:
+                    results.append(await self._gen_call(call_id, method, args))
+                self.frames += 1
+                self.calls += len(calls)
+                try:
+                    frame = _encode_frame(results)
+                except Exception as error:  # pylint: disable=W0703
+                    frame = _encode_frame(
+                        [
+                            (call_id, False, 'could not send result: %s' % error)
+                            for call_id, _, _ in results
+                        ]
+                    )
+                writer.write(frame)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _gen_call(self, call_id: int, method: str, args: Tuple) -> Tuple[int, bool, Any]:
+        if method not in SHARD_METHODS:
+            return (call_id, False, 'not a shard method: ' + repr(method))
+        try:
+            return (call_id, True, await getattr(self.shard, method)(*args))
+        except Exception as error:  # pylint: disable=W0703
+            return (call_id, False, '%s: %s' % (type(error).__name__, error))
+
+
+def run_shard_server(path: str, snapshot_path: str=None) -> None:
+    """Serve a KvetchMemShard, restored from snapshot_path if passed, at path. Never
+    returns."""
+    shard = KvetchMemShard.from_snapshot(snapshot_path) if snapshot_path else KvetchMemShard()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(KvetchShardServer(shard, path).gen_start())
+    loop.run_forever()
+
+
+class KvetchSocketShard(KvetchShard):
+    """Client for a shard served by KvetchShardServer. Every call made in the same event
+    loop tick, e.g. by dataloaders resolving one level of a query, goes to the server as
+    one frame and comes back as one frame. Connects on first use and reconnects after
+    the connection drops; calls in flight when it drops raise KvetchShardServerError."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._writer = None  # type: asyncio.StreamWriter
+        self._connecting = None  # type: asyncio.Future
+        self._next_call_id = 0
+        self._pending_calls = []  # type: List[Tuple[int, str, Tuple]]
+        self._waiting = {}  # type: Dict[int, asyncio.Future]
+
+    async def _gen_call(self, method: str, *args: Any) -> Any:
+        await self._gen_connect()
+        loop = asyncio.get_event_loop()
+        self._next_call_id += 1
+        call_id = self._next_call_id
+        future = loop.create_future()
+        self._waiting[call_id] = future
+        if not self._pending_calls:
+            loop.call_soon(self._flush)
+        self._pending_calls.append((call_id, method, args))
+        return await future
+
+    async def _gen_connect(self) -> None:
+        if self._writer is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._gen_open())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _gen_open(self) -> None:
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        self._writer = writer
+        asyncio.ensure_future(self._gen_read_responses(reader, writer))
+
+    def _flush(self) -> None:
+        calls, self._pending_calls = self._pending_calls, []
+        if self._writer is None:
+            self._fail([call_id for call_id, _, _ in calls], 'not connected')
+            return
+        self._writer.write(_encode_frame(calls))
+
+    async def _gen_read_responses(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                for call_id, ok, value in await _gen_read_frame(reader):
+                    future = self._waiting.pop(call_id, None)
+                    if future is None or future.done():
+                        continue
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(KvetchShardServerError(value))
+        except (asyncio.IncompleteReadError, ConnectionError) as error:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            self._fail(list(self._waiting.keys()), 'connection lost: %s' % error)
+
+    def _fail(self, call_ids: List[int], message: str) -> None:
+        for call_id in call_ids:
+            future = self._waiting.pop(call_id, None)
+            if future is not None and not future.done():
+                future.set_exception(KvetchShardServerError(message))
+
+    async def gen_object(self, obj_id: UUID) -> KvetchData:
+        return await self._gen_call('gen_object', obj_id)
+
+    async def gen_objects(self, obj_ids: List[UUID]) -> Dict[UUID, KvetchData]:
+        return await self._gen_call('gen_objects', obj_ids)
+
+    async def gen_objects_projected(
+        self, obj_ids: List[UUID], projection: KvetchProjection
+    ) -> Dict[UUID, KvetchData]:
+        return await self._gen_call('gen_objects_projected', obj_ids, projection)
+
+    async def gen_objects_of_type(self, type_id: int, after: UUID=None,
+                                  first: int=None) -> Dict[UUID, KvetchData]:
+        return await self._gen_call('gen_objects_of_type', type_id, after, first)
+
+    async def gen_update_object(self, obj_id: UUID, data: KvetchData) -> None:
+        await self._gen_call('gen_update_object', obj_id, data)
+
+    async def gen_delete_object(self, obj_id: UUID) -> UUID:
+        return await self._gen_call('gen_delete_object', obj_id)
+
+    async def gen_insert_object(self, new_id: UUID, type_id: int, data: KvetchData) -> UUID:
+        return await self._gen_call('gen_insert_object', new_id, type_id, data)
+
+    async def gen_insert_objects(
+        self, new_ids: List[UUID], type_id: int, datas: List[KvetchData]
+    ) -> List[UUID]:
+        return await self._gen_call('gen_insert_objects', new_ids, type_id, datas)
+
+    async def gen_apply_writes(self, batch: KvetchWriteBatch) -> None:
+        await self._gen_call('gen_apply_writes', batch)
+
+    async def gen_insert_edge(
+        self,
+        edge_definition: StoredIdEdgeDefinition,
+        from_id: UUID,
+        to_id: UUID,
+        data: KvetchData=None
+    ) -> None:
+        await self._gen_call('gen_insert_edge', edge_definition, from_id, to_id, data)
+
+    async def gen_insert_edges(
+        self, edge_definition: StoredIdEdgeDefinition, edges: List[Tuple[UUID, UUID, KvetchData]]
+    ) -> None:
+        await self._gen_call('gen_insert_edges', edge_definition, edges)
+
+    async def gen_edges(
+        self,
+        edge_definition: StoredIdEdgeDefinition,
+        from_id: UUID,
+        after: EdgeAfter=None,
+        first: int=None
+    ) -> List[EdgeData]:
+        return await self._gen_call('gen_edges', edge_definition, from_id, after, first)
+
+    async def gen_edges_batch(
+        self, edge_definition: StoredIdEdgeDefinition, queries: List[EdgeQuery]
+    ) -> List[List[EdgeData]]:
+        return await self._gen_call('gen_edges_batch', edge_definition, queries)
+
+    async def gen_delete_edge(
+        self, edge_definition: StoredIdEdgeDefinition, from_id: UUID, to_id: UUID
+    ) -> None:
+        await self._gen_call('gen_delete_edge', edge_definition, from_id, to_id)
+
+    async def gen_edge_counts(self, edge_definition: StoredIdEdgeDefinition,
+                              from_ids: List[UUID]) -> List[int]:
+        return await self._gen_call('gen_edge_counts', edge_definition, from_ids)
+
+    async def gen_insert_index_entry(
+        self, index: IndexDefinition, index_value: Any, target_id: UUID
+    ) -> None:
+        await self._gen_call('gen_insert_index_entry', index, index_value, target_id)
+
+    async def gen_insert_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._gen_call('gen_insert_index_entries', index, entries)
+
+    async def gen_delete_index_entry(
+        self, index: IndexDefinition, index_value: Any, target_id: UUID
+    ) -> None:
+        await self._gen_call('gen_delete_index_entry', index, index_value, target_id)
+
+    async def gen_delete_index_entries(
+        self, index: IndexDefinition, entries: List[Tuple[Any, UUID]]
+    ) -> None:
+        await self._gen_call('gen_delete_index_entries', index, entries)
+
+    async def gen_index_entries(self, index: IndexDefinition, value: Any) -> List[IndexEntry]:
+        return await self._gen_call('gen_index_entries', index, value)
+
+    async def gen_index_entries_batch(self, index: IndexDefinition,
+                                      values: List[Any]) -> List[List[IndexEntry]]:
+        return await self._gen_call('gen_index_entries_batch', index, values)
+
+    async def gen_index_entries_with_objects(
+        self, index: IndexDefinition, value: Any
+    ) -> Tuple[List[IndexEntry], Dict[UUID, KvetchData]]:
+        return await self._gen_call('gen_index_entries_with_objects', index, value)
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import struct
+import zlib
+from collections import deque
+from enum import Enum, auto
+from typing import Deque, Iterator, Optional, Tuple
+
+from graphscale.errors import GraphscaleError
+
+# Each record is a 4 byte big-endian payload length, the crc32 of the payload, then the
+# payload. A crash can leave a torn record at the end of the log, and reading stops at
+# the first record that is short or fails its checksum.
+_RECORD_HEADER = struct.Struct('>II')
+
+_sync = getattr(os, 'fdatasync', os.fsync)
+
+
+class KvetchWalError(GraphscaleError):
+    pass
+
+
+class WalDurability(Enum):
+    # a write is acknowledged once it is on disk. writes that arrive while a sync is in
+    # flight share the next one (group commit)
+    EVERY_WRITE = auto()
+    # writes are acknowledged at once and synced every sync_interval seconds, so a
+    # machine crash loses at most that much
+    INTERVAL = auto()
+    # writes go to the OS before they are acknowledged and are never synced. survives the
+    # process crashing, not the machine
+    OS_BUFFERED = auto()
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def read_wal_records(path: str) -> Iterator[bytes]:
+    """Payloads of every complete record in the log at path, in order"""
+    with open(path, 'rb') as wal_file:
+        data = wal_file.read()
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        length, crc = _RECORD_HEADER.unpack_from(data, offset)
+        start = offset + _RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield payload
+        offset = start + length
+
+
+class KvetchWriteAheadLog:
+    """Append-only log file. append() buffers a record and returns its position, and
+    gen_wait(position) returns once the durability level is met for it.
+
+    Syncs run in the default executor so the event loop keeps taking writes, and
+    everything appended by the time a sync starts goes into it.
+    """
+
+    def __init__(
+        self, path: str, durability: WalDurability=WalDurability.EVERY_WRITE,
+        sync_interval: float=0.005
+    ) -> None:
+        self.path = path
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.size = os.fstat(self._fd).st_size
+        self.syncs = 0
+        self._buffer = bytearray()
+        self._appended = 0
+        self._durable = 0
+        self._waiters = deque()  # type: Deque[Tuple[int, asyncio.Future]]
+        self._syncing = None  # type: Optional[asyncio.Future]
+        self._ticker = None  # type: Optional[asyncio.Future]
+        self._closed = False
+
+    def append(self, payload: bytes) -> int:
+        if self._closed:
+            raise KvetchWalError('append to closed log: ' + self.path)
+        frame = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        self.size += len(frame)
+        self._appended += 1
+        if self.durability is WalDurability.OS_BUFFERED:
+            _write_all(self._fd, frame)
+            self._durable = self._appended
+        else:
+            self._buffer += frame
+            if self.durability is WalDurability.INTERVAL and self._ticker is None:
+                self._ticker = asyncio.ensure_future(self._gen_tick())
+        return self._appended
+
+    async def gen_wait(self, position: int) -> None:
+        if self.durability is not WalDurability.EVERY_WRITE or self._durable >= position:
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((position, future))
+        self._start_sync()
+        await future
+
+    async def gen_close(self) -> None:
+        """Sync everything appended, including records appended while closing, and close
+        the file"""
+        if self._ticker is not None:
+            self._ticker.cancel()
+        while True:
+            syncing = self._start_sync()
+            if syncing is None:
+                break
+            await asyncio.shield(syncing)
+        self._closed = True
+        os.close(self._fd)
+
+    def _start_sync(self) -> Optional[asyncio.Future]:
+        if self._syncing is None and self._buffer:
+            self._syncing = asyncio.ensure_future(self._gen_sync())
+        return self._syncing
+
+    async def _gen_sync(self) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            while self._buffer:
+                data = bytes(self._buffer)
+                self._buffer.clear()
+                position = self._appended
+                await loop.run_in_executor(None, self._write_and_sync, data)
+                self.syncs += 1
+                self._durable = position
+                while self._waiters and self._waiters[0][0] <= position:
+                    _position, future = self._waiters.popleft()
+                    if not future.done():
+                        future.set_result(None)
+        except BaseException as error:
+            for _position, future in self._waiters:
+                if not future.done():
+                    future.set_exception(error)
+            self._waiters.clear()
+            raise
+        finally:
+            self._syncing = None
+
+    def _write_and_sync(self, data: bytes) -> None:
+        _write_all(self._fd, data)
+        _sync(self._fd)
+
+    async def _gen_tick(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            syncing = self._start_sync()
+            if syncing is not None:
+                await asyncio.shield(syncing)
@@ -1,13 +1,14 @@
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 import inspect
-from typing import Any, Dict, List, Sequence, Type, TypeVar, cast
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Sequence, Type, TypeVar, cast
 from uuid import UUID
 
 from aiodataloader import DataLoader
 
 from graphscale import check
-from graphscale.kvetch import EdgeData, Kvetch, Schema
-from graphscale.utils import reverse_dict
+from graphscale.kvetch import EdgeData, EdgeQuery, Kvetch, Schema
+from graphscale.kvetch.kvetch import COLUMN_ATTRS, is_column_projection
+from graphscale.utils import async_list, reverse_dict
 
 
 class PentConfig:
@@ -36,7 +37,24 @@ class PentContext:
     def __init__(self, *, kvetch: Kvetch, config: PentConfig) -> None:
         self.__kvetch = kvetch
         self.__config = config
+        self.reset_loaders()
+
+    def reset_loaders(self) -> None:
+        """Loaders cache for the lifetime of a request and are affined with the asyncio
+        event loop they were first used on, so they must be recreated for every request"""
         self.loader = PentLoader(self)
+        # for callers that only read column attributes (e.g. a list that only selects ids)
+        self.column_loader = PentLoader(self, projection=COLUMN_ATTRS)
+        self.edge_loader = PentEdgeLoader(self)
+        self.edge_count_loader = PentEdgeCountLoader(self)
+        self.index_loader = PentIndexLoader(self)
+
+    def loader_for(self, projection: FrozenSet[str]=None) -> 'PentLoader':
+        return self.column_loader if is_column_projection(projection) else self.loader
+
+    def clear_pent(self, obj_id: UUID) -> None:
+        self.loader.clear(obj_id)
+        self.column_loader.clear(obj_id)
 
     def cls_from_name(self, name: str) -> Type:
         return self.__config.get_class_from_name(name)
@@ -118,11 +136,17 @@ class Pent(PentContextfulObject):
         return cast(TPent, pent)
 
     @classmethod
-    async def gen_list(cls: Type[TPent], context: PentContext, obj_ids: List[UUID]) -> List[TPent]:
+    async def gen_list(
+        cls: Type[TPent], context: PentContext, obj_ids: List[UUID],
+        projection: FrozenSet[str]=None
+    ) -> List[TPent]:
         """Load a list of pents by ID. Ensures that each list member matches the calling class
         users = await TodoUser.gen_list(context, obj_ids)
+
+        projection is the set of data attributes the caller will read. Pents loaded with a
+        projection may be missing any other attribute.
         """
-        pents = await context.loader.load_many(obj_ids)
+        pents = await context.loader_for(projection).load_many(obj_ids)
 
         for pent in pents:
             check.isinst(pent, cls)
@@ -147,9 +171,7 @@ class Pent(PentContextfulObject):
     @classmethod
     async def gen_from_index(cls: Type[TPent], context: PentContext, index_name: str,
                              value: Any) -> TPent:
-        # TODO need to filter out objects that don't match the index because of
-        # temporary inconsistency issues
-        obj_id = await context.kvetch.gen_id_from_index(index_name, value)
+        obj_id = await context.index_loader.load(IndexLoaderKey(index_name, value))
         if not obj_id:
             return None
         return await cls.gen(context, obj_id)
@@ -160,15 +182,24 @@ class Pent(PentContextfulObject):
 
     async def gen_edges_to(self, edge_name: str, after: UUID=None,
                            first: int=None) -> List[EdgeData]:
-        edge_definition = self.kvetch.get_edge_definition_by_name(edge_name)
-        return await self.kvetch.gen_edges(edge_definition, self._obj_id, after=after, first=first)
+        key = EdgeLoaderKey(edge_name=edge_name, from_id=self._obj_id, after=after, first=first)
+        return cast(List[EdgeData], await self.context.edge_loader.load(key))
+
+    async def gen_edge_count(self, edge_name: str) -> int:
+        key = EdgeCountLoaderKey(edge_name=edge_name, from_id=self._obj_id)
+        return cast(int, await self.context.edge_count_loader.load(key))
 
     async def gen_associated_pents_dynamic(
-        self, cls_name: str, edge_name: str, after: UUID=None, first: int=None
+        self,
+        cls_name: str,
+        edge_name: str,
+        after: UUID=None,
+        first: int=None,
+        projection: FrozenSet[str]=None
     ) -> 'List[Pent]':
 
         cls = self.context.cls_from_name(cls_name)
-        return await self.gen_associated_pents(cls, edge_name, after, first)
+        return await self.gen_associated_pents(cls, edge_name, after, first, projection)
 
     async def gen_from_stored_id_dynamic(self, cls_name: str, key: str) -> 'Pent':
         obj_id = self._data.get(key)
@@ -180,17 +211,25 @@ class Pent(PentContextfulObject):
         return cast('Pent', pent)
 
     async def gen_associated_pents(
-        self, cls: Type[TPent], edge_name: str, after: UUID=None, first: int=None
+        self,
+        cls: Type[TPent],
+        edge_name: str,
+        after: UUID=None,
+        first: int=None,
+        projection: FrozenSet[str]=None
     ) -> List[TPent]:
         edges = await self.gen_edges_to(edge_name, after=after, first=first)
         to_ids = [edge.to_id for edge in edges]
-        return await cls.gen_list(self.context, to_ids)
+        return await cls.gen_list(self.context, to_ids, projection)
 
 
 async def create_pent(context: PentContext, cls: Type[TPent],
                       mutation_data: PentMutationData) -> TPent:
     type_id = context.config.get_type_id(cls)
     new_id = await context.kvetch.gen_insert_object(type_id, mutation_data._asdict())
+    context.edge_loader.clear_all()
+    context.edge_count_loader.clear_all()
+    context.index_loader.clear_all()
     return await cls.gen(context, new_id)
 
 
@@ -199,30 +238,35 @@ async def update_pent(
 ) -> TPent:
     data = mutation_data._asdict()
     await context.kvetch.gen_update_object(obj_id, data)
-    context.loader.clear(obj_id)
+    context.clear_pent(obj_id)
+    context.index_loader.clear_all()
     return await cls.gen(context, obj_id)
 
 
 async def delete_pent(context: PentContext, _cls: Type, obj_id: UUID) -> UUID:
     value = await context.kvetch.gen_delete_object(obj_id)
-    context.loader.clear(obj_id)
+    context.clear_pent(obj_id)
+    context.edge_loader.clear_all()
+    context.edge_count_loader.clear_all()
+    context.index_loader.clear_all()
     return value
 
 
 class PentLoader(DataLoader):
-    def __init__(self, context: PentContext) -> None:
+    def __init__(self, context: PentContext, projection: FrozenSet[str]=None) -> None:
         super().__init__(batch_load_fn=self._load_pents)
         self.context = context
+        self.projection = projection
 
     async def _load_pents(self, ids: List[UUID]) -> Sequence[Pent]:
         obj_dict = await self._actual_load_pent_dict(ids)
         return list(obj_dict.values())
 
     async def _actual_load_pent_dict(self, ids: List[UUID]) -> Dict[UUID, Pent]:
-        obj_dict = await self.context.kvetch.gen_objects(ids)
+        obj_dict = await self.context.kvetch.gen_objects(ids, self.projection)
         pent_dict = OrderedDict()  # type: OrderedDict[UUID, Pent]
         for obj_id, data in obj_dict.items():
-            if not data:
+            if data is None:
                 pent_dict[obj_id] = None
             else:
                 cls = self.context.config.get_type(data['type_id'])
@@ -230,6 +274,118 @@ class PentLoader(DataLoader):
         return pent_dict
 
 
+class EdgeLoaderKey(NamedTuple):
+    edge_name: str
+    from_id: UUID
+    after: UUID
+    first: int
+
+
+class PentEdgeLoader(DataLoader):
+    """Coalesces the edge fetches made by all resolvers in a tick, so resolving
+    an edge on every member of a list costs one query per shard rather than one per parent"""
+
+    def __init__(self, context: PentContext) -> None:
+        super().__init__(batch_load_fn=self._load_edges)
+        self.context = context
+
+    async def _load_edges(self, keys: List[EdgeLoaderKey]) -> List[List[EdgeData]]:
+        positions_per_edge = defaultdict(list)  # type: Dict[str, List[int]]
+        for position, key in enumerate(keys):
+            positions_per_edge[key.edge_name].append(position)
+
+        kvetch = self.context.kvetch
+        edge_names = list(positions_per_edge.keys())
+        edge_lists_per_edge = await async_list(
+            [
+                kvetch.gen_edges_batch(
+                    kvetch.get_edge_definition_by_name(edge_name),
+                    [
+                        EdgeQuery(keys[pos].from_id, keys[pos].after, keys[pos].first)
+                        for pos in positions_per_edge[edge_name]
+                    ],
+                ) for edge_name in edge_names
+            ]
+        )
+
+        results = [[] for _ in keys]  # type: List[List[EdgeData]]
+        for edge_name, edge_lists in zip(edge_names, edge_lists_per_edge):
+            for position, edges in zip(positions_per_edge[edge_name], edge_lists):
+                results[position] = edges
+        return results
+
+
+class EdgeCountLoaderKey(NamedTuple):
+    edge_name: str
+    from_id: UUID
+
+
+class PentEdgeCountLoader(DataLoader):
+    """Batches edge counts the same way PentEdgeLoader batches edges"""
+
+    def __init__(self, context: PentContext) -> None:
+        super().__init__(batch_load_fn=self._load_counts)
+        self.context = context
+
+    async def _load_counts(self, keys: List[EdgeCountLoaderKey]) -> List[int]:
+        positions_per_edge = defaultdict(list)  # type: Dict[str, List[int]]
+        for position, key in enumerate(keys):
+            positions_per_edge[key.edge_name].append(position)
+
+        kvetch = self.context.kvetch
+        edge_names = list(positions_per_edge.keys())
+        counts_per_edge = await async_list(
+            [
+                kvetch.gen_edge_counts(
+                    kvetch.get_edge_definition_by_name(edge_name),
+                    [keys[position].from_id for position in positions_per_edge[edge_name]],
+                ) for edge_name in edge_names
+            ]
+        )
+
+        results = [0 for _ in keys]
+        for edge_name, counts in zip(edge_names, counts_per_edge):
+            for position, count in zip(positions_per_edge[edge_name], counts):
+                results[position] = count
+        return results
+
+
+class IndexLoaderKey(NamedTuple):
+    index_name: str
+    value: Any
+
+
+class PentIndexLoader(DataLoader):
+    """Resolves (index_name, value) to the first matching obj_id. Lookups made in the same
+    tick are grouped into one query per index per shard"""
+
+    def __init__(self, context: PentContext) -> None:
+        super().__init__(batch_load_fn=self._load_ids)
+        self.context = context
+
+    async def _load_ids(self, keys: List[IndexLoaderKey]) -> List[UUID]:
+        positions_per_index = defaultdict(list)  # type: Dict[str, List[int]]
+        for position, key in enumerate(keys):
+            positions_per_index[key.index_name].append(position)
+
+        kvetch = self.context.kvetch
+        index_names = list(positions_per_index.keys())
+        id_lists_per_index = await async_list(
+            [
+                kvetch.gen_ids_from_index_batch(
+                    kvetch.get_index(index_name),
+                    [keys[position].value for position in positions_per_index[index_name]],
+                ) for index_name in index_names
+            ]
+        )
+
+        results = [None for _ in keys]  # type: List[UUID]
+        for index_name, id_lists in zip(index_names, id_lists_per_index):
+            for position, obj_ids in zip(positions_per_index[index_name], id_lists):
+                results[position] = obj_ids[0] if obj_ids else None
+        return results
+
+
 def is_direct_subclass(obj: Any, subcls: Type) -> bool:
     return inspect.isclass(obj) and issubclass(obj, subcls)
 
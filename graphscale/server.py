@@ -5,7 +5,7 @@ from graphql import GraphQLSchema
 from sanic import Sanic
 from sanic_graphql import GraphQLView
 
-from .pent import PentContextfulObject, PentLoader
+from .pent import PentContextfulObject
 
 
 def create_graphql_app(
@@ -30,7 +30,7 @@ def create_graphql_app(
     # you do need a new loader every request because it is affined with its
     # asyncio event loop
     def root_factory() -> Any:
-        root_object.context.loader = PentLoader(root_object.context)
+        root_object.context.reset_loaders()
         return root_object
 
     app.add_route(
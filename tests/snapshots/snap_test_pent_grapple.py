@@ -92,8 +92,8 @@ class TodoUserGenerated(Pent):
     def obj_id(self) -> UUID:
         return typed_or_none(self._data['obj_id'], UUID) # type: ignore
 
-    async def gen_todo_lists(self, first: int, after: UUID=None) -> List[Pent]: # mypy circ 'List[TodoList]'
-        return await self.gen_associated_pents_dynamic('TodoList', 'user_to_list_edge', after, first) # type: ignore
+    async def gen_todo_lists(self, first: int, after: UUID=None, projection: FrozenSet[str]=None) -> List[Pent]: # mypy circ 'List[TodoList]'
+        return await self.gen_associated_pents_dynamic('TodoList', 'user_to_list_edge', after, first, projection) # type: ignore
 
 class TodoListGenerated(Pent):
     @property
@@ -210,3 +210,17 @@ __CreateTodoUserPayloadDataMixin = namedtuple('__CreateTodoUserPayloadDataMixin'
 class CreateTodoUserPayload(PentMutationPayload, __CreateTodoUserPayloadDataMixin):
     pass
 '''
+
+snapshots['test_edge_count 1'] = '''class RootGenerated(PentContextfulObject):
+    pass
+
+class TodoUserGenerated(Pent):
+    @property
+    def obj_id(self) -> UUID:
+        return typed_or_none(self._data['obj_id'], UUID) # type: ignore
+
+    async def gen_todo_list_count(self) -> int:
+        return await self.gen_edge_count('user_to_list_edge')
+'''
+
+snapshots['test_edge_count 2'] = ''
@@ -1,6 +1,9 @@
 from typing import Any
 
+from graphql import parse
+
 from graphscale.grapple.graphql_printer import print_graphql_defs
+from graphscale.grapple.grapple_types import collect_projection
 from graphscale.grapple.parser import parse_grapple
 
 
@@ -77,3 +80,16 @@ enum HospitalStatus {
 }
 """
     )
+
+
+class FakeResolveInfo:
+    def __init__(self, query: str) -> None:
+        self.field_asts = parse(query).definitions[0].selection_set.selections
+
+
+def test_collect_projection() -> None:
+    info = FakeResolveInfo('{ todoLists { id __typename listName } }')
+    assert collect_projection(info) == frozenset(['obj_id', 'list_name'])
+
+    assert collect_projection(FakeResolveInfo('{ todoLists { id ... on X { y } } }')) is None
+    assert collect_projection(FakeResolveInfo('{ count }')) is None
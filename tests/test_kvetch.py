@@ -1,12 +1,13 @@
-from typing import Any, List, Sequence
-from uuid import UUID
+import asyncio
+from typing import Any, Dict, List, Sequence, Tuple
+from uuid import UUID, uuid4
 
 import pytest
 
 from graphscale.kvetch import (
     Kvetch, ObjectDefinition, Schema, StoredIdEdgeDefinition, define_int_index, IndexDefinition
 )
-from graphscale.kvetch.kvetch import KvetchShard
+from graphscale.kvetch.kvetch import EdgeCursor, KvetchData, KvetchShard, KvetchWriteBatch
 
 from graphscale.kvetch.memshard import KvetchMemShard
 
@@ -127,8 +128,10 @@ async def test_insert_gen_objects() -> None:
 
     obj_dict = await kvetch.gen_objects([id_one, id_two, id_three])
     assert len(obj_dict) == 3
-    for data in obj_dict.values():
-        del data['updated']
+    obj_dict = {
+        obj_id: {key: value for key, value in data.items() if key != 'updated'}
+        for obj_id, data in obj_dict.items()
+    }
 
     expected = {
         id_one: {
@@ -150,6 +153,22 @@ async def test_insert_gen_objects() -> None:
     assert obj_dict == expected
 
 
+@pytest.mark.asyncio
+async def test_mem_shard_objects_are_isolated_from_writes() -> None:
+    kvetch = single_shard_no_index()
+    obj_id = await kvetch.gen_insert_object(1000, {'num': 4, 'text': 'same'})
+    before = await kvetch.gen_object(obj_id)
+
+    with pytest.raises(TypeError):
+        before['num'] = 5  # type: ignore
+
+    await kvetch.gen_update_object(obj_id, {'num': 5})
+    after = await kvetch.gen_object(obj_id)
+    assert before['num'] == 4
+    assert after['num'] == 5
+    assert after['text'] is before['text']
+
+
 @pytest.mark.asyncio
 async def test_many_objects_many_shards() -> None:
     kvetch = many_shards_no_index()
@@ -194,6 +213,62 @@ async def test_single_edge_kvetch(single_edge_kvetch: Kvetch) -> None:
     assert set(ids_related_to_one) == set(id_results)
 
 
+@pytest.mark.asyncio
+async def test_edge_cursor_paging(single_edge_kvetch: Kvetch) -> None:
+    kvetch = single_edge_kvetch
+    id_one = await kvetch.gen_insert_object(2345, {'name': 'John', 'related_id': None})
+    related_ids = [
+        await kvetch.gen_insert_object(2345, {'related_id': id_one}) for _ in range(0, 10)
+    ]
+    related_edge = kvetch.get_edge_definition_by_name('related_edge')
+
+    paged_ids = []  # type: List[UUID]
+    after = None  # type: Any
+    while True:
+        page = await kvetch.gen_edges(related_edge, id_one, after=after, first=3)
+        if not page:
+            break
+        paged_ids.extend(edge.to_id for edge in page)
+        after = EdgeCursor.decode(page[-1].cursor.encode())
+    assert paged_ids == related_ids
+
+    # the to_id of the last edge seen still works as after
+    after_id_page = await kvetch.gen_edges(related_edge, id_one, after=related_ids[3], first=2)
+    assert [edge.to_id for edge in after_id_page] == related_ids[4:6]
+    assert await kvetch.gen_edges(related_edge, id_one, after=uuid4()) == []
+
+
+@pytest.mark.asyncio
+async def test_edge_counts(single_edge_kvetch: Kvetch) -> None:
+    kvetch = single_edge_kvetch
+    parent_ids = [await kvetch.gen_insert_object(2345, {'related_id': None}) for _ in range(0, 3)]
+    child_ids = []
+    for num_children, parent_id in zip([2, 0, 5], parent_ids):
+        child_ids.append(
+            [
+                await kvetch.gen_insert_object(2345, {'related_id': parent_id})
+                for _ in range(0, num_children)
+            ]
+        )
+    related_edge = kvetch.get_edge_definition_by_name('related_edge')
+
+    assert await kvetch.gen_edge_counts(related_edge, parent_ids + [uuid4()]) == [2, 0, 5, 0]
+
+    await kvetch.gen_delete_object(child_ids[2][1])
+    assert await kvetch.gen_edge_count(related_edge, parent_ids[2]) == 4
+    edges = await kvetch.gen_edges(related_edge, parent_ids[2])
+    assert [edge.to_id for edge in edges] == child_ids[2][:1] + child_ids[2][2:]
+
+    await kvetch.gen_delete_edge(related_edge, parent_ids[0], child_ids[0][0])
+    await kvetch.gen_delete_edge(related_edge, parent_ids[0], uuid4())
+    assert await kvetch.gen_edge_count(related_edge, parent_ids[0]) == 1
+
+
+def test_edge_cursor_decode_rejects_garbage() -> None:
+    with pytest.raises(ValueError):
+        EdgeCursor.decode('bm90IGEgY3Vyc29y')
+
+
 @pytest.mark.asyncio
 async def test_single_index_kvetch(single_index_kvetch: Kvetch) -> None:
     kvetch = single_index_kvetch
@@ -240,3 +315,232 @@ async def test_single_shard_gen_objects_of_type() -> None:
 
     all_objs_after_one_first_one = await kvetch.gen_objects_of_type(type_id, after=id_one, first=1)
     assert list(all_objs_after_one_first_one.keys()) == [id_two]
+
+
+class CountingMemShard(KvetchMemShard):
+    def __init__(self) -> None:
+        super().__init__()
+        self.gen_objects_calls = 0
+
+    async def gen_objects(self, ids: List[UUID]) -> Dict[UUID, KvetchData]:
+        self.gen_objects_calls += 1
+        return await super().gen_objects(ids)
+
+
+class StalledMemShard(KvetchMemShard):
+    async def gen_index_entries_with_objects(self, index: IndexDefinition,
+                                             value: Any) -> Tuple[List[Any], Dict]:
+        await asyncio.sleep(10)
+        return await super().gen_index_entries_with_objects(index, value)
+
+
+def num_index() -> IndexDefinition:
+    return define_int_index(index_name='num_index', indexed_type='Test', indexed_attr='num')
+
+
+@pytest.mark.asyncio
+async def test_gen_from_index_many_shards() -> None:
+    kvetch = create_test_kvetch(
+        shards=[KvetchMemShard() for _ in range(0, 8)], indexes=[num_index()]
+    )
+    ids_with_2 = [await kvetch.gen_insert_object(2345, {'num': 2}) for _ in range(0, 10)]
+    await kvetch.gen_insert_object(2345, {'num': 3})
+
+    result = await kvetch.gen_from_index(kvetch.get_index('num_index'), 2)
+    assert set(result.keys()) == set(ids_with_2)
+    for obj_id, obj in result.items():
+        assert obj['obj_id'] == obj_id
+        assert obj['num'] == 2
+
+
+@pytest.mark.asyncio
+async def test_gen_from_index_colocated_single_round_trip() -> None:
+    shard = CountingMemShard()
+    kvetch = create_test_kvetch(shards=[shard], indexes=[num_index()])
+    new_id = await kvetch.gen_insert_object(2345, {'num': 2})
+
+    result = await kvetch.gen_from_index(kvetch.get_index('num_index'), 2)
+    assert list(result.keys()) == [new_id]
+    # fetched together with the index entries, no follow up gen_objects
+    assert shard.gen_objects_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_gen_from_index_shard_timeout() -> None:
+    shards = [KvetchMemShard(), StalledMemShard()]
+    kvetch = create_test_kvetch(shards=shards, indexes=[num_index()])
+    index = kvetch.get_index('num_index')
+    obj_id = uuid4()
+    await shards[0].gen_insert_object(obj_id, 2345, {'num': 2})
+    await shards[0].gen_insert_index_entry(index, 2, obj_id)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await kvetch.gen_from_index(index, 2, shard_timeout=0.01)
+
+    result = await kvetch.gen_from_index(index, 2, shard_timeout=0.01, allow_partial=True)
+    assert list(result.keys()) == [obj_id]
+
+
+@pytest.mark.asyncio
+async def test_gen_objects_preserves_request_order() -> None:
+    kvetch = many_shards_no_index()
+    ids = [await kvetch.gen_insert_object(1000, {'num': i}) for i in range(0, 30)]
+    missing_id = uuid4()
+    request = list(reversed(ids)) + [missing_id]
+    objs = await kvetch.gen_objects(request)
+    assert list(objs.keys()) == request
+    assert objs[missing_id] is None
+
+
+class BatchCountingMemShard(KvetchMemShard):
+    def __init__(self) -> None:
+        super().__init__()
+        self.batch_calls = 0
+
+    async def gen_insert_objects(self, new_ids: List[UUID], type_id: int,
+                                 datas: List[KvetchData]) -> List[UUID]:
+        self.batch_calls += 1
+        return await super().gen_insert_objects(new_ids, type_id, datas)
+
+
+@pytest.mark.asyncio
+async def test_insert_objects_many_shards_with_edges_and_indexes() -> None:
+    shards = [BatchCountingMemShard() for _ in range(0, 4)]
+    kvetch = create_test_kvetch(shards=shards, edges=[related_edge()], indexes=[num_index()])
+    parent_id = await kvetch.gen_insert_object(2345, {'num': 1000})
+    for shard in shards:
+        shard.batch_calls = 0
+
+    datas = [{'num': i % 5 + 1, 'related_id': parent_id} for i in range(0, 50)]
+    new_ids = await kvetch.gen_insert_objects(2345, datas)
+    assert len(new_ids) == 50
+    assert all(shard.batch_calls == 1 for shard in shards)
+
+    objs = await kvetch.gen_objects(new_ids)
+    assert [obj['num'] for obj in objs.values()] == [data['num'] for data in datas]
+
+    edges = await kvetch.gen_edges(kvetch.get_edge_definition_by_name('related_edge'), parent_id)
+    assert set(edge.to_id for edge in edges) == set(new_ids)
+
+    with_one = await kvetch.gen_from_index(kvetch.get_index('num_index'), 1)
+    assert set(with_one.keys()) == set(new_ids[0::5])
+
+
+class ApplyWritesRecordingMemShard(KvetchMemShard):
+    def __init__(self) -> None:
+        super().__init__()
+        self.batches = []  # type: List[KvetchWriteBatch]
+
+    async def gen_apply_writes(self, batch: KvetchWriteBatch) -> None:
+        self.batches.append(batch)
+        await super().gen_apply_writes(batch)
+
+
+@pytest.mark.asyncio
+async def test_update_moves_index_entries() -> None:
+    shards = [ApplyWritesRecordingMemShard() for _ in range(0, 4)]
+    kvetch = create_test_kvetch(shards=shards, indexes=[num_index()])
+    index = kvetch.get_index('num_index')
+    obj_id = await kvetch.gen_insert_object(2345, {'num': 1, 'name': 'a'})
+    for shard in shards:
+        shard.batches = []
+
+    # attributes that are not indexed never touch index shards
+    await kvetch.gen_update_object(obj_id, {'name': 'b'})
+    await kvetch.gen_update_object(obj_id, {'num': 1})
+    assert all(shard.batches == [] for shard in shards)
+
+    await kvetch.gen_update_object(obj_id, {'num': 2})
+    assert await kvetch.gen_ids_from_index(index, 1) == []
+    assert await kvetch.gen_ids_from_index(index, 2) == [obj_id]
+    assert (await kvetch.gen_object(obj_id))['num'] == 2
+
+    # falsy values are not indexed
+    await kvetch.gen_update_object(obj_id, {'num': 0})
+    assert await kvetch.gen_ids_from_index(index, 2) == []
+    assert await kvetch.gen_ids_from_index(index, 0) == []
+    await kvetch.gen_update_object(obj_id, {'num': 3})
+    assert await kvetch.gen_ids_from_index(index, 3) == [obj_id]
+
+    deletes = [
+        entry for shard in shards for batch in shard.batches
+        for entry in batch.index_deletes[index]
+    ]
+    inserts = [
+        entry for shard in shards for batch in shard.batches
+        for entry in batch.index_entries[index]
+    ]
+    assert sorted(deletes) == [(1, obj_id), (2, obj_id)]
+    assert sorted(inserts) == [(2, obj_id), (3, obj_id)]
+
+
+@pytest.mark.asyncio
+async def test_update_missing_object_writes_no_index_entries() -> None:
+    kvetch = create_test_kvetch(shards=[KvetchMemShard()], indexes=[num_index()])
+    await kvetch.gen_update_object(uuid4(), {'num': 1})
+    assert await kvetch.gen_ids_from_index(kvetch.get_index('num_index'), 1) == []
+
+
+@pytest.mark.asyncio
+async def test_many_shards_gen_objects_of_type_pages() -> None:
+    kvetch = many_shards_no_index()
+    type_id = 2345
+    ids = sorted([await kvetch.gen_insert_object(type_id, {'num': i}) for i in range(0, 30)])
+    await kvetch.gen_insert_object(type_id + 1, {'num': 100})
+
+    all_objs = await kvetch.gen_objects_of_type(type_id)
+    assert list(all_objs.keys()) == ids
+
+    paged_ids = []  # type: List[UUID]
+    after = None
+    while True:
+        page = await kvetch.gen_objects_of_type(type_id, after=after, first=7)
+        if not page:
+            break
+        assert len(page) <= 7
+        paged_ids.extend(page.keys())
+        after = list(page.keys())[-1]
+    assert paged_ids == ids
+
+
+@pytest.mark.asyncio
+async def test_many_shards_iterate_objects_of_type() -> None:
+    kvetch = many_shards_no_index()
+    type_id = 2345
+    ids = sorted([await kvetch.gen_insert_object(type_id, {'num': i}) for i in range(0, 50)])
+    await kvetch.gen_insert_object(type_id + 1, {'num': 100})
+
+    streamed = []
+    async for obj_id, obj in kvetch.gen_iterate_objects_of_type(type_id, page_size=2):
+        assert obj['obj_id'] == obj_id
+        streamed.append(obj_id)
+    assert streamed == ids
+
+
+def test_write_plans_only_list_definitions_for_their_type() -> None:
+    objects = [
+        ObjectDefinition(type_name='Test', type_id=2345),
+        ObjectDefinition(type_name='Other', type_id=3456),
+        ObjectDefinition(type_name='Bare', type_id=4567),
+    ]
+    other_edge = StoredIdEdgeDefinition(
+        edge_name='other_edge', edge_id=13, stored_id_attr='test_id', stored_on_type='Other'
+    )
+    other_index = define_int_index(
+        index_name='other_index', indexed_type='Other', indexed_attr='num'
+    )
+    schema = Schema(
+        objects=objects,
+        edges=[related_edge(), other_edge],
+        indexes=[num_index(), other_index],
+    )
+    kvetch = Kvetch(shards=[KvetchMemShard()], schema=schema)
+
+    assert kvetch.get_write_plan(2345).edges == (related_edge(), )
+    assert kvetch.get_write_plan(2345).indexes == (num_index(), )
+    assert kvetch.get_write_plan(3456).edges == (other_edge, )
+    assert kvetch.get_write_plan(3456).indexes == (other_index, )
+    assert kvetch.get_write_plan(4567) == kvetch.get_write_plan(9999)
+    assert kvetch.get_write_plan(4567).edges == ()
+    assert list(kvetch.iterate_applicable_indexes(3456, {'num': 1, 'related_id': uuid4()})
+                ) == [other_index]
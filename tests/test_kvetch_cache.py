@@ -0,0 +1,177 @@
+import asyncio
+from typing import Dict, List
+from uuid import UUID, uuid4
+
+import pytest
+
+from graphscale.kvetch import Kvetch, KvetchObjectCache, ObjectDefinition, Schema
+from graphscale.kvetch.data_storage import LazyKvetchRecord, data_to_body
+from graphscale.kvetch.kvetch import KvetchData
+from graphscale.kvetch.memshard import KvetchMemShard
+from graphscale.utils import async_tuple
+
+#W0621 display redefine variable for test fixture
+#pylint: disable=W0621,C0103,W0401,W0614
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CountingMemShard(KvetchMemShard):
+    def __init__(self) -> None:
+        super().__init__()
+        self.fetched = []  # type: List[UUID]
+        self.delay = 0.0
+
+    async def gen_objects(self, ids: List[UUID]) -> Dict[UUID, KvetchData]:
+        self.fetched.extend(ids)
+        # snapshot before yielding to the loop, like a real read would
+        objs = await super().gen_objects(ids)
+        result = {obj_id: dict(obj) if obj else None for obj_id, obj in objs.items()}
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return result
+
+
+def create_cached_kvetch(shards: List[KvetchMemShard], cache: KvetchObjectCache) -> Kvetch:
+    objects = [ObjectDefinition(type_name='Test', type_id=2345)]
+    schema = Schema(objects=objects, edges=[], indexes=[])
+    return Kvetch(shards=shards, schema=schema, cache=cache)
+
+
+def test_cache_lru_eviction_by_bytes() -> None:
+    cache = KvetchObjectCache(max_bytes=3, sizeof=lambda data: 1)
+    ids = [uuid4() for _ in range(0, 4)]
+    token = cache.begin_fill()
+    cache.end_fill(token, {obj_id: {'num': i} for i, obj_id in enumerate(ids[:3])})
+
+    # touch the first so the second becomes least recently used
+    assert cache.get_many([ids[0]]) == {ids[0]: {'num': 0}}
+
+    token = cache.begin_fill()
+    cache.end_fill(token, {ids[3]: {'num': 3}})
+
+    assert set(cache.get_many(ids).keys()) == {ids[0], ids[2], ids[3]}
+    stats = cache.stats()
+    assert stats.evictions == 1
+    assert stats.entries == 3
+    assert stats.size_bytes == 3
+
+
+def test_cache_skips_oversized_objects() -> None:
+    cache = KvetchObjectCache(max_bytes=10, sizeof=lambda data: 11)
+    obj_id = uuid4()
+    cache.end_fill(cache.begin_fill(), {obj_id: {'num': 1}})
+    assert cache.get_many([obj_id]) == {}
+    assert cache.stats().entries == 0
+
+
+def test_cache_ttl() -> None:
+    clock = FakeClock()
+    cache = KvetchObjectCache(ttl=10.0, clock=clock)
+    obj_id = uuid4()
+    cache.end_fill(cache.begin_fill(), {obj_id: {'num': 1}})
+
+    clock.now = 9.0
+    assert cache.get_many([obj_id]) == {obj_id: {'num': 1}}
+    clock.now = 10.0
+    assert cache.get_many([obj_id]) == {}
+
+    stats = cache.stats()
+    assert stats.hits == 1
+    assert stats.misses == 1
+    assert stats.expirations == 1
+    assert stats.entries == 0
+
+
+def test_cache_is_isolated_from_callers() -> None:
+    cache = KvetchObjectCache()
+    obj_id = uuid4()
+    filled = {'num': 1}
+    cache.end_fill(cache.begin_fill(), {obj_id: filled})
+    filled['num'] = 2
+    with pytest.raises(TypeError):
+        cache.get_many([obj_id])[obj_id]['num'] = 3  # type: ignore
+    assert cache.get_many([obj_id])[obj_id]['num'] == 1
+
+
+def test_cache_keeps_lazy_records_undecoded() -> None:
+    cache = KvetchObjectCache()
+    obj_id = uuid4()
+    record = LazyKvetchRecord(obj_id, 2345, data_to_body({'num': 1, 'name': 'x' * 1000}))
+    cache.end_fill(cache.begin_fill(), {obj_id: record})
+    assert not record.is_decoded
+    assert cache.stats().size_bytes < 1000  # sized by the compressed body
+
+    first = cache.get_many([obj_id])[obj_id]
+    assert isinstance(first, LazyKvetchRecord) and not first.is_decoded
+    first['num'] = 2
+    second = cache.get_many([obj_id])[obj_id]
+    assert not second.is_decoded
+    assert second['num'] == 1
+    assert second['name'] == 'x' * 1000
+
+
+def test_invalidation_during_fill_wins() -> None:
+    cache = KvetchObjectCache()
+    obj_id = uuid4()
+    token = cache.begin_fill()
+    cache.invalidate(obj_id)
+    cache.end_fill(token, {obj_id: {'num': 'stale'}})
+    assert cache.get_many([obj_id]) == {}
+
+
+@pytest.mark.asyncio
+async def test_kvetch_serves_repeat_reads_from_cache() -> None:
+    shard = CountingMemShard()
+    cache = KvetchObjectCache()
+    kvetch = create_cached_kvetch([shard], cache)
+    id_one = await kvetch.gen_insert_object(2345, {'num': 1})
+    id_two = await kvetch.gen_insert_object(2345, {'num': 2})
+
+    assert (await kvetch.gen_object(id_one))['num'] == 1
+    objs = await kvetch.gen_objects([id_two, id_one])
+    assert list(objs.keys()) == [id_two, id_one]
+    assert shard.fetched == [id_one, id_two]
+
+    objs = await kvetch.gen_objects([id_one, id_two])
+    assert [obj['num'] for obj in objs.values()] == [1, 2]
+    assert shard.fetched == [id_one, id_two]
+    assert cache.stats().hits == 3
+
+
+@pytest.mark.asyncio
+async def test_kvetch_writes_invalidate_cache() -> None:
+    shard = CountingMemShard()
+    kvetch = create_cached_kvetch([shard], KvetchObjectCache())
+    obj_id = await kvetch.gen_insert_object(2345, {'num': 1})
+    assert (await kvetch.gen_object(obj_id))['num'] == 1
+
+    await kvetch.gen_update_object(obj_id, {'num': 2})
+    assert (await kvetch.gen_object(obj_id))['num'] == 2
+
+    await kvetch.gen_delete_object(obj_id)
+    assert await kvetch.gen_object(obj_id) is None
+
+
+@pytest.mark.asyncio
+async def test_kvetch_read_racing_update_does_not_cache_stale_data() -> None:
+    shard = CountingMemShard()
+    kvetch = create_cached_kvetch([shard], KvetchObjectCache())
+    obj_id = await kvetch.gen_insert_object(2345, {'num': 1})
+
+    async def gen_update_during_read() -> None:
+        await asyncio.sleep(0.001)
+        await kvetch.gen_update_object(obj_id, {'num': 2})
+
+    shard.delay = 0.01
+    stale, _ = await async_tuple(kvetch.gen_object(obj_id), gen_update_during_read())
+    shard.delay = 0.0
+
+    assert stale['num'] == 1
+    assert (await kvetch.gen_object(obj_id))['num'] == 2
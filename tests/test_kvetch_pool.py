@@ -0,0 +1,379 @@
+from contextlib import contextmanager
+import threading
+import time
+from typing import Any, Iterator, List
+from uuid import uuid4
+
+from pymysql.constants import SERVER_STATUS
+import pytest
+
+from graphscale.kvetch import StoredIdEdgeDefinition, define_int_index, define_string_index
+from graphscale.kvetch.dbshard import (
+    KvetchDbConnectionPool, KvetchDbPoolTimeout, KvetchDbShard, KvetchDbThreadedShard
+)
+from graphscale.kvetch.data_storage import body_to_data, data_to_body
+from graphscale.kvetch.kvetch import KvetchWriteBatch
+from graphscale.test.utils import MagnusConn
+from graphscale.utils import async_list
+
+#W0621 display redefine variable for test fixture
+#pylint: disable=W0621,C0103,W0401,W0614
+
+
+class FakeConn:
+    def __init__(self) -> None:
+        self.closed = False
+        self.healthy = True
+        self.pings = 0
+
+    def ping(self, reconnect: bool=True) -> None:
+        self.pings += 1
+        if not self.healthy:
+            raise Exception('gone away')
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class RecordingConn(FakeConn):
+    """Records statements and transaction boundaries like a pymysql connection would see"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.log = []  # type: List[str]
+        self.args = []  # type: List[Any]
+        self.rows = []  # type: List[Any]
+        self.server_status = 0
+
+    def begin(self) -> None:
+        self.log.append('BEGIN')
+        self.server_status |= SERVER_STATUS.SERVER_STATUS_IN_TRANS
+
+    def commit(self) -> None:
+        self.log.append('COMMIT')
+        self.server_status &= ~SERVER_STATUS.SERVER_STATUS_IN_TRANS
+
+    def rollback(self) -> None:
+        self.log.append('ROLLBACK')
+        self.server_status &= ~SERVER_STATUS.SERVER_STATUS_IN_TRANS
+
+    @contextmanager
+    def cursor(self) -> Iterator['RecordingConn']:
+        yield self
+
+    def execute(self, sql: str, args: Any=None) -> int:
+        self.log.append(sql.split('(')[0].strip())
+        self.args.append(args)
+        return 1
+
+    def executemany(self, sql: str, args: List[Any]) -> None:
+        if args:
+            self.log.append(sql.split('(')[0].strip())
+            self.args.append(args)
+
+    def fetchone(self) -> Any:
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self) -> List[Any]:
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def create_pool(created: List[FakeConn], clock: FakeClock=None, **kwargs: Any
+                ) -> KvetchDbConnectionPool:
+    def conn_factory(_conn_info: Any) -> FakeConn:
+        conn = FakeConn()
+        created.append(conn)
+        return conn
+
+    if clock:
+        kwargs['clock'] = clock
+    return KvetchDbConnectionPool(
+        MagnusConn.get_unittest_conn_info(), conn_factory=conn_factory, **kwargs
+    )
+
+
+def test_pool_reuses_connection() -> None:
+    created = []  # type: List[FakeConn]
+    pool = create_pool(created)
+    with pool.create_safe_conn() as conn_one:
+        pass
+    with pool.create_safe_conn() as conn_two:
+        pass
+    assert conn_one is conn_two
+    assert len(created) == 1
+    assert not conn_one.closed
+
+    stats = pool.stats()
+    assert stats.checkouts == 2
+    assert stats.creations == 1
+    assert stats.size == 1
+    assert stats.idle == 1
+
+
+def test_pool_min_size_prefills() -> None:
+    created = []  # type: List[FakeConn]
+    pool = create_pool(created, min_size=3, max_size=5)
+    assert len(created) == 3
+    assert pool.stats().idle == 3
+
+
+def test_pool_nested_checkouts_get_distinct_connections() -> None:
+    created = []  # type: List[FakeConn]
+    pool = create_pool(created, max_size=2)
+    with pool.create_safe_conn() as conn_one:
+        with pool.create_safe_conn() as conn_two:
+            assert conn_one is not conn_two
+            assert pool.stats().size == 2
+    assert pool.stats().idle == 2
+
+
+def test_pool_checkout_timeout() -> None:
+    created = []  # type: List[FakeConn]
+    pool = create_pool(created, max_size=1, checkout_timeout=0.01)
+    with pool.create_safe_conn():
+        with pytest.raises(KvetchDbPoolTimeout):
+            with pool.create_safe_conn():
+                pass
+    stats = pool.stats()
+    assert stats.waits == 1
+    assert stats.timeouts == 1
+    assert stats.size == 1
+
+
+def test_pool_waiter_gets_returned_connection() -> None:
+    created = []  # type: List[FakeConn]
+    pool = create_pool(created, max_size=1, checkout_timeout=5.0)
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold_conn() -> None:
+        with pool.create_safe_conn():
+            acquired.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold_conn)
+    holder.start()
+    acquired.wait()
+
+    waiter_conns = []  # type: List[FakeConn]
+
+    def wait_for_conn() -> None:
+        with pool.create_safe_conn() as conn:
+            waiter_conns.append(conn)
+
+    waiter = threading.Thread(target=wait_for_conn)
+    waiter.start()
+    release.set()
+    holder.join()
+    waiter.join()
+
+    assert waiter_conns == created
+    assert pool.stats().waits <= 1
+    assert pool.stats().creations == 1
+
+
+def test_pool_discards_on_error() -> None:
+    created = []  # type: List[FakeConn]
+    pool = create_pool(created)
+    with pytest.raises(ValueError):
+        with pool.create_safe_conn():
+            raise ValueError('query blew up')
+    assert created[0].closed
+    stats = pool.stats()
+    assert stats.size == 0
+    assert stats.discards == 1
+
+    with pool.create_safe_conn() as conn:
+        assert conn is created[1]
+
+
+def test_pool_prunes_idle_connections() -> None:
+    created = []  # type: List[FakeConn]
+    clock = FakeClock()
+    pool = create_pool(created, clock=clock, min_size=1, max_size=3, idle_timeout=10.0)
+    with pool.create_safe_conn():
+        with pool.create_safe_conn():
+            with pool.create_safe_conn():
+                pass
+    assert pool.stats().idle == 3
+
+    clock.now = 100.0
+    with pool.create_safe_conn():
+        pass
+
+    # everything was idle too long but min_size is retained
+    assert pool.stats().size == 1
+    assert len([conn for conn in created if conn.closed]) == 2
+
+
+def test_pool_health_check_replaces_dead_connection() -> None:
+    created = []  # type: List[FakeConn]
+    clock = FakeClock()
+    pool = create_pool(created, clock=clock, health_check_interval=5.0, idle_timeout=1000.0)
+    with pool.create_safe_conn() as conn:
+        pass
+
+    # recently used connections are not pinged
+    with pool.create_safe_conn() as conn:
+        pass
+    assert conn.pings == 0
+
+    conn.healthy = False
+    clock.now = 10.0
+    with pool.create_safe_conn() as new_conn:
+        assert new_conn is not conn
+    assert conn.pings == 1
+    assert conn.closed
+    assert pool.stats().creations == 2
+    assert pool.stats().size == 1
+
+
+@pytest.mark.asyncio
+async def test_threaded_shard_overlaps_queries() -> None:
+    created = []  # type: List[FakeConn]
+    pool = create_pool(created, max_size=4)
+    shard = KvetchDbThreadedShard(pool=pool)
+
+    def slow_query(conn: FakeConn, num: int) -> int:
+        assert isinstance(conn, FakeConn)
+        time.sleep(0.1)
+        return num
+
+    start = time.monotonic()
+    results = await async_list([shard._gen_with_conn(slow_query, i) for i in range(0, 4)])
+    elapsed = time.monotonic() - start
+
+    assert results == [0, 1, 2, 3]
+    # four 100ms queries on the loop thread would take at least 400ms
+    assert elapsed < 0.3
+    assert pool.stats().creations == 4
+    assert pool.stats().idle == 4
+
+
+@pytest.mark.asyncio
+async def test_inline_shard_runs_on_loop_thread() -> None:
+    created = []  # type: List[FakeConn]
+    shard = KvetchDbShard(pool=create_pool(created))
+
+    def which_thread(_conn: FakeConn) -> threading.Thread:
+        return threading.current_thread()
+
+    assert await shard._gen_with_conn(which_thread) is threading.current_thread()
+
+
+@pytest.mark.asyncio
+async def test_db_shard_applies_write_batch_in_one_transaction() -> None:
+    conns = []  # type: List[RecordingConn]
+
+    def conn_factory(_conn_info: Any) -> RecordingConn:
+        conns.append(RecordingConn())
+        return conns[-1]
+
+    pool = KvetchDbConnectionPool(MagnusConn.get_unittest_conn_info(), conn_factory=conn_factory)
+    shard = KvetchDbShard(pool=pool)
+
+    edge = StoredIdEdgeDefinition('related_edge', 12, 'related_id', 'Test')
+    index = define_int_index(index_name='num_index', indexed_type='Test', indexed_attr='num')
+    parent_id, new_id = uuid4(), uuid4()
+    batch = KvetchWriteBatch()
+    batch.add_object(2345, new_id, {'num': 4, 'related_id': parent_id})
+    batch.add_edge(edge, parent_id, new_id, {})
+    batch.add_index_entry(index, 4, new_id)
+    batch.add_index_delete(index, 3, new_id)
+    await shard.gen_apply_writes(batch)
+
+    assert len(conns) == 1
+    assert conns[0].log == [
+        'BEGIN',
+        'INSERT INTO kvetch_objects',
+        'INSERT into kvetch_edges',
+        'INSERT INTO kvetch_edge_counts',
+        'DELETE FROM num_index WHERE num = %s AND target_id = %s',
+        'INSERT INTO num_index',
+        'COMMIT',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_db_shard_deletes_index_entries_before_inserting() -> None:
+    conn = RecordingConn()
+    pool = KvetchDbConnectionPool(
+        MagnusConn.get_unittest_conn_info(), conn_factory=lambda _conn_info: conn
+    )
+    shard = KvetchDbShard(pool=pool)
+    index = define_string_index(index_name='name_index', indexed_type='Test', indexed_attr='name')
+    target_id = uuid4()
+    # a case-only change. the collation treats both values as equal, so the delete must
+    # not see the new row
+    batch = KvetchWriteBatch()
+    batch.add_index_entry(index, 'alice', target_id)
+    batch.add_index_delete(index, 'Alice', target_id)
+    await shard.gen_apply_writes(batch)
+
+    assert conn.log == [
+        'BEGIN',
+        'DELETE FROM name_index WHERE name = %s AND target_id = %s',
+        'INSERT INTO name_index',
+        'COMMIT',
+    ]
+    assert conn.args[0] == [('Alice', target_id.bytes)]
+
+
+@pytest.mark.asyncio
+async def test_db_shard_update_merges_under_row_lock() -> None:
+    conn = RecordingConn()
+    pool = KvetchDbConnectionPool(
+        MagnusConn.get_unittest_conn_info(), conn_factory=lambda _conn_info: conn
+    )
+    shard = KvetchDbShard(pool=pool)
+    conn.rows = [{'body': data_to_body({'num': 1, 'name': 'a'})}]
+
+    await shard.gen_update_object(uuid4(), {'num': 2})
+    assert conn.log == [
+        'BEGIN',
+        'SELECT body FROM kvetch_objects WHERE obj_id = %s FOR UPDATE',
+        'UPDATE kvetch_objects SET body = %s, updated = %s WHERE obj_id = %s',
+        'COMMIT',
+    ]
+    assert body_to_data(conn.args[1][0]) == {'num': 2, 'name': 'a'}
+
+    # a missing object is left alone
+    conn.log = []
+    await shard.gen_update_object(uuid4(), {'num': 3})
+    assert conn.log == [
+        'BEGIN', 'SELECT body FROM kvetch_objects WHERE obj_id = %s FOR UPDATE', 'COMMIT'
+    ]
+
+
+@pytest.mark.asyncio
+async def test_db_shard_index_batch_matches_rows_by_position() -> None:
+    conn = RecordingConn()
+    pool = KvetchDbConnectionPool(
+        MagnusConn.get_unittest_conn_info(), conn_factory=lambda _conn_info: conn
+    )
+    shard = KvetchDbShard(pool=pool)
+    index = define_string_index(index_name='name_index', indexed_type='Test', indexed_attr='name')
+    jose_id, other_id = uuid4(), uuid4()
+    # rows as MySQL returns them: the stored 'José' matches the requested 'jose' under the
+    # column's collation, and comes back with the positions that asked for it
+    conn.rows = [
+        {'position': 0, 'target_id': jose_id.bytes},
+        {'position': 2, 'target_id': jose_id.bytes},
+        {'position': 2, 'target_id': other_id.bytes},
+    ]
+
+    results = await shard.gen_index_entries_batch(index, ['jose', 'nobody', 'JOSE '])
+    assert [[entry.target_id for entry in entries] for entries in results] == [
+        [jose_id], [], [jose_id, other_id]
+    ]
+    assert conn.args == [[0, 'jose', 1, 'nobody', 2, 'JOSE ']]
+    assert conn.log == ['SELECT requested.position, name_index.target_id FROM']
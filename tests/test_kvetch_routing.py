@@ -0,0 +1,164 @@
+from collections import Counter
+import os
+import subprocess
+import sys
+from uuid import UUID, uuid4
+
+import pytest
+
+from graphscale.errors import InvariantViolation
+from graphscale.kvetch import (
+    ConsistentHashShardRouter, Kvetch, ModuloShardRouter, ObjectDefinition, Schema,
+    define_string_index, plan_shard_moves
+)
+from graphscale.kvetch.memshard import KvetchMemShard
+from graphscale.kvetch.migration import IndexRebuildStats, gen_rebuild_index
+from graphscale.kvetch.routing import stable_hash
+
+#W0621 display redefine variable for test fixture
+#pylint: disable=W0621,C0103,W0401,W0614
+
+
+def test_modulo_router_matches_original_placement() -> None:
+    router = ModuloShardRouter(16)
+    obj_id = uuid4()
+    assert router.get_shard_id_from_obj_id(obj_id) == obj_id.int % 16
+
+
+def test_consistent_router_is_deterministic() -> None:
+    obj_id = UUID('f2d41433-a996-40c9-ba3b-6047b2bd27f7')
+    router_one = ConsistentHashShardRouter(8)
+    router_two = ConsistentHashShardRouter(8)
+    assert router_one.get_shard_id_from_obj_id(obj_id) == router_two.get_shard_id_from_obj_id(
+        obj_id
+    )
+    assert router_one.get_shard_id_from_value('someone@example.com'
+                                              ) == router_two.get_shard_id_from_value(
+                                                  'someone@example.com'
+                                              )
+
+
+def test_consistent_router_spreads_keys() -> None:
+    router = ConsistentHashShardRouter(8)
+    counts = Counter(router.get_shard_id_from_obj_id(uuid4()) for _ in range(0, 8000))
+    assert set(counts.keys()) == set(range(0, 8))
+    for count in counts.values():
+        assert 600 < count < 1400
+
+
+def test_consistent_router_weights() -> None:
+    router = ConsistentHashShardRouter(2, weights=[1.0, 3.0])
+    counts = Counter(router.get_shard_id_from_obj_id(uuid4()) for _ in range(0, 4000))
+    assert counts[1] > 2 * counts[0]
+
+
+def test_growing_consistent_ring_moves_few_keys() -> None:
+    obj_ids = [uuid4() for _ in range(0, 9000)]
+    old_router = ConsistentHashShardRouter(8)
+    new_router = ConsistentHashShardRouter(9)
+    plan = plan_shard_moves(old_router, new_router, obj_ids=obj_ids)
+
+    # ideal is 1/9 of the keys, all of them onto the new shard
+    assert 600 < len(plan.objects) < 1400
+    assert all(move.to_shard_id == 8 for move in plan.objects)
+    for move in plan.objects:
+        assert move.from_shard_id == old_router.get_shard_id_from_obj_id(move.key)
+
+
+def test_growing_modulo_moves_most_keys() -> None:
+    obj_ids = [uuid4() for _ in range(0, 900)]
+    plan = plan_shard_moves(ModuloShardRouter(8), ModuloShardRouter(9), obj_ids=obj_ids)
+    assert len(plan.objects) > 700
+
+
+def test_plan_index_value_moves() -> None:
+    values = ['user' + str(i) for i in range(0, 900)]
+    plan = plan_shard_moves(
+        ConsistentHashShardRouter(8), ConsistentHashShardRouter(9), index_values=values
+    )
+    assert 0 < len(plan.index_values) < 200
+    assert plan.objects == []
+
+
+def test_kvetch_router_must_match_shards() -> None:
+    schema = Schema(objects=[], edges=[], indexes=[])
+    with pytest.raises(InvariantViolation):
+        Kvetch(shards=[KvetchMemShard()], schema=schema, router=ConsistentHashShardRouter(2))
+
+
+@pytest.mark.asyncio
+async def test_kvetch_with_consistent_router() -> None:
+    index = define_string_index(index_name='name_index', indexed_type='Test', indexed_attr='name')
+    schema = Schema(
+        objects=[ObjectDefinition(type_name='Test', type_id=2345)], edges=[], indexes=[index]
+    )
+    shards = [KvetchMemShard() for _ in range(0, 4)]
+    router = ConsistentHashShardRouter(4)
+    kvetch = Kvetch(shards=shards, schema=schema, router=router)
+
+    ids = [await kvetch.gen_insert_object(2345, {'name': 'name' + str(i)}) for i in range(0, 20)]
+    for obj_id in ids:
+        shard = shards[router.get_shard_id_from_obj_id(obj_id)]
+        assert (await shard.gen_object(obj_id))['obj_id'] == obj_id
+
+    objs = await kvetch.gen_objects(ids)
+    assert set(objs.keys()) == set(ids)
+
+    assert await kvetch.gen_id_from_index('name_index', 'name7') == ids[7]
+
+
+def routing_in_subprocess(hash_seed: str) -> str:
+    script = (
+        'from graphscale.kvetch.routing import ModuloShardRouter, ConsistentHashShardRouter\n'
+        'values = ["someone@example.com", "schrockn", "a", 12345]\n'
+        'print([ModuloShardRouter(16).get_shard_id_from_value(v) for v in values])\n'
+        'print([ConsistentHashShardRouter(16).get_shard_id_from_value(v) for v in values])\n'
+    )
+    env = {**os.environ, 'PYTHONHASHSEED': hash_seed}
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.check_output([sys.executable, '-c', script], env=env, cwd=repo_root).decode()
+
+
+def test_value_routing_identical_across_processes() -> None:
+    outputs = {routing_in_subprocess(seed) for seed in ['0', '1', '2', '12345']}
+    assert len(outputs) == 1
+
+
+def test_stable_hash_distinguishes_types() -> None:
+    assert stable_hash(1) != stable_hash('1')
+    assert stable_hash('abc') == stable_hash('abc')
+
+
+@pytest.mark.asyncio
+async def test_rebuild_index_moves_misplaced_entries() -> None:
+    index = define_string_index(index_name='name_index', indexed_type='Test', indexed_attr='name')
+    schema = Schema(
+        objects=[ObjectDefinition(type_name='Test', type_id=2345)], edges=[], indexes=[index]
+    )
+    shards = [KvetchMemShard() for _ in range(0, 4)]
+    kvetch = Kvetch(shards=shards, schema=schema)
+
+    ids = []
+    for i in range(0, 20):
+        obj_id = uuid4()
+        name = 'name' + str(i)
+        await kvetch.get_shard_from_obj_id(obj_id).gen_insert_object(obj_id, 2345, {'name': name})
+        # simulate placement under an old routing scheme
+        wrong_shard_id = (kvetch.get_shard_id_from_value(name) + 1 + i % 3) % 4
+        await shards[wrong_shard_id].gen_insert_index_entry(index, name, obj_id)
+        ids.append(obj_id)
+
+    assert await kvetch.gen_id_from_index('name_index', 'name3') is None
+
+    stats = await gen_rebuild_index(kvetch, index, page_size=3)
+    assert stats == IndexRebuildStats(scanned=20, inserted=20, deleted=20)
+
+    for i, obj_id in enumerate(ids):
+        assert await kvetch.gen_id_from_index('name_index', 'name' + str(i)) == obj_id
+        for shard in shards:
+            if shard is not kvetch.get_shard_from_value('name' + str(i)):
+                assert await shard.gen_index_entries(index, 'name' + str(i)) == []
+
+    assert await gen_rebuild_index(kvetch, index) == IndexRebuildStats(
+        scanned=20, inserted=0, deleted=0
+    )
@@ -7,7 +7,8 @@ from graphscale.kvetch.kvetch import KvetchShard
 
 from graphscale.kvetch.dbschema import drop_shard_db_tables, init_shard_db_tables
 from graphscale.kvetch.dbshard import KvetchDbShard, KvetchDbSingleConnectionPool
-from graphscale.kvetch.memshard import KvetchMemShard
+from graphscale.kvetch.memshard import KvetchMemShard, _SortedIds
+from graphscale.kvetch.snapshot import KvetchSnapshotError
 
 from graphscale.test.utils import MagnusConn, db_mem_fixture
 
@@ -398,3 +399,129 @@ def test_string_index(sync_index_shard):
     assert id_one not in five_ids
     assert id_two not in five_ids
     assert id_three in five_ids
+
+
+def test_sorted_ids_split_and_remove():
+    sorted_ids = _SortedIds(load=4)
+    ids = [uuid4() for _ in range(0, 100)]
+    for obj_id in ids:
+        sorted_ids.add(obj_id)
+    assert len(sorted_ids.chunks) > 1
+    assert all(len(chunk) <= 8 for chunk in sorted_ids.chunks)
+
+    for obj_id in ids[::3]:
+        sorted_ids.remove(obj_id)
+    sorted_ids.remove(uuid4())
+    remaining = sorted(set(ids) - set(ids[::3]))
+
+    assert list(sorted_ids.iterate_after()) == remaining
+    for position in [0, 1, 7, 8, 9, 30, len(remaining) - 1]:
+        after = remaining[position]
+        assert list(sorted_ids.iterate_after(after)) == remaining[position + 1:]
+    for removed in ids[::3]:
+        assert list(sorted_ids.iterate_after(removed)) == [
+            obj_id for obj_id in remaining if obj_id > removed
+        ]
+
+
+def test_mem_shard_pages_after_deletes():
+    sync_shard = SyncedShard(KvetchMemShard())
+    ids = list(get_sorted_ids(50))
+    for obj_id in ids:
+        sync_shard.insert_object(obj_id, 1000, {'num': 1})
+    sync_shard.insert_object(uuid4(), 1001, {'num': 2})
+    for obj_id in ids[10:20]:
+        sync_shard.delete_object(obj_id)
+
+    page = sync_shard.get_objects_of_type(1000, after=ids[5], first=10)
+    assert list(page.keys()) == ids[6:10] + ids[20:26]
+    assert sync_shard.get_objects_of_type(1002) == {}
+
+
+def test_mem_shard_delete_index_entry():
+    shard = KvetchMemShard()
+    index = num_index()
+    ids = [uuid4() for _ in range(0, 3)]
+    for obj_id in ids:
+        execute_gen(shard.gen_insert_index_entry(index, 4, obj_id))
+    execute_gen(shard.gen_delete_index_entry(index, 4, ids[1]))
+    execute_gen(shard.gen_delete_index_entry(index, 5, ids[1]))
+
+    entries = execute_gen(shard.gen_index_entries(index, 4))
+    assert [entry.target_id for entry in entries] == [ids[0], ids[2]]
+
+
+def create_snapshot_shard():
+    shard = SyncedShard(KvetchMemShard())
+    ids = list(get_sorted_ids(30))
+    for obj_id in ids[:20]:
+        shard.insert_object(obj_id, 1000, {'num': 4, 'related_id': ids[0]})
+    for obj_id in ids[20:]:
+        shard.insert_object(obj_id, 1001, {'num': 5})
+    shard.delete_object(ids[1])
+    for obj_id in ids[2:6]:
+        shard.insert_edge(related_edge(), ids[0], obj_id)
+        shard.insert_index_entry(num_index(), 4, obj_id)
+    shard.insert_index_entry(num_index(), 'five', ids[20])
+    return shard, ids
+
+
+def test_mem_shard_snapshot_round_trip(tmpdir):
+    shard, ids = create_snapshot_shard()
+    path = str(tmpdir.join('shard.snapshot'))
+    shard.shard.save_snapshot(path)
+
+    restored = SyncedShard(KvetchMemShard.from_snapshot(path))
+    assert restored.shard._objects == {}
+
+    assert restored.get_object(ids[3])['num'] == 4
+    assert restored.get_object(ids[1]) is None
+    assert list(restored.shard._objects.keys()) == [ids[3]]
+
+    page = restored.get_objects_of_type(1000, after=ids[0], first=5)
+    assert list(page.keys()) == ids[2:7]
+    assert list(restored.get_objects_of_type(1001).keys()) == ids[20:]
+
+    edges = execute_gen(restored.shard.gen_edges(related_edge(), ids[0], first=2))
+    assert [edge.to_id for edge in edges] == ids[2:4]
+    rest = restored.get_edge_ids(related_edge(), ids[0], after=edges[-1].cursor)
+    assert rest == ids[4:6]
+
+    assert restored.get_index_ids(num_index(), 4) == ids[2:6]
+    assert restored.get_index_ids(num_index(), 'five') == [ids[20]]
+
+
+def test_mem_shard_snapshot_writes_after_restore(tmpdir):
+    shard, ids = create_snapshot_shard()
+    path = str(tmpdir.join('shard.snapshot'))
+    shard.shard.save_snapshot(path)
+
+    restored = SyncedShard(KvetchMemShard.from_snapshot(path))
+    restored.insert_edge(related_edge(), ids[0], ids[6])
+    execute_gen(restored.shard.gen_delete_index_entry(num_index(), 4, ids[2]))
+    restored.update_object(ids[7], {'num': 6})
+    restored.delete_object(ids[8])
+    new_id = uuid4()
+    restored.insert_object(new_id, 1001, {'num': 7})
+
+    edges = execute_gen(restored.shard.gen_edges(related_edge(), ids[0]))
+    assert [edge.to_id for edge in edges] == ids[2:7]
+    assert edges[-1].cursor.seq > edges[-2].cursor.seq
+
+    # a partly decoded shard saves both its decoded and its undecoded contents
+    path_two = str(tmpdir.join('shard_two.snapshot'))
+    restored.shard.save_snapshot(path_two)
+    again = SyncedShard(KvetchMemShard.from_snapshot(path_two))
+    assert again.get_edge_ids(related_edge(), ids[0]) == ids[2:7]
+    assert again.get_index_ids(num_index(), 4) == ids[3:6]
+    assert again.get_object(ids[7])['num'] == 6
+    assert again.get_object(ids[8]) is None
+    assert again.get_object(ids[9])['num'] == 4
+    assert list(again.get_objects_of_type(1001).keys()) == sorted(ids[20:] + [new_id])
+
+
+def test_mem_shard_snapshot_rejects_other_files(tmpdir):
+    path = tmpdir.join('not.snapshot')
+    path.write_binary(b'x' * 100)
+    with pytest.raises(KvetchSnapshotError):
+        KvetchMemShard.from_snapshot(str(path))
@@ -0,0 +1,130 @@
+import os
+import stat
+from typing import Tuple
+from uuid import UUID, uuid4
+
+import pytest
+
+from graphscale.kvetch import (
+    IndexDefinition, Kvetch, ObjectDefinition, Schema, StoredIdEdgeDefinition, define_int_index
+)
+from graphscale.kvetch.kvetch import KvetchData
+from graphscale.kvetch.memshard import KvetchMemShard
+from graphscale.kvetch.socketshard import (
+    KvetchShardServer, KvetchShardServerError, KvetchSocketShard
+)
+from graphscale.utils import async_list
+
+#W0621 display redefine variable for test fixture
+#pylint: disable=W0621,C0103,W0401,W0614
+
+
+class FailingMemShard(KvetchMemShard):
+    async def gen_object(self, obj_id: UUID) -> KvetchData:
+        raise ValueError('no objects today')
+
+
+def related_edge() -> StoredIdEdgeDefinition:
+    return StoredIdEdgeDefinition(
+        edge_name='related_edge', edge_id=12345, stored_id_attr='related_id', stored_on_type='Test'
+    )
+
+
+def num_index() -> IndexDefinition:
+    return define_int_index(index_name='num_index', indexed_type='Test', indexed_attr='num')
+
+
+def create_kvetch(shard: KvetchSocketShard) -> Kvetch:
+    schema = Schema(
+        objects=[ObjectDefinition(type_name='Test', type_id=2345)],
+        edges=[related_edge()],
+        indexes=[num_index()],
+    )
+    return Kvetch(shards=[shard], schema=schema)
+
+
+async def gen_served_shard(tmpdir, mem_shard: KvetchMemShard=None
+                           ) -> Tuple[KvetchShardServer, KvetchSocketShard]:
+    path = str(tmpdir.join('shard.sock'))
+    server = KvetchShardServer(mem_shard or KvetchMemShard(), path)
+    await server.gen_start()
+    return server, KvetchSocketShard(path)
+
+
+@pytest.mark.asyncio
+async def test_socket_shard_round_trip(tmpdir) -> None:
+    server, shard = await gen_served_shard(tmpdir)
+    try:
+        assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+
+        kvetch = create_kvetch(shard)
+        parent_id = await kvetch.gen_insert_object(2345, {'num': 1})
+        child_ids = await kvetch.gen_insert_objects(
+            2345, [{'num': 2, 'related_id': parent_id} for _ in range(0, 3)]
+        )
+
+        assert (await kvetch.gen_object(parent_id))['num'] == 1
+        edges = await kvetch.gen_edges(related_edge(), parent_id)
+        assert [edge.to_id for edge in edges] == child_ids
+        assert await kvetch.gen_edge_count(related_edge(), parent_id) == 3
+        assert sorted(await kvetch.gen_ids_from_index(num_index(), 2)) == sorted(child_ids)
+
+        await kvetch.gen_update_object(child_ids[0], {'num': 3})
+        assert await kvetch.gen_ids_from_index(num_index(), 3) == [child_ids[0]]
+        await kvetch.gen_delete_object(child_ids[1])
+        assert await kvetch.gen_edge_count(related_edge(), parent_id) == 2
+        assert await kvetch.gen_object(child_ids[1]) is None
+
+        # objects come back as read-only views, like from a local mem shard
+        with pytest.raises(TypeError):
+            (await kvetch.gen_object(parent_id))['num'] = 5  # type: ignore
+    finally:
+        await server.gen_close()
+
+
+@pytest.mark.asyncio
+async def test_socket_shard_batches_calls_per_tick(tmpdir) -> None:
+    server, shard = await gen_served_shard(tmpdir)
+    try:
+        kvetch = create_kvetch(shard)
+        ids = [await kvetch.gen_insert_object(2345, {'num': i}) for i in range(0, 10)]
+        frames, calls = server.frames, server.calls
+
+        objs = await async_list([shard.gen_object(obj_id) for obj_id in ids])
+        assert [obj['num'] for obj in objs] == list(range(0, 10))
+        assert server.frames == frames + 1
+        assert server.calls == calls + 10
+    finally:
+        await server.gen_close()
+
+
+@pytest.mark.asyncio
+async def test_socket_shard_remote_errors(tmpdir) -> None:
+    server, shard = await gen_served_shard(tmpdir, FailingMemShard())
+    try:
+        with pytest.raises(KvetchShardServerError) as error:
+            await shard.gen_object(uuid4())
+        assert 'no objects today' in str(error.value)
+
+        with pytest.raises(KvetchShardServerError):
+            await shard._gen_call('gen_close')
+
+        # the connection survives errors
+        assert await shard.gen_objects([]) == {}
+    finally:
+        await server.gen_close()
+
+
+@pytest.mark.asyncio
+async def test_socket_shard_reconnects(tmpdir) -> None:
+    server, shard = await gen_served_shard(tmpdir)
+    try:
+        obj_id = uuid4()
+        await shard.gen_insert_object(obj_id, 2345, {'num': 1})
+        shard._writer.close()
+
+        with pytest.raises(KvetchShardServerError):
+            await shard.gen_object(obj_id)
+        assert (await shard.gen_object(obj_id))['num'] == 1
+    finally:
+        await server.gen_close()
@@ -0,0 +1,166 @@
+import os
+import stat
+from uuid import uuid4
+
+import pytest
+
+from graphscale.kvetch import (
+    IndexDefinition, Kvetch, ObjectDefinition, Schema, StoredIdEdgeDefinition, define_int_index
+)
+from graphscale.kvetch.durableshard import KvetchDurableMemShard
+from graphscale.kvetch.wal import KvetchWriteAheadLog, WalDurability, read_wal_records
+from graphscale.utils import async_list
+
+#W0621 display redefine variable for test fixture
+#pylint: disable=W0621,C0103,W0401,W0614
+
+
+def related_edge() -> StoredIdEdgeDefinition:
+    return StoredIdEdgeDefinition(
+        edge_name='related_edge', edge_id=12345, stored_id_attr='related_id', stored_on_type='Test'
+    )
+
+
+def num_index() -> IndexDefinition:
+    return define_int_index(index_name='num_index', indexed_type='Test', indexed_attr='num')
+
+
+def create_kvetch(shard: KvetchDurableMemShard) -> Kvetch:
+    schema = Schema(
+        objects=[ObjectDefinition(type_name='Test', type_id=2345)],
+        edges=[related_edge()],
+        indexes=[num_index()],
+    )
+    return Kvetch(shards=[shard], schema=schema)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('durability', list(WalDurability))
+async def test_durable_shard_recovers_writes(tmpdir, durability) -> None:
+    directory = str(tmpdir.join('shard'))
+    kvetch = create_kvetch(KvetchDurableMemShard(directory, durability))
+    parent_id = await kvetch.gen_insert_object(2345, {'num': 1})
+    child_id = await kvetch.gen_insert_object(2345, {'num': 2, 'related_id': parent_id})
+    gone_id = await kvetch.gen_insert_object(2345, {'num': 3})
+    await kvetch.gen_update_object(child_id, {'num': 4})
+    await kvetch.gen_delete_object(gone_id)
+    await kvetch.get_shard_from_obj_id(parent_id).gen_close()
+
+    kvetch = create_kvetch(KvetchDurableMemShard(directory, durability))
+    assert (await kvetch.gen_object(child_id))['num'] == 4
+    assert await kvetch.gen_object(gone_id) is None
+    edges = await kvetch.gen_edges(related_edge(), parent_id)
+    assert [edge.to_id for edge in edges] == [child_id]
+    assert await kvetch.gen_id_from_index('num_index', 4) == child_id
+    assert await kvetch.gen_id_from_index('num_index', 2) is None
+
+
+@pytest.mark.asyncio
+async def test_durable_shard_stops_at_torn_record(tmpdir) -> None:
+    directory = str(tmpdir.join('shard'))
+    shard = KvetchDurableMemShard(directory)
+    kept_id, torn_id = uuid4(), uuid4()
+    await shard.gen_insert_object(kept_id, 2345, {'num': 1})
+    await shard.gen_insert_object(torn_id, 2345, {'num': 2})
+    await shard.gen_close()
+
+    # a crash in the middle of writing the last record
+    path = os.path.join(directory, 'wal.1')
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as wal_file:
+        wal_file.truncate(size - 3)
+    assert len(list(read_wal_records(path))) == 1
+
+    shard = KvetchDurableMemShard(directory)
+    assert (await shard.gen_object(kept_id))['num'] == 1
+    assert await shard.gen_object(torn_id) is None
+    # later writes go to a new log, after the torn one
+    await shard.gen_insert_object(torn_id, 2345, {'num': 3})
+    await shard.gen_close()
+    assert (await KvetchDurableMemShard(directory).gen_object(torn_id))['num'] == 3
+
+
+@pytest.mark.asyncio
+async def test_wal_group_commit(tmpdir) -> None:
+    wal = KvetchWriteAheadLog(str(tmpdir.join('wal.1')))
+    positions = [wal.append(str(i).encode()) for i in range(0, 50)]
+    await async_list([wal.gen_wait(position) for position in positions])
+    assert wal.syncs == 1
+
+    # appends made while a sync is in flight share the next one
+    first = wal.gen_wait(wal.append(b'a'))
+    rest = [wal.gen_wait(wal.append(b'b')) for _ in range(0, 10)]
+    await async_list([first] + rest)
+    assert wal.syncs <= 3
+    await wal.gen_close()
+    assert len(list(read_wal_records(wal.path))) == 61
+
+
+@pytest.mark.asyncio
+async def test_durable_shard_compacts(tmpdir) -> None:
+    directory = str(tmpdir.join('shard'))
+    kvetch = create_kvetch(KvetchDurableMemShard(directory, compact_after_bytes=2000))
+    shard = kvetch.get_shard_from_obj_id(uuid4())
+    ids = await async_list(
+        [kvetch.gen_insert_object(2345, {'num': i, 'pad': 'x' * 100}) for i in range(0, 40)]
+    )
+    await shard.gen_compact()
+    await kvetch.gen_update_object(ids[0], {'num': 100})
+    await shard.gen_close()
+
+    names = sorted(os.listdir(directory))
+    snapshots = [name for name in names if name.startswith('snapshot.')]
+    assert len(snapshots) == 1
+    # only the log started by the last compaction is left
+    assert [name for name in names if name.startswith('wal.')] == ['wal' + snapshots[0][8:]]
+
+    kvetch = create_kvetch(KvetchDurableMemShard(directory))
+    objs = await kvetch.gen_objects(ids)
+    assert [objs[obj_id]['num'] for obj_id in ids] == [100] + list(range(1, 40))
+    assert await kvetch.gen_id_from_index('num_index', 100) == ids[0]
+
+
+@pytest.mark.asyncio
+async def test_compaction_syncs_before_removing_logs(tmpdir, monkeypatch) -> None:
+    shard = KvetchDurableMemShard(str(tmpdir.join('shard')))
+    await shard.gen_insert_object(uuid4(), 2345, {'num': 1})
+
+    events = []
+    real_fsync, real_replace, real_remove = os.fsync, os.replace, os.remove
+
+    def fsync(fd):
+        events.append('sync dir' if stat.S_ISDIR(os.fstat(fd).st_mode) else 'sync file')
+        real_fsync(fd)
+
+    def replace(src, dst):
+        events.append('replace')
+        real_replace(src, dst)
+
+    def remove(path):
+        events.append('remove')
+        real_remove(path)
+
+    monkeypatch.setattr(os, 'fsync', fsync)
+    monkeypatch.setattr(os, 'replace', replace)
+    monkeypatch.setattr(os, 'remove', remove)
+    await shard.gen_compact()
+    await shard.gen_close()
+
+    # new log's entry, snapshot contents, snapshot's name, then the old log goes
+    assert events == ['sync dir', 'sync file', 'replace', 'sync dir', 'remove']
+
+
+@pytest.mark.asyncio
+async def test_edge_cursors_survive_compaction_and_recovery(tmpdir) -> None:
+    directory = str(tmpdir.join('shard'))
+    shard = KvetchDurableMemShard(directory)
+    parent_id, first_id, second_id = uuid4(), uuid4(), uuid4()
+    await shard.gen_compact()
+    await shard.gen_insert_edge(related_edge(), parent_id, first_id)
+    await shard.gen_insert_edge(related_edge(), parent_id, second_id)
+    cursor = (await shard.gen_edges(related_edge(), parent_id, first=1))[0].cursor
+    await shard.gen_close()
+
+    shard = KvetchDurableMemShard(directory)
+    edges = await shard.gen_edges(related_edge(), parent_id, after=cursor)
+    assert [edge.to_id for edge in edges] == [second_id]
@@ -0,0 +1,259 @@
+from typing import Any, Dict, List
+from uuid import UUID
+
+import pytest
+
+from graphscale.kvetch import (
+    EdgeData, EdgeQuery, IndexDefinition, Kvetch, ObjectDefinition, Schema,
+    StoredIdEdgeDefinition, define_string_index
+)
+from graphscale.kvetch.data_storage import LazyKvetchRecord, data_to_body
+from graphscale.kvetch.kvetch import IndexEntry, KvetchData, KvetchProjection
+from graphscale.kvetch.memshard import KvetchMemShard
+from graphscale.pent import (
+    Pent, PentConfig, PentContext, PentMutationData, create_pent, delete_pent
+)
+from graphscale.utils import async_list
+
+#W0621 display redefine variable for test fixture
+#pylint: disable=W0621,C0103,W0401,W0614
+
+
+class SampleUser(Pent):
+    pass
+
+
+class SampleItem(Pent):
+    pass
+
+
+class CreateSampleItemData(PentMutationData):
+    pass
+
+
+class BatchCountingShard(KvetchMemShard):
+    def __init__(self) -> None:
+        super().__init__()
+        self.edge_batches = []  # type: List[List[EdgeQuery]]
+        self.index_batches = []  # type: List[List[Any]]
+        self.object_batches = []  # type: List[List[UUID]]
+        self.projected_batches = []  # type: List[List[UUID]]
+        self.count_batches = []  # type: List[List[UUID]]
+
+    async def gen_edges_batch(self, edge_definition: StoredIdEdgeDefinition,
+                              queries: List[EdgeQuery]) -> List[List[EdgeData]]:
+        self.edge_batches.append(queries)
+        return await super().gen_edges_batch(edge_definition, queries)
+
+    async def gen_edge_counts(self, edge_definition: StoredIdEdgeDefinition,
+                              from_ids: List[UUID]) -> List[int]:
+        self.count_batches.append(from_ids)
+        return await super().gen_edge_counts(edge_definition, from_ids)
+
+    async def gen_index_entries_batch(self, index: IndexDefinition,
+                                      values: List[Any]) -> List[List[IndexEntry]]:
+        self.index_batches.append(values)
+        return await super().gen_index_entries_batch(index, values)
+
+    async def gen_objects(self, ids: List[UUID]) -> Dict[UUID, KvetchData]:
+        self.object_batches.append(ids)
+        return await super().gen_objects(ids)
+
+    async def gen_objects_projected(self, ids: List[UUID],
+                                    projection: KvetchProjection) -> Dict[UUID, KvetchData]:
+        self.projected_batches.append(ids)
+        objs = await super().gen_objects(ids)
+        return {
+            obj_id: {attr: obj[attr] for attr in projection} if obj else None
+            for obj_id, obj in objs.items()
+        }
+
+
+class LazyRecordShard(KvetchMemShard):
+    """Hands out records the way the db shard does"""
+
+    async def gen_objects(self, ids: List[UUID]) -> Dict[UUID, KvetchData]:
+        objs = await super().gen_objects(ids)
+        return {
+            obj_id: LazyKvetchRecord(obj_id, obj['type_id'], data_to_body(dict(obj)))
+            if obj else None
+            for obj_id, obj in objs.items()
+        }
+
+
+def user_to_items_edge() -> StoredIdEdgeDefinition:
+    return StoredIdEdgeDefinition(
+        edge_name='user_to_items_edge',
+        edge_id=1,
+        stored_id_attr='user_id',
+        stored_on_type='SampleItem',
+    )
+
+
+def create_test_context(shards: List[KvetchMemShard]) -> PentContext:
+    schema = Schema(
+        objects=[
+            ObjectDefinition(type_name='SampleUser', type_id=1),
+            ObjectDefinition(type_name='SampleItem', type_id=2),
+        ],
+        edges=[user_to_items_edge()],
+        indexes=[
+            define_string_index(
+                index_name='user_name_index', indexed_type='SampleUser', indexed_attr='name'
+            )
+        ],
+    )
+    class_map = {'SampleUser': SampleUser, 'SampleItem': SampleItem}
+    kvetch = Kvetch(shards=shards, schema=schema)
+    return PentContext(kvetch=kvetch, config=PentConfig(class_map, schema))
+
+
+async def gen_users_with_items(context: PentContext, num_users: int) -> List[List[UUID]]:
+    kvetch = context.kvetch
+    user_ids = [
+        await kvetch.gen_insert_object(1, {'name': 'user' + str(i)}) for i in range(0, num_users)
+    ]
+    item_ids = []
+    for user_id in user_ids:
+        item_ids.append(
+            [await kvetch.gen_insert_object(2, {'user_id': user_id}) for _ in range(0, 3)]
+        )
+    return [user_ids] + item_ids
+
+
+@pytest.mark.asyncio
+async def test_edges_batched_across_parents() -> None:
+    shard = BatchCountingShard()
+    context = create_test_context([shard])
+    user_ids, *item_ids = await gen_users_with_items(context, 5)
+
+    users = await SampleUser.gen_list(context, user_ids)
+    edge_lists = await async_list([user.gen_edges_to('user_to_items_edge') for user in users])
+
+    assert len(shard.edge_batches) == 1
+    assert [query.from_id for query in shard.edge_batches[0]] == user_ids
+    for edges, expected_ids in zip(edge_lists, item_ids):
+        assert [edge.to_id for edge in edges] == expected_ids
+
+
+@pytest.mark.asyncio
+async def test_edges_batched_per_shard() -> None:
+    shards = [BatchCountingShard() for _ in range(0, 4)]
+    context = create_test_context(shards)
+    user_ids, *item_ids = await gen_users_with_items(context, 12)
+
+    users = await SampleUser.gen_list(context, user_ids)
+    item_lists = await async_list(
+        [user.gen_associated_pents(SampleItem, 'user_to_items_edge', first=2) for user in users]
+    )
+
+    assert all(len(shard.edge_batches) <= 1 for shard in shards)
+    assert sum(len(shard.edge_batches) for shard in shards) > 1
+    for items, expected_ids in zip(item_lists, item_ids):
+        assert [item.obj_id for item in items] == expected_ids[:2]
+
+
+@pytest.mark.asyncio
+async def test_create_pent_clears_edge_loader() -> None:
+    context = create_test_context([KvetchMemShard()])
+    user_ids, _ = await gen_users_with_items(context, 1)
+    user = await SampleUser.gen(context, user_ids[0])
+
+    assert len(await user.gen_edges_to('user_to_items_edge')) == 3
+    await create_pent(context, SampleItem, CreateSampleItemData({'user_id': user.obj_id}))
+    assert len(await user.gen_edges_to('user_to_items_edge')) == 4
+
+
+@pytest.mark.asyncio
+async def test_index_lookups_batched() -> None:
+    shard = BatchCountingShard()
+    context = create_test_context([shard])
+    user_ids, *_ = await gen_users_with_items(context, 5)
+    shard.object_batches = []
+
+    names = ['user' + str(i) for i in range(0, 5)] + ['nobody']
+    users = await async_list(
+        [SampleUser.gen_from_index(context, 'user_name_index', name) for name in names]
+    )
+
+    assert [user.obj_id for user in users[:5]] == user_ids
+    assert users[5] is None
+    assert shard.index_batches == [names]
+    assert shard.object_batches == [user_ids]
+
+
+@pytest.mark.asyncio
+async def test_index_lookups_batched_per_shard() -> None:
+    shards = [BatchCountingShard() for _ in range(0, 4)]
+    context = create_test_context(shards)
+    user_ids, *_ = await gen_users_with_items(context, 12)
+
+    names = ['user' + str(i) for i in range(0, 12)]
+    users = await async_list(
+        [SampleUser.gen_from_index(context, 'user_name_index', name) for name in names]
+    )
+
+    assert [user.obj_id for user in users] == user_ids
+    assert all(len(shard.index_batches) <= 1 for shard in shards)
+    assert sorted(sum([shard.index_batches[0] for shard in shards if shard.index_batches],
+                      [])) == sorted(names)
+
+
+@pytest.mark.asyncio
+async def test_id_projection_skips_bodies() -> None:
+    shard = BatchCountingShard()
+    context = create_test_context([shard])
+    user_ids, item_ids = await gen_users_with_items(context, 1)
+    user = await SampleUser.gen(context, user_ids[0])
+    shard.object_batches = []
+
+    items = await user.gen_associated_pents(
+        SampleItem, 'user_to_items_edge', projection=frozenset(['obj_id'])
+    )
+    assert [item.obj_id for item in items] == item_ids
+    assert shard.projected_batches == [item_ids]
+    assert shard.object_batches == []
+
+    # full loads never see the partial objects
+    items = await SampleItem.gen_list(context, item_ids)
+    assert [item._data['user_id'] for item in items] == [user.obj_id] * 3
+    assert shard.object_batches == [item_ids]
+
+
+@pytest.mark.asyncio
+async def test_body_projection_loads_whole_objects() -> None:
+    shard = BatchCountingShard()
+    context = create_test_context([shard])
+    user_ids, item_ids = await gen_users_with_items(context, 1)
+    shard.object_batches = []
+
+    items = await SampleItem.gen_list(context, item_ids, frozenset(['obj_id', 'user_id']))
+    assert [item._data['user_id'] for item in items] == user_ids * 3
+    assert shard.projected_batches == []
+    assert shard.object_batches == [item_ids]
+
+
+@pytest.mark.asyncio
+async def test_edge_counts_batched_and_cleared() -> None:
+    shard = BatchCountingShard()
+    context = create_test_context([shard])
+    user_ids, *item_ids = await gen_users_with_items(context, 4)
+
+    users = await SampleUser.gen_list(context, user_ids)
+    counts = await async_list([user.gen_edge_count('user_to_items_edge') for user in users])
+    assert counts == [3, 3, 3, 3]
+    assert shard.count_batches == [user_ids]
+
+    await delete_pent(context, SampleItem, item_ids[0][0])
+    assert await users[0].gen_edge_count('user_to_items_edge') == 2
+
+
+@pytest.mark.asyncio
+async def test_loaded_pents_keep_records_undecoded() -> None:
+    context = create_test_context([LazyRecordShard()])
+    user_ids, _ = await gen_users_with_items(context, 1)
+
+    users = await SampleUser.gen_list(context, user_ids)
+    assert isinstance(users[0]._data, LazyKvetchRecord)
+    assert not users[0]._data.is_decoded
+    assert users[0]._data['name'] == 'user0'
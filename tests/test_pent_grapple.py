@@ -88,6 +88,15 @@ type TodoList @pent(typeId: 100002) {
     )
 
 
+def test_edge_count(snapshot: Any) -> None:
+    assert_generated_pent(
+        snapshot, '''type TodoUser @pent(typeId: 100000) {
+  id: UUID!
+  todoListCount: Int! @edgeCount(edgeName: "user_to_list_edge")
+}'''
+    )
+
+
 def test_generated_mutations(snapshot: Any) -> None:
     assert_generated_pent(
         snapshot, '''type Mutation {